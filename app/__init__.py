@@ -1,13 +1,42 @@
 from flask import Flask
 from flask_socketio import SocketIO
-from app.models.device import db
-from app.tasks.scheduler import MonitoringScheduler
 import logging
 
+# Instancié avant les imports internes : app.sockets.live_status importe socketio
 socketio = SocketIO()
+
+from app.models.device import db  # noqa: E402
+from app.models.migrations import run_migrations  # noqa: E402
+from app.tasks.scheduler import MonitoringScheduler  # noqa: E402
+
 scheduler = MonitoringScheduler()
 
-def create_app():
+def check_message_queue(url, timeout=5):
+    """Vérifie que la file de messages Socket.IO est joignable
+
+    Sans elle, les émissions du processus de collecte sont perdues sans
+    erreur visible : mieux vaut refuser de démarrer.
+    """
+    try:
+        if url.startswith(('redis://', 'rediss://', 'unix://')):
+            import redis
+            redis.Redis.from_url(url, socket_connect_timeout=timeout).ping()
+        else:
+            import kombu
+            with kombu.Connection(url, connect_timeout=timeout) as connection:
+                connection.ensure_connection(max_retries=1)
+    except ImportError as e:
+        raise RuntimeError(f"SOCKETIO_MESSAGE_QUEUE={url} : client de la file de messages absent ({e.name})") from e
+    except Exception as e:
+        raise RuntimeError(f"SOCKETIO_MESSAGE_QUEUE={url} injoignable : {e}") from e
+
+def create_app(start_scheduler=None):
+    """Crée l'application Flask
+
+    `start_scheduler` force ou empêche le démarrage du planificateur de collecte
+    (par défaut : SCHEDULER_ENABLED). Les processus web lancés derrière gunicorn
+    le désactivent et laissent la collecte au processus poller.py.
+    """
     app = Flask(__name__)
     app.config.from_object('config.Config')
 
@@ -16,6 +45,8 @@ def create_app():
         level=logging.INFO,
         format='%(asctime)s %(levelname)s %(name)s: %(message)s'
     )
+    # Le tick de collecte s'exécute chaque seconde : journaux d'APScheduler limités aux avertissements
+    logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
     # Initialisation de la base de données
     db.init_app(app)
@@ -25,16 +56,27 @@ def create_app():
     app.register_blueprint(device_bp)
 
     # Initialisation de SocketIO
-    socketio.init_app(app, cors_allowed_origins="*")
+    # La file de messages permet au processus de collecte d'émettre vers les clients web
+    message_queue = app.config.get('SOCKETIO_MESSAGE_QUEUE')
+    if message_queue:
+        check_message_queue(message_queue)
+    socketio.init_app(app, cors_allowed_origins="*", message_queue=message_queue)
 
     # Importation des handlers SocketIO
     from app.sockets import live_status
 
-    # Initialisation du planificateur
-    scheduler.init_app(app)
-
-    # Création des tables de base de données
+    # Création des tables de base de données, puis migration des bases existantes
+    # (avant le démarrage de la collecte)
     with app.app_context():
         db.create_all()
+        run_migrations()
+
+    # Initialisation du planificateur
+    if start_scheduler is None:
+        start_scheduler = app.config.get('SCHEDULER_ENABLED', True)
+    if start_scheduler:
+        scheduler.init_app(app)
+    else:
+        scheduler.shutdown()
 
     return app
@@ -0,0 +1,28 @@
+from app.models.device import db
+
+
+class MetricChunk(db.Model):
+    """Bloc compressé d'une série (appareil, métrique) sur une fenêtre de temps fixe
+
+    `data` contient les horodatages et valeurs de la fenêtre codés par
+    app.services.timeseries_codec ; start_time / end_time bornent les points
+    réellement présents.
+    """
+    __tablename__ = 'metric_chunks'
+    __table_args__ = (
+        # Rétention : blocs entièrement expirés
+        db.Index('ix_metric_chunks_end_time', 'end_time'),
+    )
+
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id', ondelete='CASCADE'), primary_key=True,
+                          autoincrement=False)
+    metric_type = db.Column(db.String(50), primary_key=True)
+    window_start = db.Column(db.DateTime, primary_key=True)  # début de la fenêtre (UTC)
+    unit = db.Column(db.String(20))
+    count = db.Column(db.Integer, nullable=False, default=0)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f'<MetricChunk {self.metric_type} {self.window_start} ({self.count} points)>'
@@ -1,8 +1,10 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from app.models.encrypted import EncryptedString
 
 db = SQLAlchemy()
 
+
 class Device(db.Model):
     __tablename__ = 'devices'
     
@@ -26,6 +28,8 @@ class Device(db.Model):
     
     # Relations
     metrics = db.relationship('DeviceMetric', backref='device', lazy=True, cascade='all, delete-orphan')
+    poll_profile = db.relationship('PollProfile', backref='device', uselist=False, lazy=True, cascade='all, delete-orphan')
+    snmp_credential = db.relationship('SNMPCredential', backref='device', uselist=False, lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Device {self.name} ({self.ip_address})>'
@@ -45,8 +49,15 @@ class Device(db.Model):
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
+
 class DeviceMetric(db.Model):
     __tablename__ = 'device_metrics'
+    __table_args__ = (
+        # Séries d'un appareil (par type) sur une fenêtre de temps
+        db.Index('ix_device_metrics_device_type_timestamp', 'device_id', 'metric_type', 'timestamp'),
+        # Rétention : suppression des échantillons plus anciens qu'une date
+        db.Index('ix_device_metrics_timestamp', 'timestamp'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), nullable=False)
@@ -66,4 +77,56 @@ class DeviceMetric(db.Model):
             'value': self.value,
             'unit': self.unit,
             'timestamp': self.timestamp.isoformat()
-        }
\ No newline at end of file
+        }
+
+
+class PollProfile(db.Model):
+    __tablename__ = 'poll_profiles'
+    
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), primary_key=True, autoincrement=False)
+    sys_object_id = db.Column(db.String(255), index=True)
+    device_type = db.Column(db.String(50))
+    scalar_oids = db.Column(db.JSON, nullable=False, default=dict)  # métrique -> OID d'instance supporté
+    interface_counter_bits = db.Column(db.Integer)  # 64 (ifXTable), 32 (ifTable) ou NULL
+    discovered_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<PollProfile {self.device_id} ({self.sys_object_id})>'
+    
+    def to_dict(self):
+        return {
+            'device_id': self.device_id,
+            'sys_object_id': self.sys_object_id,
+            'device_type': self.device_type,
+            'scalar_oids': dict(self.scalar_oids or {}),
+            'interface_counter_bits': self.interface_counter_bits,
+            'discovered_at': self.discovered_at.isoformat() if self.discovered_at else None
+        }
+
+
+class SNMPCredential(db.Model):
+    __tablename__ = 'snmp_credentials'
+    
+    AUTH_PROTOCOLS = ('none', 'md5', 'sha', 'sha224', 'sha256', 'sha384', 'sha512')
+    PRIV_PROTOCOLS = ('none', 'des', '3des', 'aes', 'aes192', 'aes256')
+    
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id'), primary_key=True, autoincrement=False)
+    username = db.Column(db.String(32), nullable=False)
+    auth_protocol = db.Column(db.String(10), default='sha')
+    # Phrases secrètes chiffrées au repos (AES-GCM, clé CREDENTIALS_KEY)
+    auth_key = db.Column(EncryptedString(128))
+    priv_protocol = db.Column(db.String(10), default='aes')
+    priv_key = db.Column(EncryptedString(128))
+    engine_id = db.Column(db.String(64))  # engine ID autoritaire découvert (hexadécimal)
+    
+    def __repr__(self):
+        return f'<SNMPCredential {self.device_id} ({self.username})>'
+    
+    def to_dict(self):
+        # Les phrases secrètes ne sont jamais renvoyées par l'API
+        return {
+            'username': self.username,
+            'auth_protocol': self.auth_protocol,
+            'priv_protocol': self.priv_protocol,
+            'engine_id': self.engine_id
+        }
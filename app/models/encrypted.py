@@ -0,0 +1,58 @@
+from base64 import b64decode, b64encode
+from hashlib import sha256
+from flask import current_app
+from sqlalchemy.types import String, TypeDecorator
+from Cryptodome.Cipher import AES
+from Cryptodome.Random import get_random_bytes
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Préfixe des valeurs chiffrées ; une valeur sans préfixe est un ancien texte en clair
+ENCRYPTED_PREFIX = 'enc:'
+
+
+def _cipher_key():
+    """Clé AES-256 dérivée de CREDENTIALS_KEY (SECRET_KEY par défaut)"""
+    secret = current_app.config.get('CREDENTIALS_KEY') or current_app.config['SECRET_KEY']
+    return sha256(secret.encode('utf-8')).digest()
+
+
+def encrypt_secret(value):
+    """Chiffre une chaîne en AES-GCM : 'enc:' + base64(nonce, tag, texte chiffré)"""
+    if value is None:
+        return None
+    cipher = AES.new(_cipher_key(), AES.MODE_GCM, nonce=get_random_bytes(12))
+    ciphertext, tag = cipher.encrypt_and_digest(value.encode('utf-8'))
+    return ENCRYPTED_PREFIX + b64encode(cipher.nonce + tag + ciphertext).decode('ascii')
+
+
+def decrypt_secret(value):
+    """Déchiffre une valeur produite par encrypt_secret (texte en clair rendu tel quel)
+
+    Retourne None si la valeur ne peut pas être déchiffrée (clé changée).
+    """
+    if value is None or not value.startswith(ENCRYPTED_PREFIX):
+        return value
+    data = b64decode(value[len(ENCRYPTED_PREFIX):])
+    cipher = AES.new(_cipher_key(), AES.MODE_GCM, nonce=data[:12])
+    try:
+        return cipher.decrypt_and_verify(data[28:], data[12:28]).decode('utf-8')
+    except ValueError:
+        logger.error("Secret chiffré illisible : CREDENTIALS_KEY (ou SECRET_KEY) a changé")
+        return None
+
+
+class EncryptedString(TypeDecorator):
+    """Colonne texte chiffrée au repos, lue et écrite en clair par l'ORM
+
+    Les valeurs chiffrées ne sont pas comparables en SQL (nonce aléatoire).
+    """
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return encrypt_secret(value)
+
+    def process_result_value(self, value, dialect):
+        return decrypt_secret(value)
@@ -0,0 +1,93 @@
+from itertools import chain
+from app.models.device import Device, SNMPCredential, db
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+# Colonnes de devices modifiées à chaque sonde : n'incrémentent que `version`
+VOLATILE_COLUMNS = frozenset(('cpu_usage', 'memory_usage', 'uptime', 'last_seen', 'updated_at'))
+
+
+# Ligne de compteurs de ce processus : commune hors collecte répartie
+DEFAULT_WRITER = 'default'
+_writer = DEFAULT_WRITER
+
+
+class FleetVersion(db.Model):
+    """Compteurs de version de la table devices, une ligne par processus écrivain
+
+    `version` change à chaque écriture d'un appareil, `status_version`
+    seulement lorsque la liste des appareils, leurs champs descriptifs ou
+    un statut changent. Chaque poller réparti incrémente sa propre ligne
+    (son identifiant de processus) : les vidages de processus différents ne
+    se disputent pas une même ligne. Les autres écrivains (API, poller
+    unique) partagent la ligne 'default'. Les ETag de l'API lisent toutes
+    les lignes en une requête : un processus web connaît ainsi l'état écrit
+    par les processus de collecte sans parcourir devices.
+    """
+    __tablename__ = 'fleet_versions'
+
+    writer = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    status_version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<FleetVersion {self.writer} {self.version}/{self.status_version}>'
+
+
+def set_fleet_writer(writer=None):
+    """Ligne de compteurs incrémentée par ce processus (None : ligne commune)"""
+    global _writer
+    _writer = writer or DEFAULT_WRITER
+
+
+def bump_fleet_version(executor, status=False):
+    """Incrémente les compteurs de ce processus dans la transaction de `executor` (session ou connexion)"""
+    table = FleetVersion.__table__
+    values = {'version': table.c.version + 1}
+    if status:
+        values['status_version'] = table.c.status_version + 1
+    if not executor.execute(table.update().where(table.c.writer == _writer).values(values)).rowcount:
+        executor.execute(table.insert().values(writer=_writer, version=1, status_version=1))
+
+
+def read_fleet_version():
+    """(versions, versions de statut) écrites en base : couples (écrivain, compteur) triés"""
+    table = FleetVersion.__table__
+    rows = db.session.execute(
+        db.select(table.c.writer, table.c.version, table.c.status_version).order_by(table.c.writer)
+    ).all()
+    return (
+        tuple((writer, version) for writer, version, _ in rows),
+        tuple((writer, status_version) for writer, _, status_version in rows)
+    )
+
+
+def forget_fleet_writers(live_writers):
+    """Supprime les lignes des pollers répartis qui ne sont plus vivants"""
+    FleetVersion.query.filter(
+        FleetVersion.writer != DEFAULT_WRITER, FleetVersion.writer.notin_(live_writers)
+    ).delete(synchronize_session=False)
+
+
+def _status_change(obj):
+    """Vrai si la modification d'un appareil touche autre chose que ses colonnes volatiles"""
+    if isinstance(obj, SNMPCredential):
+        return True
+    return any(
+        attr.key not in VOLATILE_COLUMNS and attr.history.has_changes()
+        for attr in inspect(obj).attrs
+    )
+
+
+@event.listens_for(Session, 'before_flush')
+def _track_device_writes(session, flush_context, instances):
+    """Écritures ORM d'appareils (API, test de connectivité) : compteurs dans la même transaction
+
+    Les UPDATE groupés du MetricWriter, hors ORM, appellent bump_fleet_version
+    eux-mêmes.
+    """
+    tracked = (Device, SNMPCredential)
+    created = any(isinstance(obj, tracked) for obj in chain(session.new, session.deleted))
+    modified = [obj for obj in session.dirty if isinstance(obj, tracked) and session.is_modified(obj)]
+    if created or modified:
+        bump_fleet_version(session, status=created or any(_status_change(obj) for obj in modified))
@@ -0,0 +1,158 @@
+from datetime import datetime
+from sqlalchemy import String, type_coerce
+from sqlalchemy.exc import IntegrityError
+from app.models.device import DeviceMetric, SNMPCredential, db
+from app.models.encrypted import ENCRYPTED_PREFIX
+from app.models.rollup import ROLLUP_MODELS, apply_rollups
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaMigration(db.Model):
+    """Version de schéma appliquée à la base"""
+    __tablename__ = 'schema_migrations'
+
+    version = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<SchemaMigration {self.version}>'
+
+
+class MigrationProgress(db.Model):
+    """Avancement d'une migration appliquée par lots (reprise après interruption)"""
+    __tablename__ = 'migration_progress'
+
+    version = db.Column(db.String(100), primary_key=True)
+    position = db.Column(db.BigInteger, nullable=False, default=0)
+    target = db.Column(db.BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f'<MigrationProgress {self.version} {self.position}/{self.target}>'
+
+
+def _create_indexes(*tables):
+    """Crée les index déclarés sur les modèles qui manquent dans la base"""
+    def migrate(connection):
+        for table in tables:
+            table.create(connection, checkfirst=True)
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+    return migrate
+
+
+def _batched(migrate):
+    """Migration appliquée en plusieurs transactions : elle reçoit le moteur, pas une connexion"""
+    migrate.batched = True
+    return migrate
+
+
+@_batched
+def _backfill_rollups(engine, chunk_size=50000, version='0002_metric_rollups_backfill'):
+    """Agrège les échantillons bruts déjà présents dans les tables d'agrégats
+
+    Un lot de `chunk_size` échantillons par transaction, validé avec la
+    progression (dernier id agrégé) : une migration interrompue reprend au lot
+    suivant. La borne (plus grand id au premier démarrage) est enregistrée une
+    fois ; les échantillons écrits ensuite sont agrégés à l'écriture. Chaque lot
+    est réservé par une mise à jour conditionnelle de la progression, si bien
+    que deux processus qui migrent en même temps ne l'agrègent pas deux fois.
+    """
+    for model in ROLLUP_MODELS:
+        model.__table__.create(engine, checkfirst=True)
+    progress = MigrationProgress.__table__
+    progress.create(engine, checkfirst=True)
+    table = DeviceMetric.__table__
+    try:
+        with engine.begin() as connection:
+            target = connection.execute(db.select(db.func.max(table.c.id))).scalar() or 0
+            connection.execute(progress.insert().values(version=version, position=0, target=target))
+    except IntegrityError:
+        pass  # reprise, ou progression créée par un autre processus
+
+    while True:
+        with engine.begin() as connection:
+            position, target = connection.execute(
+                db.select(progress.c.position, progress.c.target).where(progress.c.version == version)
+            ).one()
+            rows = connection.execute(
+                db.select(table.c.id, table.c.device_id, table.c.metric_type, table.c.value, table.c.unit, table.c.timestamp)
+                .where(table.c.id > position, table.c.id <= target).order_by(table.c.id).limit(chunk_size)
+            ).mappings().all()
+            if not rows:
+                return
+            # Sans effet si un autre processus a déjà agrégé ce lot : on relit la progression
+            claimed = connection.execute(
+                progress.update()
+                .where(progress.c.version == version, progress.c.position == position)
+                .values(position=rows[-1]['id'])
+            ).rowcount
+            if claimed:
+                apply_rollups(rows, connection)
+
+
+def _encrypt_snmp_keys(connection):
+    """Chiffre les phrases secrètes SNMPv3 enregistrées en clair"""
+    table = SNMPCredential.__table__
+    raw_auth, raw_priv = type_coerce(table.c.auth_key, String), type_coerce(table.c.priv_key, String)
+    rows = connection.execute(db.select(table.c.device_id, raw_auth, raw_priv)).all()
+    for device_id, auth_key, priv_key in rows:
+        values = {
+            column: value for column, value in (('auth_key', auth_key), ('priv_key', priv_key))
+            if value is not None and not value.startswith(ENCRYPTED_PREFIX)
+        }
+        if values:
+            connection.execute(table.update().where(table.c.device_id == device_id).values(**values))
+
+
+def _drop_shared_fleet_version(connection):
+    """Supprime l'ancienne ligne de version commune, remplacée par fleet_versions"""
+    connection.execute(db.text('DROP TABLE IF EXISTS fleet_version'))
+
+
+# Migrations ordonnées : (version, fonction(connexion)), appliquées une seule fois chacune
+MIGRATIONS = [
+    ('0001_device_metrics_time_series_indexes', _create_indexes(DeviceMetric.__table__)),
+    ('0002_metric_rollups_backfill', _backfill_rollups),
+    ('0003_metric_rollups_bucket_indexes', _create_indexes(*(model.__table__ for model in ROLLUP_MODELS))),
+    ('0004_snmp_credentials_encrypted_keys', _encrypt_snmp_keys),
+    ('0005_fleet_versions_per_writer', _drop_shared_fleet_version),
+]
+
+
+def run_migrations(engine=None):
+    """Applique les migrations manquantes et retourne les versions appliquées
+
+    db.create_all() crée les tables absentes mais ne modifie pas une table
+    existante (index, colonnes) : ces changements passent par MIGRATIONS.
+    Chaque migration est appliquée dans sa propre transaction avec
+    l'enregistrement de sa version ; si un autre processus (web, poller)
+    l'applique en même temps, l'enregistrement en double est ignoré. Les
+    migrations par lots (_batched) valident leur progression à chaque lot et
+    n'enregistrent leur version qu'une fois terminées.
+    """
+    engine = engine or db.engine
+    table = SchemaMigration.__table__
+    table.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        done = {row[0] for row in connection.execute(db.select(table.c.version))}
+
+    applied = []
+    for version, migrate in MIGRATIONS:
+        if version in done:
+            continue
+        batched = getattr(migrate, 'batched', False)
+        if batched:
+            migrate(engine)
+        try:
+            with engine.begin() as connection:
+                if not batched:
+                    migrate(connection)
+                connection.execute(table.insert().values(version=version, applied_at=datetime.utcnow()))
+        except IntegrityError:
+            logger.info(f"Migration {version} déjà appliquée par un autre processus")
+            continue
+        logger.info(f"Migration {version} appliquée")
+        applied.append(version)
+    return applied
@@ -0,0 +1,33 @@
+from datetime import datetime
+from app.models.device import db
+
+
+class PollerWorker(db.Model):
+    __tablename__ = 'poller_workers'
+
+    id = db.Column(db.String(100), primary_key=True)  # identifiant du processus de collecte
+    hostname = db.Column(db.String(255))
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    heartbeat_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<PollerWorker {self.id}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'hostname': self.hostname,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'heartbeat_at': self.heartbeat_at.isoformat() if self.heartbeat_at else None
+        }
+
+
+class DeviceLease(db.Model):
+    __tablename__ = 'device_leases'
+
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id', ondelete='CASCADE'), primary_key=True, autoincrement=False)
+    worker_id = db.Column(db.String(100), index=True)  # NULL : bail libre
+    expires_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<DeviceLease {self.device_id} -> {self.worker_id}>'
@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta
+from app.models.device import db
+from sqlalchemy import bindparam, case
+from sqlalchemy.orm import declared_attr
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class MetricRollupMixin:
+    """Agrégats (min, max, somme, nombre) d'une série sur des intervalles fixes
+
+    La clé primaire (device_id, metric_type, bucket) sert aussi d'index pour
+    les lectures d'une série sur une fenêtre de temps. La moyenne est dérivée
+    de la somme et du nombre, ce qui permet de fusionner les lots au fil de
+    l'eau.
+    """
+    resolution = None  # secondes
+    tier = None  # nom du palier de rétention
+
+    @declared_attr
+    def __table_args__(cls):
+        # Rétention : intervalles expirés
+        return (db.Index(f'ix_{cls.__tablename__}_bucket', 'bucket'),)
+
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.id', ondelete='CASCADE'), primary_key=True,
+                          autoincrement=False)
+    metric_type = db.Column(db.String(50), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)  # début de l'intervalle (UTC)
+    unit = db.Column(db.String(20))
+    count = db.Column(db.Integer, nullable=False, default=0)
+    value_sum = db.Column(db.Float, nullable=False, default=0.0)
+    value_min = db.Column(db.Float, nullable=False)
+    value_max = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.metric_type} {self.bucket}>'
+
+    def to_dict(self):
+        return {
+            'device_id': self.device_id,
+            'metric_type': self.metric_type,
+            'value': self.value_sum / self.count if self.count else None,
+            'min': self.value_min,
+            'max': self.value_max,
+            'count': self.count,
+            'unit': self.unit,
+            'timestamp': self.bucket.isoformat(),
+            'resolution': self.resolution
+        }
+
+
+class MetricRollup1m(MetricRollupMixin, db.Model):
+    __tablename__ = 'metric_rollups_1m'
+    resolution = 60
+    tier = '1m'
+
+
+class MetricRollup5m(MetricRollupMixin, db.Model):
+    __tablename__ = 'metric_rollups_5m'
+    resolution = 300
+    tier = '5m'
+
+
+class MetricRollup1h(MetricRollupMixin, db.Model):
+    __tablename__ = 'metric_rollups_1h'
+    resolution = 3600
+    tier = '1h'
+
+
+# De la plus fine à la plus grossière
+ROLLUP_MODELS = (MetricRollup1m, MetricRollup5m, MetricRollup1h)
+
+
+def bucket_start(timestamp, resolution):
+    """Début de l'intervalle de `resolution` secondes contenant `timestamp`"""
+    seconds = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % resolution)
+
+
+def apply_rollups(samples, executor=None, models=ROLLUP_MODELS):
+    """Fusionne des échantillons bruts dans les tables d'agrégats
+
+    `samples` : dicts device_id, metric_type, value, unit, timestamp. Les
+    échantillons sont d'abord agrégés en mémoire par intervalle, puis, pour
+    chaque résolution, les intervalles existants sont mis à jour et les autres
+    insérés, par requêtes groupées (executemany), dans la transaction de
+    l'appelant (`executor` : session ou connexion, db.session par défaut).
+    `models` restreint les résolutions mises à jour.
+    """
+    executor = executor if executor is not None else db.session
+    if not samples:
+        return
+
+    for model in models:
+        table = model.__table__
+        aggregates = {}
+        for sample in samples:
+            value = float(sample['value'])
+            key = (sample['device_id'], sample['metric_type'], bucket_start(sample['timestamp'], model.resolution))
+            aggregate = aggregates.get(key)
+            if aggregate is None:
+                aggregates[key] = {'unit': sample.get('unit'), 'count': 1, 'sum': value, 'min': value, 'max': value}
+            else:
+                aggregate['count'] += 1
+                aggregate['sum'] += value
+                aggregate['min'] = min(aggregate['min'], value)
+                aggregate['max'] = max(aggregate['max'], value)
+
+        buckets = [key[2] for key in aggregates]
+        existing = {
+            tuple(row) for row in executor.execute(
+                db.select(table.c.device_id, table.c.metric_type, table.c.bucket).where(
+                    table.c.device_id.in_({key[0] for key in aggregates}),
+                    table.c.metric_type.in_({key[1] for key in aggregates}),
+                    table.c.bucket.between(min(buckets), max(buckets))
+                )
+            )
+        }
+
+        updates, inserts = [], []
+        for key, aggregate in aggregates.items():
+            if key in existing:
+                updates.append({
+                    'b_device_id': key[0], 'b_metric_type': key[1], 'b_bucket': key[2],
+                    'b_count': aggregate['count'], 'b_sum': aggregate['sum'],
+                    'b_min': aggregate['min'], 'b_max': aggregate['max']
+                })
+            else:
+                inserts.append({
+                    'device_id': key[0], 'metric_type': key[1], 'bucket': key[2], 'unit': aggregate['unit'],
+                    'count': aggregate['count'], 'value_sum': aggregate['sum'],
+                    'value_min': aggregate['min'], 'value_max': aggregate['max']
+                })
+
+        if updates:
+            executor.execute(
+                table.update()
+                .where(
+                    table.c.device_id == bindparam('b_device_id'),
+                    table.c.metric_type == bindparam('b_metric_type'),
+                    table.c.bucket == bindparam('b_bucket')
+                )
+                .values(
+                    count=table.c.count + bindparam('b_count'),
+                    value_sum=table.c.value_sum + bindparam('b_sum'),
+                    value_min=case((table.c.value_min <= bindparam('b_min'), table.c.value_min), else_=bindparam('b_min')),
+                    value_max=case((table.c.value_max >= bindparam('b_max'), table.c.value_max), else_=bindparam('b_max'))
+                ),
+                updates
+            )
+        if inserts:
+            executor.execute(table.insert(), inserts)
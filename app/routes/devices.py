@@ -1,36 +1,224 @@
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash
-from app.models.device import Device, DeviceMetric, db
-from app.services.snmp import SNMPService
+from flask import Blueprint, Response, render_template, request, jsonify, redirect, url_for, flash, stream_with_context
+from app.models.device import Device, SNMPCredential, db
+from app.models.chunk import MetricChunk
+from app.models.fleet_version import read_fleet_version
+from app.models.rollup import ROLLUP_MODELS
+from app.services.fleet_stats import fleet_stats
+from app.services.snmp import get_snmp_service
+from app.services.metrics_query import (
+    DEFAULT_PAGE_SIZE, EXPORT_FORMATS, MAX_PAGE_SIZE, decode_cursor, encode_cursor, iter_device_metrics,
+    query_device_metrics, stream_export
+)
+from app import scheduler
 from datetime import datetime, timedelta
+from itertools import islice
+from sqlalchemy import and_, or_
+import hashlib
 import ipaddress
+import os
 
 device_bp = Blueprint('devices', __name__)
 
+# Champs de Device.to_dict(), puis ceux ajoutés par l'API
+DEVICE_FIELDS = (
+    'id', 'name', 'ip_address', 'device_type', 'status', 'last_seen', 'cpu_usage', 'memory_usage', 'uptime',
+    'created_at', 'updated_at'
+)
+DEVICE_API_FIELDS = DEVICE_FIELDS + ('polling', 'snmp_v3')
+# Champs qui changent à chaque sonde : hors de ces champs, l'ETag ne suit que les statuts
+VOLATILE_FIELDS = {'cpu_usage', 'memory_usage', 'uptime', 'last_seen', 'updated_at', 'polling'}
+MAX_DEVICE_PAGE_SIZE = 1000
+# Colonnes du tableau de bord (l'état en mémoire s'y superpose)
+DASHBOARD_COLUMNS = (
+    Device.id, Device.name, Device.ip_address, Device.device_type, Device.status, Device.cpu_usage,
+    Device.memory_usage, Device.last_seen
+)
+# Distingue les ETag de deux processus (ou d'un redémarrage) aux compteurs identiques
+_ETAG_SALT = os.urandom(8).hex()
+
+def _device_with_polling(device):
+    """Sérialise un appareil avec son état de backoff de collecte"""
+    data = scheduler.device_states.overlay(device.to_dict())
+    data['polling'] = scheduler.backoff.get_state(device.id)
+    data['snmp_v3'] = device.snmp_credential.to_dict() if device.snmp_credential else None
+    return data
+
+def _apply_snmp_v3(device, data):
+    """Crée ou met à jour les identifiants SNMPv3 ; retourne un message d'erreur ou None"""
+    if device.snmp_version != '3':
+        return None
+    
+    values = data.get('snmp_v3') or {}
+    credential = device.snmp_credential or SNMPCredential()
+    for field in ('username', 'auth_protocol', 'auth_key', 'priv_protocol', 'priv_key'):
+        if field in values:
+            setattr(credential, field, values[field])
+    
+    credential.auth_protocol = credential.auth_protocol or 'sha'
+    credential.priv_protocol = credential.priv_protocol or 'aes'
+    
+    if not credential.username:
+        return 'Le champ snmp_v3.username est requis pour SNMPv3'
+    if credential.auth_protocol not in SNMPCredential.AUTH_PROTOCOLS:
+        return 'Protocole d\'authentification SNMPv3 invalide'
+    if credential.priv_protocol not in SNMPCredential.PRIV_PROTOCOLS:
+        return 'Protocole de chiffrement SNMPv3 invalide'
+    if credential.auth_protocol == 'none' and credential.priv_protocol != 'none':
+        return 'Le chiffrement SNMPv3 nécessite une authentification'
+    # Les agents refusent les phrases secrètes de moins de 8 caractères (RFC 3414) ;
+    # au-delà de 64, la valeur chiffrée ne tient plus dans la colonne
+    for field, protocol in (('auth_key', credential.auth_protocol), ('priv_key', credential.priv_protocol)):
+        if protocol != 'none' and not 8 <= len(getattr(credential, field) or '') <= 64:
+            return f'Le champ snmp_v3.{field} doit contenir entre 8 et 64 caractères'
+    
+    device.snmp_credential = credential
+    return None
+
 @device_bp.route('/')
 def dashboard():
     """Page d'accueil avec le tableau de bord"""
-    devices = Device.query.all()
+    # Colonnes affichées seulement, état courant tenu en mémoire par-dessus
+    devices = []
+    for row in db.session.execute(db.select(*DASHBOARD_COLUMNS).order_by(Device.id)):
+        device = dict(row._mapping)
+        device.update(scheduler.device_states.state(device['id']) or {})
+        devices.append(device)
     
-    # Statistiques générales
-    total_devices = len(devices)
-    online_devices = len([d for d in devices if d.status == 'online'])
-    offline_devices = len([d for d in devices if d.status == 'offline'])
-    warning_devices = len([d for d in devices if d.status == 'warning'])
-    
-    stats = {
-        'total': total_devices,
-        'online': online_devices,
-        'offline': offline_devices,
-        'warning': warning_devices
-    }
+    # Statistiques générales (agrégats SQL)
+    stats = fleet_stats(scheduler.device_states)
     
     return render_template('dashboard.html', devices=devices, stats=stats)
 
+def _split_arg(name):
+    value = request.args.get(name)
+    return [item.strip() for item in value.split(',') if item.strip()] if value else None
+
+def _devices_etag(fields):
+    """ETag de la liste des appareils, selon des compteurs de version
+    
+    Ceux de l'état en mémoire pour les appareils sondés ici, ceux de la
+    table fleet_versions (une ligne par processus écrivain, lues en une
+    requête) pour l'état écrit en base par les autres processus : aucun
+    parcours de devices. Un processus web seul ne dépend que de
+    fleet_versions, partagée par tous les workers.
+    """
+    store = scheduler.device_states
+    volatile = not VOLATILE_FIELDS.isdisjoint(fields)
+    basis = []
+    if store.active:
+        basis += [_ETAG_SALT, store.version if volatile else store.status_version]
+    if 'polling' in fields:
+        basis.append(scheduler.backoff.version)
+    if not store.complete:
+        version, status_version = read_fleet_version()
+        basis.append(version if volatile else status_version)
+    basis.append(request.query_string.decode())
+    return hashlib.sha1(repr(basis).encode()).hexdigest()[:24]
+
+def _status_condition(statuses):
+    """Filtre SQL sur le statut courant : celui en base, corrigé des statuts en mémoire pas encore écrits"""
+    joined, left = [], []
+    for device_id, _, persisted, current in scheduler.device_states.status_changes():
+        if (current in statuses) != (persisted in statuses):
+            (joined if current in statuses else left).append(device_id)
+    condition = Device.status.in_(statuses)
+    if joined:
+        condition = or_(condition, Device.id.in_(joined))
+    if left:
+        condition = and_(condition, Device.id.notin_(left))
+    return condition
+
+def _device_list_args():
+    """Paramètres de GET /api/devices : ({'fields', 'limit', 'cursor'}, None) ou (None, message d'erreur)"""
+    fields = _split_arg('fields') or list(DEVICE_API_FIELDS)
+    unknown = [field for field in fields if field not in DEVICE_API_FIELDS]
+    if unknown:
+        return None, f"Champs inconnus: {', '.join(unknown)}"
+    limit = request.args.get('limit', type=int)
+    if limit is not None and not 0 < limit <= MAX_DEVICE_PAGE_SIZE:
+        return None, f'limit doit être compris entre 1 et {MAX_DEVICE_PAGE_SIZE}'
+    cursor = request.args.get('cursor')
+    if cursor is not None and not cursor.isdigit():
+        return None, 'Curseur invalide'
+    return {'fields': fields, 'limit': limit, 'cursor': cursor}, None
+
+def _query_devices(limit=None, cursor=None):
+    """Page d'appareils filtrés, état en mémoire superposé : (appareils, curseur suivant ou None)"""
+    # Colonnes lues sans charger d'objets ORM ; l'état courant vient de la mémoire
+    columns = [getattr(Device, column) for column in DEVICE_FIELDS]
+    query = db.select(*columns).order_by(Device.id)
+    statuses = _split_arg('status')
+    if statuses:
+        query = query.where(_status_condition(statuses))
+    device_types = _split_arg('device_type')
+    if device_types:
+        query = query.where(Device.device_type.in_(device_types))
+    ip_prefix = request.args.get('ip_prefix')
+    if ip_prefix:
+        escaped = ip_prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.where(Device.ip_address.like(f'{escaped}%', escape='\\'))
+    if cursor is not None:
+        query = query.where(Device.id > int(cursor))
+    if limit is not None:
+        query = query.limit(limit + 1)
+    rows = db.session.execute(query).all()
+    
+    has_more = limit is not None and len(rows) > limit
+    rows = rows[:limit] if has_more else rows
+    devices = [
+        scheduler.device_states.overlay({
+            column: value.isoformat() if isinstance(value, datetime) else value
+            for column, value in zip(DEVICE_FIELDS, row)
+        })
+        for row in rows
+    ]
+    return devices, str(rows[-1].id) if has_more else None
+
+def _serialize_devices(devices, fields):
+    """Champs demandés des appareils, avec état de backoff et identifiants SNMPv3 si demandés"""
+    if 'polling' in fields:
+        for data in devices:
+            data['polling'] = scheduler.backoff.get_state(data['id'])
+    if 'snmp_v3' in fields and devices:
+        device_ids = [data['id'] for data in devices]
+        credentials = {
+            credential.device_id: credential.to_dict()
+            for credential in SNMPCredential.query.filter(SNMPCredential.device_id.in_(device_ids))
+        }
+        for data in devices:
+            data['snmp_v3'] = credentials.get(data['id'])
+    return [{field: data[field] for field in fields} for data in devices]
+
 @device_bp.route('/api/devices', methods=['GET'])
 def get_devices():
-    """API pour récupérer la liste des appareils"""
-    devices = Device.query.all()
-    return jsonify([device.to_dict() for device in devices])
+    """API pour récupérer la liste des appareils
+    
+    Paramètres optionnels : filtres `status` et `device_type` (valeurs
+    séparées par des virgules) et `ip_prefix` ; `fields` restreint les champs
+    renvoyés ; `limit` / `cursor` paginent par identifiant croissant
+    (l'en-tête X-Next-Cursor donne le curseur de la page suivante).
+    
+    La réponse porte un ETag : une requête avec If-None-Match reçoit 304
+    tant que l'état des appareils n'a pas changé.
+    """
+    args, error = _device_list_args()
+    if error:
+        return jsonify({'error': error}), 400
+    
+    etag = _devices_etag(args['fields'])
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    devices, next_cursor = _query_devices(args['limit'], args['cursor'])
+    response = jsonify(_serialize_devices(devices, args['fields']))
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    response.set_etag(etag)
+    # Revalidation à chaque requête : le navigateur renvoie If-None-Match
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @device_bp.route('/api/devices', methods=['POST'])
 def add_device():
@@ -65,14 +253,17 @@ def add_device():
         snmp_community=data.get('snmp_community', 'public'),
         snmp_version=data.get('snmp_version', '2c')
     )
+    error = _apply_snmp_v3(device, data)
+    if error:
+        return jsonify({'error': error}), 400
     
     try:
         db.session.add(device)
         db.session.commit()
         
         # Tester la connectivité immédiatement
-        snmp_service = SNMPService()
-        snmp_service.test_device_connectivity(device)
+        get_snmp_service().test_device_connectivity(device)
+        scheduler.device_states.put(device, probed=True)
         
         return jsonify(device.to_dict()), 201
     except Exception as e:
@@ -83,7 +274,20 @@ def add_device():
 def get_device(device_id):
     """API pour récupérer les détails d'un appareil"""
     device = Device.query.get_or_404(device_id)
-    return jsonify(device.to_dict())
+    return jsonify(_device_with_polling(device))
+
+def _change_ip_address(device, ip_address):
+    """Valide et applique une nouvelle adresse IP ; retourne une réponse d'erreur ou None"""
+    try:
+        ipaddress.ip_address(ip_address)
+    except ValueError:
+        return jsonify({'error': 'Adresse IP invalide'}), 400
+    # Vérifier l'unicité
+    existing = Device.query.filter_by(ip_address=ip_address).first()
+    if existing and existing.id != device.id:
+        return jsonify({'error': 'Un appareil avec cette adresse IP existe déjà'}), 409
+    device.ip_address = ip_address
+    return None
 
 @device_bp.route('/api/devices/<int:device_id>', methods=['PUT'])
 def update_device(device_id):
@@ -95,31 +299,25 @@ def update_device(device_id):
         return jsonify({'error': 'Données JSON requises'}), 400
     
     # Mise à jour des champs
-    if 'name' in data:
-        device.name = data['name']
-    if 'device_type' in data:
-        device.device_type = data['device_type']
-    if 'snmp_community' in data:
-        device.snmp_community = data['snmp_community']
-    if 'snmp_version' in data:
-        device.snmp_version = data['snmp_version']
+    for field in ('name', 'device_type', 'snmp_community', 'snmp_version'):
+        if field in data:
+            setattr(device, field, data[field])
+    error = _apply_snmp_v3(device, data)
+    if error:
+        db.session.rollback()
+        return jsonify({'error': error}), 400
     
     # Validation de l'adresse IP si elle est modifiée
     if 'ip_address' in data and data['ip_address'] != device.ip_address:
-        try:
-            ipaddress.ip_address(data['ip_address'])
-            # Vérifier l'unicité
-            existing = Device.query.filter_by(ip_address=data['ip_address']).first()
-            if existing and existing.id != device.id:
-                return jsonify({'error': 'Un appareil avec cette adresse IP existe déjà'}), 409
-            device.ip_address = data['ip_address']
-        except ValueError:
-            return jsonify({'error': 'Adresse IP invalide'}), 400
+        error = _change_ip_address(device, data['ip_address'])
+        if error:
+            return error
     
     try:
         device.updated_at = datetime.utcnow()
         db.session.commit()
-        return jsonify(device.to_dict())
+        scheduler.device_states.put(device)
+        return jsonify(scheduler.device_states.overlay(device.to_dict()))
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'Erreur lors de la mise à jour: {str(e)}'}), 500
@@ -130,8 +328,12 @@ def delete_device(device_id):
     device = Device.query.get_or_404(device_id)
     
     try:
+        # Agrégats et blocs supprimés en une requête par table (pas de relation ORM à charger)
+        for model in ROLLUP_MODELS + (MetricChunk,):
+            model.query.filter_by(device_id=device.id).delete(synchronize_session=False)
         db.session.delete(device)
         db.session.commit()
+        scheduler.device_states.forget(device_id)
         return jsonify({'message': 'Appareil supprimé avec succès'})
     except Exception as e:
         db.session.rollback()
@@ -143,33 +345,91 @@ def test_device(device_id):
     device = Device.query.get_or_404(device_id)
     
     try:
-        snmp_service = SNMPService()
-        result = snmp_service.test_device_connectivity(device)
+        result = get_snmp_service().test_device_connectivity(device)
+        # Le test a écrit en base le statut constaté, en ligne comme hors ligne
+        scheduler.device_states.put(device, probed=True)
         return jsonify(result)
     except Exception as e:
         return jsonify({'error': f'Erreur lors du test: {str(e)}'}), 500
 
+@device_bp.route('/api/monitoring/status')
+def monitoring_status():
+    """API pour consulter l'état et la télémétrie du planificateur de collecte"""
+    return jsonify(scheduler.get_scheduler_status())
+
+def _metric_args():
+    """Paramètres de GET /api/devices/<id>/metrics : (paramètres, None) ou (None, message d'erreur)"""
+    max_points = request.args.get('max_points', type=int)
+    if max_points is not None and max_points <= 0:
+        return None, 'max_points doit être un entier positif'
+    export_format = request.args.get('format', 'json')
+    if export_format != 'json' and export_format not in EXPORT_FORMATS:
+        return None, f"Format inconnu: {export_format} (attendu: json, {', '.join(EXPORT_FORMATS)})"
+    limit = request.args.get('limit', type=int)
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        return None, f'limit doit être compris entre 1 et {MAX_PAGE_SIZE}'
+    cursor = request.args.get('cursor')
+    if max_points is not None and (limit is not None or cursor is not None or export_format != 'json'):
+        return None, 'max_points ne se combine ni avec la pagination ni avec l\'export'
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return None, str(e)
+    return {
+        'hours': request.args.get('hours', 24, type=int), 'type': request.args.get('type'), 'max_points': max_points,
+        'format': export_format, 'limit': limit, 'cursor': cursor, 'after': after
+    }, None
+
 @device_bp.route('/api/devices/<int:device_id>/metrics')
 def get_device_metrics(device_id):
-    """API pour récupérer les métriques d'un appareil"""
+    """API pour récupérer les métriques d'un appareil
+    
+    Avec `max_points`, la réponse passe aux agrégats 1 min, 5 min ou 1 h
+    (moyenne, min, max, nombre) lorsque les échantillons bruts dépassent le
+    budget ; la résolution retenue est indiquée par l'en-tête
+    X-Metrics-Resolution ('raw' ou secondes).
+    
+    Avec `limit` et/ou `cursor`, les échantillons bruts sont paginés par clé
+    (horodatage, id) : l'en-tête X-Next-Cursor donne le curseur de la page
+    suivante. `format=ndjson` ou `format=csv` exporte toute la fenêtre en
+    flux (curseur côté serveur, mémoire constante), `cursor` permettant de
+    reprendre un export interrompu.
+    """
     device = Device.query.get_or_404(device_id)
     
-    # Paramètres de requête
-    hours = request.args.get('hours', 24, type=int)
-    metric_type = request.args.get('type')
+    args, error = _metric_args()
+    if error:
+        return jsonify({'error': error}), 400
+    hours, metric_type, max_points = args['hours'], args['type'], args['max_points']
+    export_format, limit, after = args['format'], args['limit'], args['after']
+    paginated = limit is not None or args['cursor'] is not None
     
     # Calculer la date de début
     start_time = datetime.utcnow() - timedelta(hours=hours)
     
-    # Construire la requête
-    query = DeviceMetric.query.filter(
-        DeviceMetric.device_id == device_id,
-        DeviceMetric.timestamp >= start_time
-    )
-    
-    if metric_type:
-        query = query.filter(DeviceMetric.metric_type == metric_type)
+    if export_format != 'json' or paginated:
+        page_size = limit or DEFAULT_PAGE_SIZE
+        try:
+            # Une page : un point de plus pour savoir s'il en reste
+            points = iter_device_metrics(device.id, start_time, metric_type, after=after,
+                                         limit=limit if export_format != 'json' else page_size + 1)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if export_format != 'json':
+            response = Response(stream_with_context(stream_export(points, export_format)),
+                                mimetype=EXPORT_FORMATS[export_format])
+            response.headers['Content-Disposition'] = f'attachment; filename=device-{device.id}-metrics.{export_format}'
+        else:
+            page = list(islice(points, page_size + 1))
+            response = jsonify([point for _, point in page[:page_size]])
+            if len(page) > page_size:
+                response.headers['X-Next-Cursor'] = encode_cursor(page[page_size - 1][0])
+        response.headers['X-Metrics-Resolution'] = 'raw'
+        return response
     
-    metrics = query.order_by(DeviceMetric.timestamp.desc()).all()
+    metrics, resolution = query_device_metrics(device.id, start_time, metric_type, max_points)
     
-    return jsonify([metric.to_dict() for metric in metrics])
\ No newline at end of file
+    response = jsonify(metrics)
+    response.headers['X-Metrics-Resolution'] = str(resolution) if resolution else 'raw'
+    return response
@@ -0,0 +1,292 @@
+from datetime import datetime, timedelta
+from sqlalchemy.orm.attributes import set_committed_value
+import heapq
+import threading
+import time
+
+# Colonnes de l'état courant d'un appareil mises à jour à chaque sonde
+DEVICE_STATE_COLUMNS = ('status', 'cpu_usage', 'memory_usage', 'uptime', 'last_seen', 'updated_at')
+# Champs descriptifs de Device.to_dict(), lus avec l'état lors de sync()
+DEVICE_FIELDS = ('id', 'name', 'ip_address', 'device_type', 'created_at')
+
+
+def _serialize(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _device_data(device):
+    """to_dict() d'un appareil ORM ou d'une ligne exposant DEVICE_FIELDS et les colonnes d'état"""
+    if hasattr(device, 'to_dict'):
+        return device.to_dict()
+    return {field: _serialize(getattr(device, field)) for field in DEVICE_FIELDS + DEVICE_STATE_COLUMNS}
+
+
+class DeviceStateStore:
+    """État courant des appareils sondés par ce processus, tenu en mémoire
+
+    Chaque sonde y dépose l'état de son appareil ; les lectures (API,
+    Socket.IO) le prennent ici plutôt que dans la table devices. Seules les
+    colonnes modifiées depuis la dernière écriture sont persistées, par lots :
+
+    - changement de statut, nouvel appareil ou redémarrage (uptime en
+      baisse) : à la prochaine écriture du MetricWriter ;
+    - sinon au plus toutes les `flush_interval` secondes, et seulement si CPU
+      ou mémoire ont bougé de plus de `tolerance` points ou si last_seen en
+      base date de plus de `max_staleness` secondes.
+
+    Deux compteurs servent aux validations HTTP (ETag) : `version` change à
+    chaque modification de l'état servi, `status_version` seulement lorsque
+    la liste des appareils, leurs champs descriptifs ou un statut changent.
+    """
+
+    def __init__(self, flush_interval=60, tolerance=1.0, max_staleness=300):
+        self.flush_interval = flush_interval
+        self.tolerance = tolerance
+        self.max_staleness = max_staleness
+        self._lock = threading.Lock()
+        self._devices = {}  # device_id -> to_dict() avec l'état courant
+        self._states = {}  # device_id -> {colonne: valeur} courant
+        self._persisted = {}  # device_id -> {colonne: valeur} en base
+        self._dirty = set()
+        self._urgent = set()
+        self._released = set()  # appareils cédés à un autre processus, à écrire puis oublier
+        self._last_flush = time.monotonic()
+        # Vrai dès que ce processus sonde (sync), et lorsqu'il sonde tout le parc
+        self.active = False
+        self.complete = False
+        self.version = 0
+        self.status_version = 0
+
+    def configure(self, flush_interval=None, tolerance=None, max_staleness=None):
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if tolerance is not None:
+            self.tolerance = tolerance
+        if max_staleness is not None:
+            self.max_staleness = max_staleness
+
+    def sync(self, devices, complete=False):
+        """Aligne le magasin sur les appareils sondés par ce processus
+
+        `devices` : appareils (ORM) ou lignes exposant DEVICE_FIELDS et les
+        colonnes d'état. Les nouveaux sont amorcés depuis la base, les autres
+        sont écrits une dernière fois puis oubliés. Les champs descriptifs
+        servis par snapshot() et get() sont repris de la base à chaque appel.
+        """
+        seen = set()
+        with self._lock:
+            changed = complete != self.complete
+            for device in devices:
+                seen.add(device.id)
+                self._released.discard(device.id)
+                if device.id not in self._persisted:
+                    state = {column: getattr(device, column) for column in DEVICE_STATE_COLUMNS}
+                    self._persisted[device.id] = state
+                    self._states.setdefault(device.id, dict(state))
+                    changed = True
+                data = _device_data(device)
+                data.update({column: _serialize(value) for column, value in self._states[device.id].items()})
+                if self._devices.get(device.id) != data:
+                    self._devices[device.id] = data
+                    changed = True
+            for device_id in set(self._states) - seen:
+                if device_id in self._dirty:
+                    self._released.add(device_id)
+                else:
+                    self._drop(device_id)
+                changed = True
+            self.active = True
+            self.complete = complete
+            if changed:
+                self._bump(status=True)
+
+    def put(self, device, probed=False):
+        """Appareil écrit en base par l'API (création, modification, test de connectivité)
+
+        Sa ligne fait foi pour l'état en base et pour les champs descriptifs ;
+        l'état en mémoire est conservé, hormis le statut après un test de
+        connectivité (`probed`), ainsi que dernière vue et mise à jour si le
+        test les a avancées. Sans effet tant que ce processus ne sonde pas.
+        """
+        if not self.active:
+            return
+        data = device.to_dict()
+        persisted = {column: getattr(device, column) for column in DEVICE_STATE_COLUMNS}
+        with self._lock:
+            state = dict(self._states.get(device.id) or persisted)
+            if probed:
+                state['status'] = persisted['status']
+                # Un test en échec n'avance pas last_seen : la valeur en mémoire peut être plus récente
+                for column in ('last_seen', 'updated_at'):
+                    if persisted[column] is not None and (state[column] is None or persisted[column] > state[column]):
+                        state[column] = persisted[column]
+            self._states[device.id] = state
+            self._persisted[device.id] = persisted
+            data.update({column: _serialize(value) for column, value in state.items()})
+            self._devices[device.id] = data
+            self._bump(status=True)
+            if state == persisted:
+                self._dirty.discard(device.id)
+                self._urgent.discard(device.id)
+            else:
+                self._dirty.add(device.id)
+                if state['status'] != persisted['status']:
+                    self._urgent.add(device.id)
+
+    def record(self, device):
+        """Dépose l'état d'un appareil après une sonde"""
+        data = device.to_dict()
+        state = {column: getattr(device, column) for column in DEVICE_STATE_COLUMNS}
+        with self._lock:
+            persisted = self._persisted.get(device.id)
+            previous = self._states.get(device.id)
+            self._devices[device.id] = data
+            self._states[device.id] = state
+            if state != previous:
+                self._bump(status=previous is None or state['status'] != previous['status'])
+            if persisted is None or state['status'] != persisted['status'] or \
+                    (state['uptime'] or 0) < (persisted['uptime'] or 0):
+                self._urgent.add(device.id)
+                self._dirty.add(device.id)
+            elif state != persisted:
+                self._dirty.add(device.id)
+
+    def apply(self, device):
+        """Recopie l'état en mémoire sur un appareil chargé de la base (avant une sonde)
+
+        Les valeurs sont posées comme déjà en base : la session ne les
+        considère pas comme modifiées et ne les écrit jamais d'elle-même.
+        """
+        state = self._states.get(device.id)
+        if state:
+            for column, value in state.items():
+                set_committed_value(device, column, value)
+
+    def forget(self, device_id):
+        with self._lock:
+            if device_id in self._states:
+                self._bump(status=True)
+            self._drop(device_id)
+
+    def _bump(self, status=False):
+        self.version += 1
+        if status:
+            self.status_version += 1
+
+    def _drop(self, device_id):
+        for mapping in (self._devices, self._states, self._persisted):
+            mapping.pop(device_id, None)
+        for ids in (self._dirty, self._urgent, self._released):
+            ids.discard(device_id)
+
+    def get(self, device_id):
+        data = self._devices.get(device_id)
+        return dict(data) if data is not None else None
+
+    def status(self, device_id, default=None):
+        state = self._states.get(device_id)
+        return state['status'] if state else default
+
+    def state(self, device_id):
+        """Colonnes d'état courantes (valeurs non sérialisées) ou None"""
+        state = self._states.get(device_id)
+        return dict(state) if state is not None else None
+
+    def status_changes(self):
+        """Statuts pas encore écrits en base : [(device_id, device_type ou None, statut en base, statut courant)]"""
+        changes = []
+        with self._lock:
+            for device_id, state in self._states.items():
+                persisted = self._persisted.get(device_id)
+                if persisted is not None and persisted['status'] != state['status']:
+                    device_type = (self._devices.get(device_id) or {}).get('device_type')
+                    changes.append((device_id, device_type, persisted['status'], state['status']))
+        return changes
+
+    def top(self, column, limit):
+        """Les `limit` plus fortes valeurs de `column` : [(valeur, device_id)]"""
+        with self._lock:
+            return heapq.nlargest(limit, (
+                (state[column], device_id) for device_id, state in self._states.items() if state[column] is not None
+            ))
+
+    def snapshot(self):
+        with self._lock:
+            return [dict(data) for data in self._devices.values()]
+
+    def overlay(self, data):
+        """Remplace les champs d'état d'un to_dict() lu en base par l'état en mémoire"""
+        state = self._states.get(data.get('id'))
+        if state:
+            data.update({column: _serialize(value) for column, value in state.items()})
+        return data
+
+    @property
+    def flush_due(self):
+        return time.monotonic() - self._last_flush >= self.flush_interval
+
+    def has_pending(self):
+        return bool(self._urgent or self._released or (self._dirty and self.flush_due))
+
+    def pending_updates(self, now=None):
+        """Colonnes à écrire : [(device_id, {colonne: valeur})], urgentes seulement hors échéance
+
+        Retourne (mises à jour, écriture périodique) ; à confirmer par
+        mark_persisted() une fois la transaction validée.
+        """
+        now = now or datetime.utcnow()
+        periodic = self.flush_due
+        updates = []
+        with self._lock:
+            candidates = (self._dirty | self._released if periodic else self._urgent | self._released) & set(self._states)
+            for device_id in candidates:
+                state = self._states[device_id]
+                persisted = self._persisted.get(device_id)
+                if persisted is None:
+                    updates.append((device_id, dict(state)))
+                    continue
+                if device_id not in self._urgent and device_id not in self._released and \
+                        not self._significant(state, persisted, now):
+                    continue
+                changed = {column: value for column, value in state.items() if persisted.get(column) != value}
+                if changed:
+                    updates.append((device_id, changed))
+                elif device_id in self._released:
+                    self._drop(device_id)
+                else:
+                    # Revenu à l'état écrit en base : plus rien à persister
+                    self._urgent.discard(device_id)
+                    self._dirty.discard(device_id)
+        return updates, periodic
+
+    def _significant(self, state, persisted, now):
+        for column in ('cpu_usage', 'memory_usage'):
+            if abs((state[column] or 0) - (persisted[column] or 0)) > self.tolerance:
+                return True
+        last_seen = persisted['last_seen']
+        return last_seen is None or now - last_seen >= timedelta(seconds=self.max_staleness)
+
+    def mark_persisted(self, updates, periodic=False):
+        """Enregistre les colonnes écrites en base"""
+        with self._lock:
+            for device_id, values in updates:
+                persisted = self._persisted.setdefault(device_id, {})
+                persisted.update(values)
+                self._urgent.discard(device_id)
+                if self._states.get(device_id) == persisted:
+                    self._dirty.discard(device_id)
+                if device_id in self._released:
+                    self._drop(device_id)
+            if periodic:
+                self._last_flush = time.monotonic()
+
+    def get_status(self):
+        return {
+            'devices': len(self._states),
+            'dirty': len(self._dirty),
+            'urgent': len(self._urgent),
+            'active': self.active,
+            'complete': self.complete,
+            'version': self.version,
+            'flush_interval': self.flush_interval
+        }
@@ -0,0 +1,95 @@
+from app.models.device import Device, db
+from sqlalchemy import func
+
+# Statuts comptés dans les statistiques générales
+STATUSES = ('online', 'offline', 'warning')
+# Colonnes des classements CPU / mémoire
+TOP_COLUMNS = (Device.id, Device.name, Device.ip_address, Device.device_type, Device.cpu_usage, Device.memory_usage)
+
+
+def status_breakdown(device_states=None):
+    """Nombre d'appareils par (device_type, statut) : {(device_type, statut): nombre}
+
+    Un GROUP BY sur devices, corrigé des statuts tenus en mémoire par
+    `device_states` (DeviceStateStore) et pas encore écrits en base.
+    """
+    counts = {
+        (device_type, status): count
+        for device_type, status, count in db.session.execute(
+            db.select(Device.device_type, Device.status, func.count(Device.id))
+            .group_by(Device.device_type, Device.status)
+        )
+    }
+    changes = device_states.status_changes() if device_states is not None else []
+    if changes:
+        # Appareils sondés mais jamais sérialisés en mémoire : type lu en base
+        unknown = [device_id for device_id, device_type, _, _ in changes if device_type is None]
+        types = dict(db.session.execute(
+            db.select(Device.id, Device.device_type).where(Device.id.in_(unknown))
+        ).all()) if unknown else {}
+        for device_id, device_type, persisted, current in changes:
+            device_type = device_type if device_type is not None else types.get(device_id)
+            if counts.get((device_type, persisted)):
+                counts[(device_type, persisted)] -= 1
+                counts[(device_type, current)] = counts.get((device_type, current), 0) + 1
+    return {key: count for key, count in counts.items() if count}
+
+
+def status_counts(device_states=None, breakdown=None):
+    """Statistiques générales : {'total', 'online', 'offline', 'warning'}"""
+    breakdown = status_breakdown(device_states) if breakdown is None else breakdown
+    stats = dict({'total': sum(breakdown.values())}, **dict.fromkeys(STATUSES, 0))
+    for (_, status), count in breakdown.items():
+        if status in STATUSES:
+            stats[status] += count
+    return stats
+
+
+def top_devices(column, limit=5, device_states=None):
+    """Les `limit` appareils aux plus fortes valeurs de `column` ('cpu_usage' ou 'memory_usage')
+
+    Candidats : le classement en base (ORDER BY ... LIMIT) et celui de
+    l'état en mémoire, dont les valeurs, plus récentes, l'emportent.
+    """
+    rows = {
+        row.id: dict(row._mapping)
+        for row in db.session.execute(
+            db.select(*TOP_COLUMNS).where(getattr(Device, column).isnot(None))
+            .order_by(getattr(Device, column).desc()).limit(limit)
+        )
+    }
+    if device_states is not None:
+        missing = [device_id for _, device_id in device_states.top(column, limit) if device_id not in rows]
+        if missing:
+            rows.update(
+                (row.id, dict(row._mapping))
+                for row in db.session.execute(db.select(*TOP_COLUMNS).where(Device.id.in_(missing)))
+            )
+        for device_id, data in rows.items():
+            state = device_states.state(device_id)
+            if state:
+                data.update(cpu_usage=state['cpu_usage'], memory_usage=state['memory_usage'])
+    ranked = [data for data in rows.values() if data[column] is not None]
+    return sorted(ranked, key=lambda data: (-data[column], data['id']))[:limit]
+
+
+def fleet_stats(device_states=None, top=5):
+    """Statistiques du parc : statuts, répartition par type et appareils les plus chargés
+
+    Quelques requêtes d'agrégat et de classement, sans charger le parc en
+    objets ORM ; partagées par le tableau de bord, le rapport quotidien et
+    les statistiques diffusées en temps réel.
+    """
+    breakdown = status_breakdown(device_states)
+    by_type = {}
+    for (device_type, status), count in sorted(breakdown.items(), key=lambda item: str(item[0])):
+        entry = by_type.setdefault(device_type, dict(dict.fromkeys(STATUSES, 0), total=0))
+        entry['total'] += count
+        if status in STATUSES:
+            entry[status] += count
+    return dict(
+        status_counts(breakdown=breakdown),
+        by_type=by_type,
+        top_cpu=top_devices('cpu_usage', top, device_states),
+        top_memory=top_devices('memory_usage', top, device_states)
+    )
@@ -0,0 +1,168 @@
+import os
+import select
+import socket
+import struct
+import time
+import errno
+import logging
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+class ICMPPinger:
+    """Moteur ICMP in-process pour tester la joignabilité de nombreux hôtes
+
+    Utilise un socket ICMP datagramme non privilégié (net.ipv4.ping_group_range)
+    ou, à défaut, un socket brut. Toutes les requêtes echo d'un lot partent du
+    même socket et les réponses sont associées par (adresse, séquence) et, en
+    mode brut, par l'identifiant du lot.
+    """
+
+    def __init__(self, payload_size=32):
+        self.logger = logging.getLogger(__name__)
+        self.payload_size = payload_size
+        self.socket_type = self._detect_socket_type()
+        self._next_identifier = os.getpid() & 0xFFFF
+
+    @property
+    def available(self):
+        """Indique si un socket ICMP peut être ouvert par ce processus"""
+        return self.socket_type is not None
+
+    def _detect_socket_type(self):
+        """Détermine le type de socket ICMP autorisé (datagramme, brut ou aucun)"""
+        for socket_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                sock = socket.socket(socket.AF_INET, socket_type, socket.IPPROTO_ICMP)
+                sock.close()
+                return socket_type
+            except (OSError, AttributeError):
+                continue
+        self.logger.info("Sockets ICMP non autorisés, utilisation de la commande ping")
+        return None
+
+    def _allocate_identifier(self):
+        self._next_identifier = (self._next_identifier + 1) & 0xFFFF
+        return self._next_identifier
+
+    @staticmethod
+    def _checksum(data):
+        if len(data) % 2:
+            data += b'\x00'
+        total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+        total = (total >> 16) + (total & 0xFFFF)
+        total += total >> 16
+        return ~total & 0xFFFF
+
+    def _build_packet(self, identifier, sequence):
+        payload = b'\x00' * self.payload_size
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+        checksum = self._checksum(header + payload)
+        return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, identifier, sequence) + payload
+
+    def _parse_reply(self, data):
+        """Retourne (identifiant, séquence) d'une réponse echo, ou None"""
+        if self.socket_type == socket.SOCK_RAW:
+            # Le socket brut reçoit l'en-tête IP
+            header_length = (data[0] & 0x0F) * 4
+            data = data[header_length:]
+        if len(data) < 8:
+            return None
+        icmp_type, code, checksum, identifier, sequence = struct.unpack('!BBHHH', data[:8])
+        if icmp_type != ICMP_ECHO_REPLY:
+            return None
+        return identifier, sequence
+
+    def ping_many(self, hosts, timeout=3, count=1):
+        """Envoie `count` requêtes echo à chaque hôte depuis un seul socket
+
+        Retourne {hôte: {'alive': bool, 'rtt': ms moyen ou None, 'loss': 0.0-1.0}}.
+        Les hôtes non IPv4 ou non résolus valent None (à tester autrement).
+        """
+        results = dict((host, None) for host in hosts)
+        if not self.available or not hosts:
+            return results
+
+        addresses = self._resolve(hosts)
+        sock = socket.socket(socket.AF_INET, self.socket_type, socket.IPPROTO_ICMP)
+        sock.setblocking(False)
+        identifier = self._allocate_identifier()
+        # (adresse, séquence) -> instant d'envoi
+        outstanding = {}
+        rtts = dict((address, []) for address in addresses)
+
+        try:
+            deadline = time.monotonic() + timeout
+            sequence = 0
+            for attempt in range(count):
+                for address in addresses:
+                    sequence = (sequence + 1) & 0xFFFF
+                    if self._send(sock, address, identifier, sequence):
+                        outstanding[(address, sequence)] = time.monotonic()
+                    self._receive(sock, identifier, outstanding, rtts, 0)
+
+            while outstanding:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._receive(sock, identifier, outstanding, rtts, remaining)
+        finally:
+            sock.close()
+
+        for address, host in addresses.items():
+            replies = rtts[address]
+            results[host] = {
+                'alive': bool(replies),
+                'rtt': round(sum(replies) / len(replies), 3) if replies else None,
+                'loss': 1.0 - len(replies) / float(count)
+            }
+        return results
+
+    def _resolve(self, hosts):
+        """{adresse IPv4: hôte} des hôtes résolus"""
+        addresses = {}
+        for host in hosts:
+            try:
+                addresses[socket.gethostbyname(host)] = host
+            except (OSError, UnicodeError):
+                continue
+        return addresses
+
+    def _send(self, sock, address, identifier, sequence):
+        packet = self._build_packet(identifier, sequence)
+        for _ in range(3):
+            try:
+                sock.sendto(packet, (address, 0))
+                return True
+            except (BlockingIOError, InterruptedError):
+                select.select([], [sock], [], 0.01)
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    time.sleep(0.001)
+                    continue
+                # Hôte injoignable, adresse de diffusion, etc.
+                return False
+        return False
+
+    def _receive(self, sock, identifier, outstanding, rtts, wait):
+        """Lit les réponses disponibles (attend au plus `wait` secondes la première)"""
+        readable, _, _ = select.select([sock], [], [], wait)
+        while readable:
+            try:
+                data, (address, _) = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+
+            reply = self._parse_reply(data)
+            if reply is None:
+                continue
+            reply_identifier, sequence = reply
+            # En mode datagramme, le noyau impose son propre identifiant
+            if self.socket_type == socket.SOCK_RAW and reply_identifier != identifier:
+                continue
+            sent_at = outstanding.pop((address, sequence), None)
+            if sent_at is not None:
+                rtts[address].append((time.monotonic() - sent_at) * 1000)
@@ -0,0 +1,243 @@
+from app.models.chunk import MetricChunk
+from app.models.device import DeviceMetric, db
+from app.models.rollup import EPOCH, apply_rollups, bucket_start
+from app.services.timeseries_codec import SeriesEncoder, decode_series
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+from flask import current_app, has_app_context
+from operator import itemgetter
+from sqlalchemy import bindparam, func
+import numpy as np
+import threading
+
+# Moteurs de stockage des échantillons bruts (METRIC_STORAGE)
+STORAGE_ENGINES = ('rows', 'chunks')
+
+_MILLISECOND = timedelta(milliseconds=1)
+
+# Encodeur du bloc ouvert de chaque série : (appareil, métrique) -> (fenêtre, encodeur, octets écrits)
+_open_chunks = {}
+_open_chunks_lock = threading.Lock()
+
+
+def to_millis(timestamp):
+    return (timestamp - EPOCH) // _MILLISECOND
+
+
+def from_millis(millis):
+    return EPOCH + timedelta(milliseconds=int(millis))
+
+
+def storage_settings():
+    """(moteur, fenêtre des blocs en secondes) selon la configuration de l'application"""
+    config = current_app.config if has_app_context() else {}
+    engine = config.get('METRIC_STORAGE', 'rows')
+    return (engine if engine in STORAGE_ENGINES else 'rows'), config.get('METRIC_CHUNK_WINDOW', 7200)
+
+
+def uses_chunks():
+    return storage_settings()[0] == 'chunks'
+
+
+def write_samples(samples, executor=None):
+    """Écrit des échantillons bruts puis met à jour les agrégats
+
+    Selon METRIC_STORAGE : une ligne device_metrics par échantillon ('rows')
+    ou ajout aux blocs compressés de chaque série ('chunks'). Le tout dans la
+    transaction de l'appelant (`executor` : session ou connexion).
+    """
+    if not samples:
+        return
+    executor = executor if executor is not None else db.session
+    engine, window = storage_settings()
+    if engine == 'chunks':
+        append_to_chunks(samples, window, executor)
+    else:
+        executor.execute(DeviceMetric.__table__.insert(), samples)
+    apply_rollups(samples, executor)
+
+
+def append_to_chunks(samples, window=7200, executor=None):
+    """Ajoute des échantillons aux blocs de leurs séries
+
+    Les échantillons sont regroupés par (appareil, métrique, fenêtre de
+    `window` secondes). Un bloc existant est prolongé par l'encodeur gardé en
+    mémoire depuis sa dernière écriture, si la base contient toujours les
+    octets qu'il a produits et que les nouveaux points sont plus récents ;
+    sinon (autre processus, transaction annulée, point en retard) il est
+    décodé et réencodé. Mises à jour et insertions sont groupées (executemany).
+    """
+    executor = executor if executor is not None else db.session
+    if not samples:
+        return
+    table = MetricChunk.__table__
+
+    series = {}
+    for sample in samples:
+        key = (sample['device_id'], sample['metric_type'], bucket_start(sample['timestamp'], window))
+        entry = series.setdefault(key, {'unit': sample.get('unit'), 'points': []})
+        entry['points'].append((to_millis(sample['timestamp']), float(sample['value'])))
+
+    windows = [key[2] for key in series]
+    existing = {
+        (row.device_id, row.metric_type, row.window_start): row.data
+        for row in executor.execute(
+            db.select(table.c.device_id, table.c.metric_type, table.c.window_start, table.c.data).where(
+                table.c.device_id.in_({key[0] for key in series}),
+                table.c.metric_type.in_({key[1] for key in series}),
+                table.c.window_start.between(min(windows), max(windows))
+            )
+        )
+    }
+
+    updates, inserts = [], []
+    for key, entry in series.items():
+        points = sorted(entry['points'], key=itemgetter(0))
+        data = existing.get(key)
+        encoder = _chunk_encoder(key, data, points[0][0])
+        if encoder is None:
+            encoder = SeriesEncoder()
+            if data is not None:
+                stored = list(zip(*decode_series(data)))
+                if stored and points[0][0] < stored[-1][0]:
+                    points = sorted(stored + points, key=itemgetter(0))
+                else:
+                    points = stored + points
+        encoder.extend([point[0] for point in points], [point[1] for point in points])
+        row = {
+            'count': encoder.count,
+            'start_time': from_millis(encoder.first_timestamp),
+            'end_time': from_millis(encoder.last_timestamp),
+            'data': encoder.getvalue()
+        }
+        _remember_chunk_encoder(key, encoder, row['data'])
+        if data is not None:
+            updates.append(dict(
+                {f'b_{column}': value for column, value in row.items()},
+                b_device_id=key[0], b_metric_type=key[1], b_window_start=key[2]
+            ))
+        else:
+            inserts.append(dict(row, device_id=key[0], metric_type=key[1], window_start=key[2], unit=entry['unit']))
+
+    if updates:
+        executor.execute(
+            table.update()
+            .where(
+                table.c.device_id == bindparam('b_device_id'),
+                table.c.metric_type == bindparam('b_metric_type'),
+                table.c.window_start == bindparam('b_window_start')
+            )
+            .values({column: bindparam(f'b_{column}') for column in ('count', 'start_time', 'end_time', 'data')}),
+            updates
+        )
+    if inserts:
+        executor.execute(table.insert(), inserts)
+
+
+def _chunk_encoder(key, data, first_timestamp):
+    """Encodeur en mémoire du bloc `key` s'il a produit `data` et peut être prolongé dès `first_timestamp`
+
+    L'encodeur est retiré du cache : un seul appelant le prolonge à la fois.
+    """
+    if data is None:
+        return None
+    with _open_chunks_lock:
+        cached = _open_chunks.get(key[:2])
+        if cached is None or cached[0] != key[2] or cached[2] != data or first_timestamp < cached[1].last_timestamp:
+            return None
+        del _open_chunks[key[:2]]
+    return cached[1]
+
+
+def _remember_chunk_encoder(key, encoder, data):
+    """Garde l'encodeur du dernier bloc écrit de la série"""
+    with _open_chunks_lock:
+        _open_chunks[key[:2]] = (key[2], encoder, data)
+
+
+def _chunk_filters(device_id, start_time, end_time=None, metric_type=None):
+    table = MetricChunk.__table__
+    filters = [table.c.device_id == device_id, table.c.end_time >= start_time]
+    if end_time is not None:
+        filters.append(table.c.start_time <= end_time)
+    if metric_type:
+        filters.append(table.c.metric_type == metric_type)
+    return filters
+
+
+def count_chunk_points(device_id, start_time, end_time=None, metric_type=None):
+    """Majorant du nombre de points (blocs entiers) sur la fenêtre, sans décodage"""
+    table = MetricChunk.__table__
+    return db.session.execute(
+        db.select(func.coalesce(func.sum(table.c.count), 0))
+        .where(*_chunk_filters(device_id, start_time, end_time, metric_type))
+    ).scalar()
+
+
+def read_series(device_id, start_time, end_time=None, metric_type=None):
+    """Séries d'un appareil sur [start_time, end_time] lues dans les blocs
+
+    Retourne {metric_type: (unité, horodatages en ms, valeurs)}, triés par
+    horodatage, en tableaux NumPy (int64, float64).
+    """
+    table = MetricChunk.__table__
+    rows = db.session.execute(
+        db.select(table.c.metric_type, table.c.unit, table.c.start_time, table.c.end_time, table.c.data)
+        .where(*_chunk_filters(device_id, start_time, end_time, metric_type))
+        .order_by(table.c.metric_type, table.c.window_start)
+    )
+
+    start_ms = to_millis(start_time)
+    end_ms = to_millis(end_time) if end_time is not None else None
+    result = {}
+    for row in rows:
+        timestamps, values = decode_series(row.data)
+        # Seuls les blocs aux bords de la fenêtre sont découpés
+        low = bisect_left(timestamps, start_ms) if row.start_time < start_time else 0
+        high = bisect_right(timestamps, end_ms) if end_ms is not None and row.end_time > end_time else len(timestamps)
+        entry = result.setdefault(row.metric_type, (row.unit, [], []))
+        entry[1].extend(timestamps[low:high])
+        entry[2].extend(values[low:high])
+
+    return {
+        metric: (unit, np.array(timestamps, dtype=np.int64), np.array(values, dtype=np.float64))
+        for metric, (unit, timestamps, values) in result.items()
+    }
+
+
+def stream_points(device_id, start_time, end_time=None, metric_type=None, batch_size=100):
+    """Points d'un appareil sur [start_time, end_time] lus dans les blocs, en flux
+
+    Génère des tuples (horodatage en ms, métrique, unité, valeur) du plus
+    récent au plus ancien (horodatage puis métrique décroissants). Les blocs
+    sont lus par un curseur côté serveur, du dernier point le plus récent au
+    plus ancien ; un point n'est émis qu'une fois qu'aucun bloc restant ne
+    peut en contenir de plus récent : la mémoire reste bornée à quelques
+    fenêtres.
+    """
+    table = MetricChunk.__table__
+    rows = db.session.execute(
+        db.select(table.c.metric_type, table.c.unit, table.c.end_time, table.c.data)
+        .where(*_chunk_filters(device_id, start_time, end_time, metric_type))
+        .order_by(table.c.end_time.desc())
+        .execution_options(yield_per=batch_size)
+    )
+
+    start_ms = to_millis(start_time)
+    end_ms = to_millis(end_time) if end_time is not None else None
+    newest_first = itemgetter(0, 1)
+    pending = []
+    for row in rows:
+        # Les blocs suivants s'arrêtent au plus à row.end_time
+        horizon = to_millis(row.end_time)
+        ready = [point for point in pending if point[0] > horizon]
+        if ready:
+            pending = [point for point in pending if point[0] <= horizon]
+            yield from sorted(ready, key=newest_first, reverse=True)
+        timestamps, values = decode_series(row.data)
+        pending.extend(
+            (timestamp, row.metric_type, row.unit, value)
+            for timestamp, value in zip(timestamps, values)
+            if timestamp >= start_ms and (end_ms is None or timestamp <= end_ms)
+        )
+    yield from sorted(pending, key=newest_first, reverse=True)
@@ -0,0 +1,316 @@
+from app.models.device import Device, db
+from app.models.fleet_version import bump_fleet_version
+from app.services.device_state import DeviceStateStore
+from app.services.metric_storage import write_samples
+from sqlalchemy import bindparam
+from collections import deque
+from datetime import datetime
+import logging
+import threading
+import time
+
+# Comportement de record() lorsque la file est pleine
+QUEUE_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+
+class MetricWriter:
+    """File d'écriture différée des échantillons et de l'état des appareils
+
+    Les sondes y déposent leurs métriques et le dernier état de chaque appareil
+    (tenu par `state_store`) ; flush() écrit le tout en une transaction : les
+    échantillons (INSERT groupé dans device_metrics ou blocs compressés, selon
+    METRIC_STORAGE), la mise à jour des agrégats 1 min / 5 min / 1 h et des
+    UPDATE groupés de devices limités aux colonnes modifiées que le magasin
+    d'état juge à écrire.
+
+    Une fois start() appelé, un thread d'écriture dédié vide la file dès que
+    `batch_size` échantillons sont en attente, et au plus tard `flush_interval`
+    secondes après l'écriture précédente : les sondes n'attendent plus les
+    commits. Sans ce thread, record() signale un lot plein et l'appelant
+    écrit lui-même.
+
+    La file est bornée à `max_pending` échantillons. Pleine, `policy` décide :
+    'block' fait attendre la sonde jusqu'à `block_timeout` secondes (contre-
+    pression), puis écarte ses échantillons ; 'drop_oldest' écarte les plus
+    anciens en attente ; 'drop_newest' écarte les nouveaux.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=5, max_pending=50000, policy='block', block_timeout=1.0,
+                 state_store=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.logger = logging.getLogger(__name__)
+        self._samples = deque()
+        self.state_store = state_store if state_store is not None else DeviceStateStore()
+        self._lock = threading.Lock()
+        # Réveil du thread d'écriture (lot plein, arrêt) et des sondes en attente de place
+        self._wakeup = threading.Condition(self._lock)
+        self._space = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._pending_since = None
+        self._flush_durations = deque(maxlen=200)
+        self._app = None
+        self._thread = None
+        self._stopping = False
+        self.stats = {
+            'flushes': 0, 'samples_written': 0, 'devices_updated': 0, 'dropped': 0, 'blocked': 0, 'errors': 0
+        }
+
+    def configure(self, batch_size=None, flush_interval=None, max_pending=None, policy=None, block_timeout=None):
+        if batch_size is not None:
+            self.batch_size = max(1, batch_size)
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if max_pending is not None:
+            self.max_pending = max(1, max_pending)
+        if policy is not None:
+            if policy not in QUEUE_POLICIES:
+                raise ValueError(f"Politique de file inconnue: {policy} (attendu: {', '.join(QUEUE_POLICIES)})")
+            self.policy = policy
+        if block_timeout is not None:
+            self.block_timeout = block_timeout
+
+    @property
+    def pending(self):
+        return len(self._samples)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, app):
+        """Démarre le thread d'écriture (dans le contexte de `app`)"""
+        if self.running:
+            return
+        self._app = app
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='metric-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        """Arrête le thread d'écriture après avoir vidé la file
+
+        Retourne le nombre d'échantillons restés en attente (écriture en échec
+        ou délai dépassé).
+        """
+        thread = self._thread
+        if thread is None:
+            return self.pending
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+            self._space.notify_all()
+        thread.join(timeout)
+        if thread.is_alive():
+            self.logger.warning(f"Thread d'écriture toujours actif après {timeout}s, {self.pending} échantillons en attente")
+        else:
+            self._thread = None
+        if self.pending:
+            self.logger.warning(f"{self.pending} échantillons non écrits à l'arrêt")
+        return self.pending
+
+    def record(self, device, metrics, timestamp=None):
+        """Met en attente les métriques d'une sonde et l'état courant de l'appareil
+
+        Retourne True lorsque `batch_size` échantillons sont en attente et
+        qu'aucun thread d'écriture ne tourne : à l'appelant d'appeler flush()
+        (avec un contexte applicatif).
+        """
+        timestamp = timestamp or datetime.utcnow()
+        rows = [
+            {
+                'device_id': device.id,
+                'metric_type': metric['type'],
+                'value': metric['value'],
+                'unit': metric['unit'],
+                'timestamp': timestamp
+            }
+            for metric in metrics
+        ]
+        self.state_store.record(device)
+        running = self.running
+        with self._lock:
+            if rows and len(self._samples) + len(rows) > self.max_pending:
+                rows = self._make_room(rows, running)
+            if rows and not self._samples:
+                self._pending_since = time.monotonic()
+            self._samples.extend(rows)
+            full = len(self._samples) >= self.batch_size
+            if full and running:
+                self._wakeup.notify()
+            return full and not running
+
+    def _make_room(self, rows, running):
+        """File pleine : applique la politique, retourne les lignes à ajouter (verrou tenu)"""
+        if self.policy == 'block' and running:
+            self.stats['blocked'] += 1
+            deadline = time.monotonic() + self.block_timeout
+            while len(self._samples) + len(rows) > self.max_pending and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._space.wait(remaining)
+
+        room = self.max_pending - len(self._samples)
+        if len(rows) <= room:
+            return rows
+        if self.policy == 'drop_oldest':
+            excess = min(len(self._samples), len(rows) - room)
+            for _ in range(excess):
+                self._samples.popleft()
+            self.stats['dropped'] += excess
+            room += excess
+        self.stats['dropped'] += max(0, len(rows) - room)
+        return rows[:max(0, room)]
+
+    def request_flush(self):
+        """Demande l'écriture de la file : au thread d'écriture s'il tourne, sinon ici"""
+        if self.running:
+            with self._lock:
+                self._last_flush = float('-inf')
+                self._wakeup.notify()
+            return 0
+        return self.flush()
+
+    def flush_if_due(self, now=None):
+        """Écrit le lot si l'intervalle d'écriture est écoulé (sans thread d'écriture)"""
+        if self.running:
+            return 0
+        now = time.monotonic() if now is None else now
+        if now - self._last_flush >= self.flush_interval:
+            return self.flush()
+        return 0
+
+    def _run(self):
+        """Boucle du thread d'écriture"""
+        while True:
+            with self._lock:
+                while not self._stopping:
+                    if len(self._samples) >= self.batch_size:
+                        break
+                    remaining = self._last_flush + self.flush_interval - time.monotonic()
+                    if remaining <= 0 and (self._samples or self.state_store.has_pending()):
+                        break
+                    self._wakeup.wait(remaining if remaining > 0 else self.flush_interval)
+                stopping = self._stopping
+
+            with self._app.app_context():
+                self.flush()
+                # Arrêt : vider la file, lot après lot, tant que l'écriture réussit
+                while stopping and self.pending and self.flush():
+                    pass
+            if stopping:
+                return
+
+    def flush(self):
+        """Écrit les échantillons en attente et l'état à persister en une transaction
+
+        Retourne le nombre d'échantillons écrits. Les lignes des appareils
+        supprimés entre-temps sont écartées ; en cas d'erreur, le lot est remis
+        en attente (dans la limite de `max_pending` échantillons) et l'état
+        reste à écrire.
+        """
+        with self._flush_lock:
+            with self._lock:
+                samples, self._samples = list(self._samples), deque()
+                self._last_flush = time.monotonic()
+                self._pending_since = None
+                self._space.notify_all()
+            updates, periodic = self.state_store.pending_updates()
+            if not samples and not updates:
+                if periodic:
+                    self.state_store.mark_persisted([], periodic)
+                return 0
+
+            started = time.perf_counter()
+            try:
+                existing = self._existing_device_ids(
+                    {device_id for device_id, _ in updates} | {row['device_id'] for row in samples}
+                )
+                samples = [row for row in samples if row['device_id'] in existing]
+                for device_id, _ in updates:
+                    if device_id not in existing:
+                        self.state_store.forget(device_id)
+                updates = [(device_id, values) for device_id, values in updates if device_id in existing]
+
+                write_samples(samples)
+                self._update_devices(updates)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self._requeue(samples)
+                self.stats['errors'] += 1
+                self.logger.error(f"Erreur lors de l'écriture groupée des métriques: {e}")
+                return 0
+
+            self.state_store.mark_persisted(updates, periodic)
+            self._flush_durations.append(time.perf_counter() - started)
+            self.stats['flushes'] += 1
+            self.stats['samples_written'] += len(samples)
+            self.stats['devices_updated'] += len(updates)
+            return len(samples)
+
+    def _update_devices(self, updates):
+        """Un UPDATE groupé (executemany) par ensemble de colonnes modifiées, puis les compteurs de version"""
+        if not updates:
+            return
+        bump_fleet_version(db.session, status=any('status' in values for _, values in updates))
+        table = Device.__table__
+        groups = {}
+        for device_id, values in updates:
+            groups.setdefault(tuple(sorted(values)), []).append(
+                dict({f'b_{column}': value for column, value in values.items()}, b_id=device_id)
+            )
+        for columns, params in groups.items():
+            db.session.execute(
+                table.update()
+                .where(table.c.id == bindparam('b_id'))
+                .values({column: bindparam(f'b_{column}') for column in columns}),
+                params
+            )
+
+    def _existing_device_ids(self, device_ids, chunk_size=500):
+        device_ids = list(device_ids)
+        existing = set()
+        for start in range(0, len(device_ids), chunk_size):
+            chunk = device_ids[start:start + chunk_size]
+            existing.update(row[0] for row in db.session.query(Device.id).filter(Device.id.in_(chunk)))
+        return existing
+
+    def _requeue(self, samples):
+        """Remet un lot en échec devant les nouvelles écritures"""
+        with self._lock:
+            room = max(0, self.max_pending - len(self._samples))
+            self.stats['dropped'] += max(0, len(samples) - room)
+            self._samples.extendleft(reversed(samples[:room]))
+            if self._samples and self._pending_since is None:
+                self._pending_since = time.monotonic()
+
+    def get_status(self):
+        durations = sorted(self._flush_durations)
+        pending_since = self._pending_since
+
+        def percentile(p):
+            return round(durations[min(len(durations) - 1, int(p * len(durations)))], 4) if durations else None
+
+        return dict(
+            self.stats,
+            pending=self.pending,
+            max_pending=self.max_pending,
+            policy=self.policy,
+            running=self.running,
+            oldest_pending_age=round(time.monotonic() - pending_since, 3) if pending_since is not None else None,
+            batch_size=self.batch_size,
+            flush_interval=self.flush_interval,
+            device_state=self.state_store.get_status(),
+            flush_latency={
+                'samples': len(durations),
+                'p50': percentile(0.50),
+                'p99': percentile(0.99),
+                'max': round(durations[-1], 4) if durations else None
+            }
+        )
@@ -0,0 +1,166 @@
+from app.models.device import DeviceMetric, db
+from app.models.rollup import ROLLUP_MODELS, bucket_start
+from app.services.metric_storage import count_chunk_points, from_millis, stream_points, uses_chunks
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from itertools import islice
+from operator import itemgetter
+from sqlalchemy import func, or_
+import csv
+import heapq
+import io
+import json
+
+# Formats d'export en flux des échantillons bruts
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_COLUMNS = ('timestamp', 'metric_type', 'value', 'unit', 'id')
+# Pagination de l'API JSON (points par page)
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+
+def _count_at_most(query, limit):
+    """Nombre de lignes de `query` borné à `limit` + 1 (au plus limit + 1 entrées d'index lues)"""
+    return db.session.query(func.count()).select_from(query.limit(limit + 1).subquery()).scalar()
+
+
+def encode_cursor(key):
+    """Curseur opaque d'une clé de pagination (horodatage, id ou métrique)"""
+    timestamp, tiebreak = key
+    payload = json.dumps([timestamp.isoformat(), tiebreak], separators=(',', ':')).encode()
+    return urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Clé de pagination d'un curseur ; ValueError s'il est invalide"""
+    try:
+        timestamp, tiebreak = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        key = (datetime.fromisoformat(timestamp), tiebreak)
+    except (ValueError, TypeError) as e:
+        raise ValueError('Curseur invalide') from e
+    if not isinstance(tiebreak, (int, str)) or isinstance(tiebreak, bool):
+        raise ValueError('Curseur invalide')
+    return key
+
+
+def _point(device_id, point_id, metric_type, value, unit, timestamp):
+    return {
+        'id': point_id,
+        'device_id': device_id,
+        'metric_type': metric_type,
+        'value': float(value),
+        'unit': unit,
+        'timestamp': timestamp.isoformat()
+    }
+
+
+def _stream_rows(device_id, start_time, metric_type, after, limit, tiebreak, batch_size):
+    """Lignes device_metrics par curseur côté serveur, clé (horodatage, `tiebreak`) décroissante"""
+    table = DeviceMetric.__table__
+    column = table.c[tiebreak]
+    query = db.select(table.c.id, table.c.metric_type, table.c.value, table.c.unit, table.c.timestamp).where(
+        table.c.device_id == device_id, table.c.timestamp >= start_time
+    )
+    if metric_type:
+        query = query.where(table.c.metric_type == metric_type)
+    if after is not None:
+        # Forme (t <= ? AND (t < ? OR k < ?)) : plage d'index sur timestamp
+        query = query.where(table.c.timestamp <= after[0], or_(table.c.timestamp < after[0], column < after[1]))
+    query = query.order_by(table.c.timestamp.desc(), column.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    for row in db.session.execute(query.execution_options(yield_per=batch_size)):
+        point = _point(device_id, row.id, row.metric_type, row.value, row.unit, row.timestamp)
+        yield (row.timestamp, getattr(row, tiebreak)), point
+
+
+def _stream_chunks(device_id, start_time, metric_type, after):
+    """Points des blocs compressés, clé (horodatage, métrique) décroissante"""
+    end_time = after[0] if after is not None else None
+    for timestamp_ms, metric, unit, value in stream_points(device_id, start_time, end_time, metric_type):
+        timestamp = from_millis(timestamp_ms)
+        key = (timestamp, metric)
+        if after is not None and key >= after:
+            continue
+        yield key, _point(device_id, None, metric, value, unit, timestamp)
+
+
+def iter_device_metrics(device_id, start_time, metric_type=None, after=None, limit=None, batch_size=1000):
+    """Échantillons bruts d'un appareil depuis `start_time`, du plus récent au plus ancien, en flux
+
+    Génère des couples (clé, point) sans rien accumuler : curseurs côté
+    serveur et décodage des blocs fenêtre par fenêtre, la mémoire ne dépend
+    pas de la fenêtre de temps. La clé sert à la pagination par clé (keyset) :
+    `after` reprend juste après. C'est (horodatage, id) pour les lignes
+    device_metrics ; (horodatage, métrique) avec METRIC_STORAGE=chunks, les
+    points des blocs n'ayant pas d'id (les lignes écrites avant le passage
+    aux blocs sont fusionnées selon la même clé). ValueError si `after`
+    provient de l'autre mode de stockage.
+    """
+    chunks = uses_chunks()
+    if after is not None and not isinstance(after[1], str if chunks else int):
+        raise ValueError('Curseur invalide pour ce mode de stockage')
+    if not chunks:
+        return _stream_rows(device_id, start_time, metric_type, after, limit, 'id', batch_size)
+
+    points = heapq.merge(
+        _stream_chunks(device_id, start_time, metric_type, after),
+        _stream_rows(device_id, start_time, metric_type, after, limit, 'metric_type', batch_size),
+        key=itemgetter(0), reverse=True
+    )
+    return islice(points, limit) if limit is not None else points
+
+
+def stream_export(points, export_format, batch_size=1000):
+    """Sérialise des points en NDJSON ou CSV, par morceaux de `batch_size` lignes"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n') if export_format == 'csv' else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+    lines = 0
+    for _, point in points:
+        if writer:
+            writer.writerow([point[column] for column in EXPORT_COLUMNS])
+        else:
+            buffer.write(json.dumps(point) + '\n')
+        lines += 1
+        if lines % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def query_device_metrics(device_id, start_time, metric_type=None, max_points=None):
+    """Points d'un appareil depuis `start_time`, du plus récent au plus ancien
+
+    Sans `max_points`, les échantillons bruts. Sinon, la résolution la plus
+    fine (brute, 1 min, 5 min, 1 h) qui tient dans le budget de `max_points`
+    points, l'agrégat horaire à défaut. Retourne (points, résolution en
+    secondes, None pour les échantillons bruts).
+    """
+    raw = DeviceMetric.query.filter(DeviceMetric.device_id == device_id, DeviceMetric.timestamp >= start_time)
+    if metric_type:
+        raw = raw.filter(DeviceMetric.metric_type == metric_type)
+
+    if uses_chunks():
+        within_budget = max_points is None or (
+            count_chunk_points(device_id, start_time, metric_type=metric_type)
+            + _count_at_most(raw, max_points) <= max_points
+        )
+        if within_budget:
+            return [point for _, point in iter_device_metrics(device_id, start_time, metric_type)], None
+    elif max_points is None or _count_at_most(raw, max_points) <= max_points:
+        raw = raw.order_by(DeviceMetric.timestamp.desc(), DeviceMetric.id.desc())
+        return [metric.to_dict() for metric in raw], None
+
+    for model in ROLLUP_MODELS:
+        query = model.query.filter(
+            model.device_id == device_id,
+            model.bucket >= bucket_start(start_time, model.resolution)
+        )
+        if metric_type:
+            query = query.filter(model.metric_type == metric_type)
+        if model is ROLLUP_MODELS[-1] or _count_at_most(query, max_points) <= max_points:
+            return [rollup.to_dict() for rollup in query.order_by(model.bucket.desc())], model.resolution
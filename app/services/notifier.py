@@ -162,6 +162,19 @@ class NotificationService:
         online = devices_stats.get('online', 0)
         offline = devices_stats.get('offline', 0)
         warning = devices_stats.get('warning', 0)
+        availability = f"{(online/total*100):.1f}%" if total else "n/a"
+        
+        by_type = '\n'.join(
+            f"        - {device_type or 'inconnu'}: {counts['total']} "
+            f"({counts['online']} en ligne, {counts['offline']} hors ligne, {counts['warning']} en avertissement)"
+            for device_type, counts in devices_stats.get('by_type', {}).items()
+        ) or '        - aucun appareil'
+        
+        def ranking(devices, column):
+            return '\n'.join(
+                f"        - {device['name']} ({device['ip_address']}): {device[column]:.1f}%"
+                for device in devices
+            ) or '        - aucune mesure'
         
         subject = f"Rapport quotidien - Surveillance réseau ({datetime.utcnow().strftime('%d/%m/%Y')})"
         body = f"""
@@ -175,7 +188,16 @@ class NotificationService:
         - Appareils hors ligne: {offline}
         - Appareils en avertissement: {warning}
         
-        Taux de disponibilité: {(online/total*100):.1f}% ({online}/{total})
+        Taux de disponibilité: {availability} ({online}/{total})
+        
+        PAR TYPE D'APPAREIL:
+{by_type}
+        
+        CPU LES PLUS CHARGÉS:
+{ranking(devices_stats.get('top_cpu', []), 'cpu_usage')}
+        
+        MÉMOIRE LA PLUS UTILISÉE:
+{ranking(devices_stats.get('top_memory', []), 'memory_usage')}
         
         Ce rapport a été généré automatiquement le {datetime.utcnow().strftime('%d/%m/%Y à %H:%M')}.
         
@@ -0,0 +1,291 @@
+from app.models.chunk import MetricChunk
+from app.models.device import DeviceMetric, db
+from app.models.rollup import ROLLUP_MODELS, apply_rollups, bucket_start
+from app.services.metric_storage import from_millis
+from app.services.timeseries_codec import decode_series
+from datetime import datetime, timedelta
+from functools import partial
+from sqlalchemy import not_, tuple_
+import logging
+import time
+
+# Paliers de rétention, du plus fin au plus grossier
+RETENTION_TIERS = ('raw',) + tuple(model.tier for model in ROLLUP_MODELS)
+
+
+def _is_pattern(metric_type):
+    return '*' in metric_type or '?' in metric_type
+
+
+def _like(pattern):
+    """Motif * / ? converti pour LIKE (échappement de % et _)"""
+    escaped = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.replace('*', '%').replace('?', '_')
+
+
+def _check_tiers(name, retention):
+    unknown = set(retention) - set(RETENTION_TIERS)
+    if unknown:
+        raise ValueError(
+            f"Palier de rétention inconnu pour {name}: {', '.join(sorted(unknown))} "
+            f"(attendu: {', '.join(RETENTION_TIERS)})"
+        )
+
+
+def retention_policies(raw_days, rollup_days=None, overrides=None):
+    """Politiques de rétention ordonnées : [(motif de metric_type, {palier: jours})]
+
+    La politique par défaut garde les échantillons bruts `raw_days` jours et
+    chaque résolution d'agrégat selon `rollup_days` ({'1m': 30, ...}) ;
+    `overrides` ({motif: {palier: jours}}) la précise par métrique, les
+    paliers absents étant repris du défaut ('*' remplace le défaut). Un
+    palier à None est conservé indéfiniment. Les motifs acceptent * et ? ;
+    un nom exact l'emporte sur un motif, un motif sur ceux déclarés après lui.
+    """
+    overrides = overrides or {}
+    rollup_days = rollup_days or {}
+    _check_tiers('les agrégats', rollup_days)
+    default = dict({tier: None for tier in RETENTION_TIERS}, **rollup_days)
+    default['raw'] = raw_days
+    _check_tiers('*', overrides.get('*', {}))
+    default.update(overrides.get('*', {}))
+
+    policies = []
+    for metric_type, retention in overrides.items():
+        _check_tiers(metric_type, retention)
+        if metric_type != '*':
+            policies.append((metric_type, dict(default, **retention)))
+    policies.sort(key=lambda policy: _is_pattern(policy[0]))
+    policies.append(('*', default))
+    return policies
+
+
+def _policy_filters(column, policies):
+    """Conditions SQL de chaque politique sur `column`, hors métriques des politiques prioritaires"""
+    filters, previous = [], []
+    for metric_type, _ in policies:
+        if metric_type == '*':
+            condition = None
+        elif _is_pattern(metric_type):
+            condition = column.like(_like(metric_type), escape='\\')
+        else:
+            condition = column == metric_type
+        filters.append(([condition] if condition is not None else []) + [not_(other) for other in previous])
+        if condition is not None:
+            previous.append(condition)
+    return filters
+
+
+class MetricRetention:
+    """Purge des métriques expirées par petits lots
+
+    Chaque lot sélectionne au plus `chunk_size` clés par l'index sur
+    l'horodatage (timestamp, end_time pour les blocs compressés, bucket pour
+    les agrégats), les supprime par clé primaire et valide aussitôt : aucune
+    transaction ne reste longtemps ouverte et rien n'est chargé dans l'ORM.
+    Entre deux lots, une pause de `pause` secondes laisse passer les
+    écritures de la collecte.
+
+    `policies` (voir retention_policies) fixe la durée de conservation de
+    chaque palier (brut, 1 min, 5 min, 1 h) par métrique.
+    """
+
+    def __init__(self, chunk_size=5000, pause=0.1, policies=None):
+        self.chunk_size = max(1, chunk_size)
+        self.pause = pause
+        self.policies = policies or []
+        self.logger = logging.getLogger(__name__)
+        self._compacted = 0
+
+    def purge(self, now=None, max_duration=None, max_rows=None):
+        """Applique les politiques de rétention, palier par palier
+
+        Les échantillons bruts d'abord (lignes device_metrics puis blocs
+        compressés), puis les agrégats du plus fin au plus grossier. Avant
+        suppression, les échantillons bruts absents de l'agrégat le plus
+        durable de leur politique (écrits hors du MetricWriter) y sont
+        agrégés. S'arrête après `max_duration` secondes ou `max_rows` lignes
+        supprimées : le reste sera purgé au passage suivant.
+        Retourne {'deleted', 'deleted_blocks', 'deleted_rollups', 'compacted',
+        'chunks', 'duration', 'complete'}.
+        """
+        now = now or datetime.utcnow()
+        jobs = []
+        for tier in RETENTION_TIERS:
+            models = [model for model in ROLLUP_MODELS if model.tier == tier]
+            tables = (DeviceMetric.__table__, MetricChunk.__table__) if tier == 'raw' else (models[0].__table__,)
+            filters = [_policy_filters(table.c.metric_type, self.policies) for table in tables]
+            for index, (metric_type, retention) in enumerate(self.policies):
+                if retention.get(tier) is None:
+                    continue
+                cutoff = now - timedelta(days=retention[tier])
+                if tier == 'raw':
+                    # Agrégats conservés plus longtemps que les échantillons bruts, avec leur date limite
+                    compact = [
+                        (model, None if retention.get(model.tier) is None else now - timedelta(days=retention[model.tier]))
+                        for model in ROLLUP_MODELS
+                        if retention.get(model.tier) is None or retention[model.tier] > retention['raw']
+                    ]
+                    jobs.append(('rows', partial(self._delete_rows, cutoff, filters[0][index], compact)))
+                    jobs.append(('blocks', partial(self._delete_blocks, cutoff, filters[1][index], compact)))
+                else:
+                    jobs.append((tier, partial(self._delete_rollups, models[0], cutoff, filters[0][index])))
+        return self._run(jobs, max_duration, max_rows)
+
+    def purge_before(self, cutoff, max_duration=None, max_rows=None):
+        """Supprime les échantillons bruts antérieurs à `cutoff`, toutes métriques confondues
+
+        Un bloc compressé à cheval sur la date limite est conservé jusqu'au
+        passage suivant. Mêmes budgets et même résultat que purge().
+        """
+        jobs = [
+            ('rows', partial(self._delete_rows, cutoff, [], [])),
+            ('blocks', partial(self._delete_blocks, cutoff, [], []))
+        ]
+        return self._run(jobs, max_duration, max_rows)
+
+    def _run(self, jobs, max_duration=None, max_rows=None):
+        """Exécute les suppressions par lots dans la limite des budgets"""
+        started = time.monotonic()
+        deleted = {'rows': 0, 'blocks': 0}
+        deleted.update((model.tier, 0) for model in ROLLUP_MODELS)
+        chunks = total = 0
+        complete = True
+        self._compacted = 0
+
+        for kind, delete_chunk in jobs:
+            while True:
+                limit = self.chunk_size if max_rows is None else min(self.chunk_size, max_rows - total)
+                if limit <= 0:
+                    complete = False
+                    break
+                count = delete_chunk(limit)
+                db.session.commit()
+                if not count:
+                    break
+                deleted[kind] += count
+                total += count
+                chunks += 1
+
+                if count < limit:
+                    break
+                if max_duration is not None and time.monotonic() - started >= max_duration:
+                    complete = False
+                    break
+                # Laisser la place aux écritures de la collecte
+                if self.pause:
+                    time.sleep(self.pause)
+            if not complete:
+                break
+
+        return {
+            'deleted': deleted['rows'],
+            'deleted_blocks': deleted['blocks'],
+            'deleted_rollups': {model.tier: deleted[model.tier] for model in ROLLUP_MODELS},
+            'compacted': self._compacted,
+            'chunks': chunks,
+            'duration': round(time.monotonic() - started, 3),
+            'complete': complete
+        }
+
+    def _delete_rows(self, cutoff, filters, compact, limit):
+        """Supprime au plus `limit` lignes device_metrics expirées, par clé primaire"""
+        table = DeviceMetric.__table__
+        columns = [table.c.id]
+        if compact:
+            columns += [table.c.device_id, table.c.metric_type, table.c.value, table.c.unit, table.c.timestamp]
+        rows = db.session.execute(
+            db.select(*columns).where(table.c.timestamp < cutoff, *filters).limit(limit)
+        ).mappings().all()
+        if not rows:
+            return 0
+        if compact:
+            self._compact(self._missing(rows, compact), compact)
+        ids = [row['id'] for row in rows]
+        result = db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        return result.rowcount if result.rowcount is not None and result.rowcount >= 0 else len(ids)
+
+    def _delete_blocks(self, cutoff, filters, compact, limit):
+        """Supprime au plus `limit` blocs compressés entièrement expirés"""
+        table = MetricChunk.__table__
+        key = (table.c.device_id, table.c.metric_type, table.c.window_start)
+        rows = db.session.execute(
+            db.select(*key, table.c.start_time).where(table.c.end_time < cutoff, *filters).limit(limit)
+        ).all()
+        if not rows:
+            return 0
+        if compact:
+            # Un bloc dont le premier point n'est pas agrégé est décodé et agrégé en entier
+            missing = self._missing(
+                [{'device_id': row[0], 'metric_type': row[1], 'timestamp': row[3], 'key': tuple(row[:3])}
+                 for row in rows],
+                compact
+            )
+            if missing:
+                samples = []
+                for block in db.session.execute(
+                    db.select(*key, table.c.unit, table.c.data)
+                    .where(tuple_(*key).in_([probe['key'] for probe in missing]))
+                ):
+                    timestamps, values = decode_series(block.data)
+                    samples.extend(
+                        {'device_id': block.device_id, 'metric_type': block.metric_type, 'value': value,
+                         'unit': block.unit, 'timestamp': from_millis(timestamp)}
+                        for timestamp, value in zip(timestamps, values)
+                    )
+                self._compact(samples, compact)
+        return self._delete_keys(table, key, [tuple(row[:3]) for row in rows])
+
+    def _delete_rollups(self, model, cutoff, filters, limit):
+        """Supprime au plus `limit` intervalles d'agrégat entièrement expirés"""
+        table = model.__table__
+        key = (table.c.device_id, table.c.metric_type, table.c.bucket)
+        keys = [
+            tuple(row) for row in db.session.execute(
+                db.select(*key).where(table.c.bucket < bucket_start(cutoff, model.resolution), *filters).limit(limit)
+            )
+        ]
+        return self._delete_keys(table, key, keys)
+
+    def _delete_keys(self, table, key, keys):
+        if not keys:
+            return 0
+        result = db.session.execute(table.delete().where(tuple_(*key).in_(keys)))
+        return result.rowcount if result.rowcount is not None and result.rowcount >= 0 else len(keys)
+
+    def _missing(self, samples, compact):
+        """Échantillons absents de l'agrégat le plus durable de `compact` (jamais agrégés)"""
+        model = compact[-1][0]
+        table = model.__table__
+        keys = {
+            (sample['device_id'], sample['metric_type'], bucket_start(sample['timestamp'], model.resolution))
+            for sample in samples
+        }
+        buckets = [key[2] for key in keys]
+        existing = {
+            tuple(row) for row in db.session.execute(
+                db.select(table.c.device_id, table.c.metric_type, table.c.bucket).where(
+                    table.c.device_id.in_({key[0] for key in keys}),
+                    table.c.metric_type.in_({key[1] for key in keys}),
+                    table.c.bucket.between(min(buckets), max(buckets))
+                )
+            )
+        }
+        return [
+            sample for sample in samples
+            if (sample['device_id'], sample['metric_type'],
+                bucket_start(sample['timestamp'], model.resolution)) not in existing
+        ]
+
+    def _compact(self, samples, compact):
+        """Agrège des échantillons bruts avant leur suppression, dans la transaction du lot
+
+        Chaque résolution ne reçoit que les échantillons que sa politique
+        conserve encore.
+        """
+        if not samples:
+            return
+        for model, cutoff in compact:
+            kept = samples if cutoff is None else [sample for sample in samples if sample['timestamp'] >= cutoff]
+            apply_rollups(kept, db.session, (model,))
+        self._compacted += len(samples)
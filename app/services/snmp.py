@@ -1,9 +1,504 @@
 import subprocess
 import platform
 import socket
+import threading
+import queue
 import time
+import logging
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime
-from app.models.device import Device, DeviceMetric, db
+from flask import current_app, has_app_context
+from sqlalchemy.orm.attributes import set_committed_value
+from app.models.device import Device, PollProfile, SNMPCredential, db
+from app.models.fleet_version import bump_fleet_version
+from app.services.metric_storage import write_samples
+from app.services.icmp import ICMPPinger
+
+try:
+    from pysnmp.hlapi import asyncore as snmp_api
+    from pysnmp.hlapi.varbinds import CommandGeneratorVarBinds
+    from pysnmp.carrier.asyncore.dispatch import AsyncoreDispatcher
+    from pysnmp.carrier.asyncore.dgram import udp
+    from pysnmp.entity import config as snmp_config
+    from pysnmp.proto import rfc1902, rfc1905
+except ImportError:
+    snmp_api = None
+
+# Protocoles USM (SNMPv3) par nom, tels que stockés dans SNMPCredential
+if snmp_api is not None:
+    USM_AUTH_PROTOCOLS = {
+        'none': snmp_config.usmNoAuthProtocol,
+        'md5': snmp_config.usmHMACMD5AuthProtocol,
+        'sha': snmp_config.usmHMACSHAAuthProtocol,
+        'sha224': snmp_config.usmHMAC128SHA224AuthProtocol,
+        'sha256': snmp_config.usmHMAC192SHA256AuthProtocol,
+        'sha384': snmp_config.usmHMAC256SHA384AuthProtocol,
+        'sha512': snmp_config.usmHMAC384SHA512AuthProtocol
+    }
+    USM_PRIV_PROTOCOLS = {
+        'none': snmp_config.usmNoPrivProtocol,
+        'des': snmp_config.usmDESPrivProtocol,
+        '3des': snmp_config.usm3DESEDEPrivProtocol,
+        'aes': snmp_config.usmAesCfb128Protocol,
+        'aes192': snmp_config.usmAesCfb192Protocol,
+        'aes256': snmp_config.usmAesCfb256Protocol
+    }
+else:
+    USM_AUTH_PROTOCOLS = USM_PRIV_PROTOCOLS = {}
+
+logger = logging.getLogger(__name__)
+
+
+class SharedSNMPEngine:
+    """Moteur SNMP unique pour tout le processus.
+    
+    Un thread dédié fait tourner le dispatcher pysnmp ; les requêtes soumises depuis
+    n'importe quel thread sont multiplexées sur le même moteur et le même socket UDP,
+    les réponses étant associées à leur requête par le request-id SNMP.
+    Les cibles de transport, les identifiants et les OIDs résolus sont mis en cache.
+    
+    Pour SNMPv3, l'engine ID autoritaire et l'horloge (boots/time) de chaque agent
+    sont mémorisés et réinjectés dans pysnmp, qui les oublie au bout de 300
+    secondes : la découverte n'est payée qu'au premier contact. Les clés maîtresses
+    USM sont dérivées une seule fois par jeu d'identifiants.
+    """
+    
+    _JOB_ID = 'shared-snmp-engine'
+    
+    # Garde-fou contre les agents qui bouclent pendant un parcours de table
+    WALK_MAX_ROWS = 10000
+    
+    # Utilisateur USM fictif des requêtes de découverte d'engine ID
+    DISCOVERY_USER = 'engine-id-discovery'
+    
+    def __init__(self, timer_resolution=0.01):
+        self.timer_resolution = timer_resolution
+        self._lock = threading.Lock()
+        self._pending = queue.Queue()
+        self._thread = None
+        self._engine = None
+        self._context = None
+        self._targets = {}
+        self._auth = {}
+        self._object_types = {}
+        # (ip, port) -> engine ID autoritaire ; engine ID -> (boots, time, instant)
+        self._peer_engine_ids = {}
+        self._peer_clocks = {}
+        self._master_keys = {}
+    
+    def _ensure_started(self):
+        """Démarre le thread de dispatch au premier usage"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            
+            ready = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(ready,), name='snmp-dispatcher', daemon=True
+            )
+            self._thread.start()
+            ready.wait()
+    
+    def _run(self, ready):
+        """Boucle du dispatcher pysnmp (exécutée dans le thread dédié)"""
+        try:
+            engine = snmp_api.SnmpEngine()
+            dispatcher = AsyncoreDispatcher()
+            dispatcher.setTimerResolution(self.timer_resolution)
+            engine.registerTransportDispatcher(dispatcher)
+            
+            # Un seul socket UDP client, partagé par toutes les cibles
+            snmp_config.addTransport(engine, udp.domainName, udp.UdpTransport().openClientMode())
+            
+            dispatcher.registerTimerCbFun(self._dispatch_pending)
+            engine.observer.registerObserver(
+                self._on_incoming_message,
+                'rfc3412.prepareDataElements:response',
+                'rfc3412.prepareDataElements:internal',
+                'rfc3414.processIncomingMsg'
+            )
+            dispatcher.jobStarted(self._JOB_ID)
+            
+            self._engine = engine
+            self._context = snmp_api.ContextData()
+            # Les ObjectType résolus dépendent du MIB view du moteur courant
+            self._object_types = {}
+        finally:
+            ready.set()
+        
+        try:
+            dispatcher.runDispatcher()
+        except Exception as e:
+            logger.error(f"Arrêt du dispatcher SNMP: {e}")
+        finally:
+            self._engine = None
+            self._fail_pending(RuntimeError('Moteur SNMP arrêté'))
+    
+    def _fail_pending(self, error):
+        while True:
+            try:
+                _, future, _, _, _, _ = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            if not future.done():
+                future.set_exception(error)
+    
+    def _dispatch_pending(self, time_now):
+        """Envoie les requêtes en attente (appelé à chaque tick du dispatcher)"""
+        while True:
+            try:
+                command, future, auth_data, target, oids, options = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            
+            try:
+                var_binds = [self._object_type(oid) for oid in oids]
+                if isinstance(auth_data, snmp_api.UsmUserData):
+                    self._prime_peer(target)
+                if command == 'get':
+                    snmp_api.getCmd(
+                        self._engine, auth_data, target, self._context, *var_binds,
+                        cbFun=self._on_response, cbCtx=future, lookupMib=False
+                    )
+                elif command == 'walk':
+                    columns = [tuple(int(arc) for arc in oid.split('.')) for oid in oids]
+                    walk = {
+                        'future': future,
+                        'columns': columns,
+                        'oids': oids,
+                        'table': dict((oid, {}) for oid in oids),
+                        'max_rows': options.get('max_rows', self.WALK_MAX_ROWS),
+                        'rows': 0,
+                        'getnext': getattr(auth_data, 'mpModel', None) == 0
+                    }
+                    if walk['getnext']:
+                        # SNMPv1 n'a pas de GETBULK : parcours ligne par ligne par GETNEXT
+                        snmp_api.nextCmd(
+                            self._engine, auth_data, target, self._context, *var_binds,
+                            cbFun=self._on_walk_response, cbCtx=walk, lookupMib=False
+                        )
+                    else:
+                        snmp_api.bulkCmd(
+                            self._engine, auth_data, target, self._context,
+                            0, options.get('max_repetitions', 25), *var_binds,
+                            cbFun=self._on_walk_response, cbCtx=walk, lookupMib=False
+                        )
+                else:
+                    snmp_api.nextCmd(
+                        self._engine, auth_data, target, self._context, *var_binds,
+                        cbFun=self._on_next_response, cbCtx=future, lookupMib=False
+                    )
+            except Exception as e:
+                future.set_exception(e)
+    
+    @staticmethod
+    def _on_response(snmp_engine, send_request_handle, error_indication,
+                     error_status, error_index, var_binds, future):
+        future.set_result((error_indication, error_status, error_index, var_binds))
+    
+    @staticmethod
+    def _on_next_response(snmp_engine, send_request_handle, error_indication,
+                          error_status, error_index, var_bind_table, future):
+        var_binds = var_bind_table[0] if var_bind_table else []
+        future.set_result((error_indication, error_status, error_index, var_binds))
+        # Une seule ligne suffit : on n'enchaîne pas de GETNEXT supplémentaire
+        return False
+    
+    @staticmethod
+    def _on_walk_response(snmp_engine, send_request_handle, error_indication,
+                          error_status, error_index, var_bind_table, walk):
+        future = walk['future']
+        if walk['getnext'] and not error_indication and int(error_status) == 2:
+            # noSuchName : un agent SNMPv1 signale ainsi la fin de sa MIB
+            future.set_result((None, 0, 0, walk['table']))
+            return False
+        if error_indication or error_status:
+            future.set_result((error_indication, error_status, error_index, walk['table']))
+            return False
+        
+        for row in var_bind_table:
+            in_scope = False
+            for column, oid, (name, value) in zip(walk['columns'], walk['oids'], row):
+                name = tuple(name)
+                if name[:len(column)] != column or _is_missing_value(value):
+                    continue
+                in_scope = True
+                index = '.'.join(str(arc) for arc in name[len(column):])
+                walk['table'][oid][index] = value
+            
+            walk['rows'] += 1
+            if not in_scope or walk['rows'] >= walk['max_rows']:
+                # Toutes les colonnes sont épuisées : fin du parcours
+                future.set_result((None, 0, 0, walk['table']))
+                return False
+        
+        if not var_bind_table:
+            future.set_result((None, 0, 0, walk['table']))
+            return False
+        return True
+    
+    def _object_type(self, oid):
+        """ObjectType résolu une seule fois par OID"""
+        object_type = self._object_types.get(oid)
+        if object_type is None:
+            mib_view = CommandGeneratorVarBinds.getMibViewController(self._engine)
+            object_type = snmp_api.ObjectType(snmp_api.ObjectIdentity(oid)).resolveWithMib(mib_view)
+            self._object_types[oid] = object_type
+        return object_type
+    
+    def _on_incoming_message(self, snmp_engine, execpoint, variables, cb_ctx):
+        """Mémorise l'engine ID et l'horloge des agents SNMPv3 qui nous répondent"""
+        engine_id = variables.get('securityEngineId')
+        if not engine_id:
+            return
+        engine_id = bytes(engine_id)
+        
+        if execpoint == 'rfc3414.processIncomingMsg':
+            self._peer_clocks[engine_id] = (
+                int(variables['snmpEngineBoots']), int(variables['snmpEngineTime']), time.time()
+            )
+            return
+        
+        if variables.get('securityModel') != 3:
+            return
+        address = tuple(variables['transportAddress'])[:2]
+        previous = self._peer_engine_ids.get(address)
+        self._peer_engine_ids[address] = engine_id
+        if previous is not None and previous != engine_id:
+            # Agent réinstallé : pysnmp doit réapprendre son engine ID
+            self._peer_cache('_MPModelV3__engineIdCache', 3).pop(
+                (variables['transportDomain'], variables['transportAddress']), None
+            )
+    
+    def _peer_cache(self, attribute, model_id):
+        """Cache interne de pysnmp (vide si sa structure a changé)"""
+        if attribute.startswith('_MPModel'):
+            subsystem = self._engine.messageProcessingSubsystems.get(model_id)
+        else:
+            subsystem = self._engine.securityModels.get(model_id)
+        cache = getattr(subsystem, attribute, None)
+        return cache if isinstance(cache, dict) else {}
+    
+    def _prime_peer(self, target):
+        """Réinjecte l'engine ID et l'horloge connus d'un agent avant une requête v3"""
+        engine_id = self._peer_engine_ids.get(tuple(target.transportAddr)[:2])
+        if engine_id is None:
+            return
+        
+        engine_ids = self._peer_cache('_MPModelV3__engineIdCache', 3)
+        key = (target.transportDomain, target.transportAddr)
+        if key not in engine_ids:
+            engine_ids[key] = {
+                'securityEngineId': rfc1902.OctetString(engine_id),
+                'contextEngineId': rfc1902.OctetString(engine_id),
+                'contextName': rfc1902.OctetString('')
+            }
+        
+        clocks = self._peer_cache('_SnmpUSMSecurityModel__timeline', 3)
+        clock = self._peer_clocks.get(engine_id)
+        if clock is not None and rfc1902.OctetString(engine_id) not in clocks:
+            boots, engine_time, received_at = clock
+            engine_time += int(time.time() - received_at)
+            clocks[rfc1902.OctetString(engine_id)] = (boots, engine_time, engine_time, int(time.time()))
+    
+    def discover_engine_id(self, target):
+        """Découverte explicite de l'engine ID d'un agent au premier contact v3
+        
+        Un GET sans authentification au nom d'un utilisateur inexistant suffit :
+        l'agent répond par des rapports qui portent son engine ID. Cela évite de
+        configurer des identifiants non localisés, que pysnmp partage entre
+        tous les agents ayant le même nom d'utilisateur.
+        """
+        self.request('get', self.usm_auth_data(self.DISCOVERY_USER), target, ['1.3.6.1.2.1.1.3.0'])
+        return self.peer_engine_id(*tuple(target.transportAddr)[:2])
+    
+    def peer_engine_id(self, ip_address, port=161):
+        """Engine ID autoritaire connu d'un agent SNMPv3 (bytes), ou None"""
+        return self._peer_engine_ids.get((ip_address, port))
+    
+    def remember_peer_engine_id(self, ip_address, port, engine_id):
+        """Amorce le cache avec un engine ID déjà connu (persisté en base)"""
+        self._peer_engine_ids.setdefault((ip_address, port), engine_id)
+    
+    def usm_auth_data(self, username, auth_protocol=None, auth_key=None, priv_protocol=None, priv_key=None,
+                      engine_id=None):
+        """Identifiants SNMPv3 (USM) mis en cache
+        
+        Les clés maîtresses sont dérivées des phrases secrètes une seule fois ;
+        lorsque l'engine ID de l'agent est connu, pysnmp localise les clés pour
+        cet agent à la première requête puis les réutilise.
+        """
+        auth_protocol = auth_protocol or snmp_config.usmNoAuthProtocol
+        priv_protocol = priv_protocol or snmp_config.usmNoPrivProtocol
+        key = (username, auth_protocol, auth_key, priv_protocol, priv_key, engine_id)
+        auth = self._auth.get(key)
+        if auth is not None:
+            return auth
+        
+        master_key = (auth_protocol, auth_key, priv_protocol, priv_key)
+        master = self._master_keys.get(master_key)
+        if master is None:
+            master_auth = master_priv = None
+            if auth_key and auth_protocol != snmp_config.usmNoAuthProtocol:
+                master_auth = snmp_config.authServices[auth_protocol].hashPassphrase(auth_key)
+            if priv_key and priv_protocol != snmp_config.usmNoPrivProtocol:
+                master_priv = snmp_config.privServices[priv_protocol].hashPassphrase(auth_protocol, priv_key)
+            master = self._master_keys.setdefault(master_key, (master_auth, master_priv))
+        
+        auth = snmp_api.UsmUserData(
+            username,
+            authKey=master[0], privKey=master[1],
+            authProtocol=auth_protocol, privProtocol=priv_protocol,
+            securityEngineId=rfc1902.OctetString(engine_id) if engine_id else None,
+            authKeyType=snmp_config.usmKeyTypeMaster, privKeyType=snmp_config.usmKeyTypeMaster
+        )
+        return self._auth.setdefault(key, auth)
+    
+    def auth_data(self, community, mp_model=1):
+        """Identifiants communautaires mis en cache"""
+        key = (community, mp_model)
+        auth = self._auth.get(key)
+        if auth is None:
+            auth = self._auth.setdefault(key, snmp_api.CommunityData(community, mpModel=mp_model))
+        return auth
+    
+    def transport_target(self, ip_address, port=161, timeout=5, retries=5):
+        """Cible UDP mise en cache (l'adresse n'est résolue qu'une fois)"""
+        key = (ip_address, port, timeout, retries)
+        target = self._targets.get(key)
+        if target is None:
+            target = snmp_api.UdpTransportTarget((ip_address, port), timeout=timeout, retries=retries)
+            target = self._targets.setdefault(key, target)
+        return target
+    
+    def submit(self, command, auth_data, target, oids, **options):
+        """Soumet une requête 'get', 'next' ou 'walk' (GETBULK, GETNEXT en SNMPv1) et retourne un Future"""
+        self._ensure_started()
+        future = Future()
+        self._pending.put((command, future, auth_data, target, list(oids), options))
+        return future
+    
+    def request(self, command, auth_data, target, oids, **options):
+        """Exécute une requête de manière bloquante pour le thread appelant
+        
+        Pour 'walk', le résultat contient {colonne: {index: valeur}} à la place des varbinds.
+        """
+        # Échéance de la sonde en cours dans ce thread (voir probe_deadline)
+        remaining = probe_time_remaining()
+        if remaining is not None and remaining <= 0:
+            raise ProbeDeadlineExceeded('Échéance de la sonde dépassée')
+        
+        future = self.submit(command, auth_data, target, oids, **options)
+        # Garde-fou si le dispatcher ne répond jamais
+        deadline = target.timeout * (target.retries + 1) + 5
+        if command == 'walk':
+            deadline *= 10
+        if remaining is not None and remaining < deadline:
+            try:
+                return future.result(timeout=remaining)
+            except FutureTimeoutError:
+                raise ProbeDeadlineExceeded('Échéance de la sonde dépassée')
+        return future.result(timeout=deadline)
+
+
+class ProbeDeadlineExceeded(Exception):
+    """La sonde d'un appareil a dépassé son échéance"""
+
+
+_probe_state = threading.local()
+
+
+@contextmanager
+def probe_deadline(seconds):
+    """Borne la durée totale des requêtes SNMP du thread courant
+    
+    Les requêtes émises après l'échéance échouent immédiatement ; celle en cours
+    est abandonnée par l'appelant (la réponse tardive est ignorée).
+    """
+    previous = getattr(_probe_state, 'deadline', None)
+    _probe_state.deadline = time.monotonic() + seconds if seconds else None
+    try:
+        yield
+    finally:
+        _probe_state.deadline = previous
+
+
+def probe_time_remaining():
+    """Secondes restantes avant l'échéance de la sonde courante (None sans échéance)"""
+    deadline = getattr(_probe_state, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+# hrStorageTypes.hrStorageRam (HOST-RESOURCES-TYPES)
+HR_STORAGE_RAM = '1.3.6.1.2.1.25.2.1.2'
+
+
+def _index_key(index):
+    """Clé de tri numérique d'un index de table ('10' après '9')"""
+    return tuple(int(arc) for arc in index.split('.'))
+
+
+def _is_missing_value(value):
+    """Indique si une varbind signale une instance absente (SNMPv2c)"""
+    return isinstance(value, (rfc1905.NoSuchObject, rfc1905.NoSuchInstance, rfc1905.EndOfMibView))
+
+
+class CounterRateTracker:
+    """Convertit des échantillons successifs de compteurs d'octets en débits (bits/s)
+    
+    Le temps de référence est le sysUpTime de l'agent (centièmes de seconde) : un
+    sysUpTime qui recule signale un redémarrage et réinitialise la série.
+    """
+    
+    def __init__(self):
+        self._samples = {}
+    
+    def rate(self, key, counter, uptime, counter_bits=32):
+        """Enregistre un échantillon et retourne le débit depuis le précédent (ou None)"""
+        previous = self._samples.get(key)
+        self._samples[key] = (counter, uptime, counter_bits)
+        if previous is None:
+            return None
+        
+        previous_counter, previous_uptime, previous_bits = previous
+        if uptime <= previous_uptime or previous_bits != counter_bits:
+            # Redémarrage de l'agent ou changement de compteur : nouvelle série
+            return None
+        
+        delta = counter - previous_counter
+        if delta < 0:
+            if counter_bits != 32:
+                # Un compteur 64 bits ne reboucle pas en pratique : discontinuité
+                return None
+            delta += 2 ** 32
+        
+        return delta * 8 * 100.0 / (uptime - previous_uptime)
+    
+    def forget(self, device_id):
+        """Oublie les séries d'un appareil"""
+        for key in [key for key in self._samples if key[0] == device_id]:
+            del self._samples[key]
+
+
+_shared_engine = None
+_shared_engine_lock = threading.Lock()
+
+
+def get_shared_engine():
+    """Retourne le moteur SNMP partagé du processus"""
+    global _shared_engine
+    if _shared_engine is None:
+        with _shared_engine_lock:
+            if _shared_engine is None:
+                _shared_engine = SharedSNMPEngine()
+    return _shared_engine
+
 
 class SNMPService:
     """Service pour les communications SNMP avec fallback sur ping"""
@@ -14,61 +509,446 @@ class SNMPService:
             'sysUpTime': '1.3.6.1.2.1.1.3.0',
             'sysName': '1.3.6.1.2.1.1.5.0',
             'sysDescr': '1.3.6.1.2.1.1.1.0',
+            'sysObjectID': '1.3.6.1.2.1.1.2.0',
             'ifInOctets': '1.3.6.1.2.1.2.2.1.10',
             'ifOutOctets': '1.3.6.1.2.1.2.2.1.16',
+            'ifHCInOctets': '1.3.6.1.2.1.31.1.1.1.6',
+            'ifHCOutOctets': '1.3.6.1.2.1.31.1.1.1.10',
             'hrProcessorLoad': '1.3.6.1.2.1.25.3.3.1.2',
+            'hrStorageType': '1.3.6.1.2.1.25.2.3.1.2',
             'hrStorageUsed': '1.3.6.1.2.1.25.2.3.1.6',
             'hrStorageSize': '1.3.6.1.2.1.25.2.3.1.5'
         }
         
         # Vérifier si SNMP est disponible
         self.snmp_available = self._check_snmp_availability()
+        
+        # Moteur ICMP natif (None si les sockets ICMP ne sont pas autorisés)
+        self.pinger = ICMPPinger()
+        
+        # Derniers échantillons des compteurs d'interface pour le calcul des débits
+        self.rate_tracker = CounterRateTracker()
+        
+        # Profils de collecte : par appareil, et modèles par (sysObjectID, device_type)
+        self.poll_profiles = {}
+        self.profile_templates = {}
     
     def _check_snmp_availability(self):
-        """Vérifie si les outils SNMP sont disponibles sur le système"""
-        try:
-            # Essayer d'importer pysnmp
-            import pysnmp.hlapi
-            return True
-        except ImportError:
+        """Vérifie si PySNMP est disponible"""
+        if snmp_api is None:
             print("⚠️  PySNMP non disponible, utilisation du ping pour la connectivité")
             return False
+        return True
+    
+    @property
+    def engine(self):
+        """Moteur SNMP partagé par toutes les instances du service"""
+        return get_shared_engine()
+    
+    def auth_for(self, device):
+        """Identifiants SNMP de l'appareil selon sa version (1, 2c ou 3)
+        
+        Pour SNMPv3, l'engine ID de l'agent est repris du cache du moteur, de la
+        base (SNMPCredential.engine_id) ou découvert, puis enregistré sur
+        l'identifiant pour les redémarrages et les autres processus de collecte.
+        """
+        engine = self.engine
+        credential = device.snmp_credential if device.snmp_version == '3' else None
+        if credential is None:
+            return engine.auth_data(device.snmp_community or 'public', 0 if device.snmp_version == '1' else 1)
+        
+        options = self._snmp_options()
+        port = options.get('port', 161)
+        engine_id = engine.peer_engine_id(device.ip_address, port)
+        if engine_id is None and credential.engine_id:
+            engine_id = bytes.fromhex(credential.engine_id)
+            engine.remember_peer_engine_id(device.ip_address, port, engine_id)
+        if engine_id is None:
+            try:
+                engine_id = engine.discover_engine_id(
+                    engine.transport_target(device.ip_address, port, options.get('timeout', 5), 0)
+                )
+            except ProbeDeadlineExceeded:
+                raise
+            except Exception as e:
+                print(f"Découverte de l'engine ID impossible pour {device.ip_address}: {e}")
+        if engine_id is not None and credential.engine_id != engine_id.hex():
+            if credential.id is None:
+                credential.engine_id = engine_id.hex()
+            else:
+                # Hors de la session de la sonde : la valider écrirait aussi l'état de l'appareil
+                table = SNMPCredential.__table__
+                with db.engine.begin() as connection:
+                    connection.execute(
+                        table.update().where(table.c.id == credential.id).values(engine_id=engine_id.hex())
+                    )
+                    bump_fleet_version(connection, status=True)
+                set_committed_value(credential, 'engine_id', engine_id.hex())
+        
+        return engine.usm_auth_data(
+            credential.username,
+            USM_AUTH_PROTOCOLS[credential.auth_protocol or 'none'], credential.auth_key,
+            USM_PRIV_PROTOCOLS[credential.priv_protocol or 'none'], credential.priv_key,
+            engine_id
+        )
     
-    def get_snmp_value(self, ip_address, oid, community='public', port=161, timeout=5):
+    def get_snmp_value(self, ip_address, oid, community='public', port=161, timeout=5, auth_data=None):
         """Récupère une valeur SNMP d'un appareil"""
         if not self.snmp_available:
             return None
             
         try:
-            from pysnmp.hlapi import (
-                nextCmd, SnmpEngine, CommunityData, UdpTransportTarget,
-                ContextData, ObjectType, ObjectIdentity
+            engine = self.engine
+            errorIndication, errorStatus, errorIndex, varBinds = engine.request(
+                'next',
+                auth_data or engine.auth_data(community),
+                engine.transport_target(ip_address, port, timeout),
+                [oid]
             )
+            if errorIndication:
+                raise Exception(f"SNMP Error: {errorIndication}")
+            elif errorStatus:
+                raise Exception(f"SNMP Error: {errorStatus.prettyPrint()}")
+            else:
+                for varBind in varBinds:
+                    return varBind[1]
+            return None
+        except Exception as e:
+            print(f"Erreur SNMP pour {ip_address}: {e}")
+            return None
+    
+    def get_snmp_values(self, ip_address, oids, community='public', port=161, timeout=5, retries=5,
+                        fallback=True, auth_data=None):
+        """Récupère plusieurs valeurs SNMP en un seul PDU GET
+        
+        Retourne un dictionnaire {oid: valeur}. Les OIDs refusés par l'agent sont
+        relus individuellement par GETNEXT sur leur colonne (sauf `fallback=False`) ;
+        ceux qui restent introuvables sont absents du résultat. `auth_data`
+        (voir auth_for) remplace la communauté pour SNMPv1 et SNMPv3.
+        """
+        if not self.snmp_available or not oids:
+            return {}
+        
+        engine = self.engine
+        auth_data = auth_data or engine.auth_data(community)
+        target = engine.transport_target(ip_address, port, timeout, retries)
+        values = {}
+        
+        try:
+            values, rejected = self._get_accepted(engine, auth_data, target, oids)
+            for oid in (rejected if fallback else []):
+                instance = self._get_next_in_column(engine, auth_data, target, oid.rsplit('.', 1)[0])
+                if instance is not None:
+                    values[oid] = instance[1]
+        except Exception as e:
+            print(f"Erreur SNMP pour {ip_address}: {e}")
+        
+        return values
+    
+    def _get_accepted(self, engine, auth_data, target, oids):
+        """GET en un seul PDU, réémis sans les varbinds refusées par l'agent
+        
+        Retourne ({oid: valeur}, OIDs refusés ou absents).
+        """
+        values = {}
+        pending = list(oids)
+        rejected = []
+        while pending:
+            errorIndication, errorStatus, errorIndex, varBinds = engine.request('get', auth_data, target, pending)
+            if errorIndication:
+                raise Exception(f"SNMP Error: {errorIndication}")
+            
+            if errorStatus:
+                # Agents SNMPv1 / stricts : une varbind fautive invalide tout le PDU
+                index = int(errorIndex) - 1
+                if 0 <= index < len(pending):
+                    rejected.append(pending.pop(index))
+                    continue
+                raise Exception(f"SNMP Error: {errorStatus.prettyPrint()}")
             
-            for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-                SnmpEngine(),
-                CommunityData(community),
-                UdpTransportTarget((ip_address, port), timeout=timeout),
-                ContextData(),
-                ObjectType(ObjectIdentity(oid)),
-                lexicographicMode=False,
-                ignoreNonIncreasingOid=True,
-                maxRows=1
-            ):
-                if errorIndication:
-                    raise Exception(f"SNMP Error: {errorIndication}")
-                elif errorStatus:
-                    raise Exception(f"SNMP Error: {errorStatus.prettyPrint()}")
+            for oid, (name, value) in zip(pending, varBinds):
+                if _is_missing_value(value):
+                    rejected.append(oid)
                 else:
-                    for varBind in varBinds:
-                        return varBind[1]
-            return None
+                    values[oid] = value
+            break
+        return values, rejected
+    
+    def walk_table(self, ip_address, columns, community='public', port=161, timeout=5, max_repetitions=25,
+                   auth_data=None):
+        """Parcourt des colonnes de table par GETBULK (GETNEXT pour un agent SNMPv1)
+        
+        Retourne {colonne: {index: valeur}} ; un dictionnaire vide en cas d'erreur.
+        """
+        if not self.snmp_available or not columns:
+            return {}
+        
+        try:
+            engine = self.engine
+            errorIndication, errorStatus, errorIndex, table = engine.request(
+                'walk',
+                auth_data or engine.auth_data(community),
+                engine.transport_target(ip_address, port, timeout),
+                columns,
+                max_repetitions=max_repetitions
+            )
+            if errorIndication:
+                raise Exception(f"SNMP Error: {errorIndication}")
+            elif errorStatus:
+                raise Exception(f"SNMP Error: {errorStatus.prettyPrint()}")
+            return table
         except Exception as e:
             print(f"Erreur SNMP pour {ip_address}: {e}")
+            return {}
+    
+    def collect_interface_metrics(self, device, uptime=None, counter_bits=None):
+        """Débits entrants/sortants (bits/s) de chaque interface
+        
+        Les compteurs 64 bits de l'ifXTable sont préférés ; l'ifTable 32 bits n'est
+        parcourue que si l'agent ne les expose pas. `counter_bits` (issu du profil
+        de collecte) désigne directement la table à parcourir. Le premier
+        échantillon d'une interface ne produit pas de débit.
+        """
+        options = self._snmp_options()
+        table = {}
+        if counter_bits in (None, 64):
+            counter_bits = 64
+            in_column, out_column = self.oids['ifHCInOctets'], self.oids['ifHCOutOctets']
+            table = self.walk_table(
+                device.ip_address, [in_column, out_column], auth_data=self.auth_for(device), **options
+            )
+        
+        if not any(table.values()):
+            counter_bits = 32
+            in_column, out_column = self.oids['ifInOctets'], self.oids['ifOutOctets']
+            table = self.walk_table(
+                device.ip_address, [in_column, out_column], auth_data=self.auth_for(device), **options
+            )
+        
+        if uptime is None:
+            uptime = time.time() * 100
+        
+        metrics = []
+        for direction, column in (('in', in_column), ('out', out_column)):
+            for index, counter in table.get(column, {}).items():
+                rate = self.rate_tracker.rate(
+                    (device.id, index, direction), int(counter), int(uptime), counter_bits
+                )
+                if rate is not None:
+                    metrics.append({
+                        'type': f'bandwidth_{direction}.{index}',
+                        'value': rate,
+                        'unit': 'bps'
+                    })
+        return metrics
+    
+    def _get_next_in_column(self, engine, auth_data, target, column):
+        """GETNEXT de repli : (OID, valeur) de la première instance de la colonne"""
+        errorIndication, errorStatus, errorIndex, varBinds = engine.request('next', auth_data, target, [column])
+        if errorIndication:
+            raise Exception(f"SNMP Error: {errorIndication}")
+        if errorStatus or not varBinds:
+            return None
+        
+        name, value = varBinds[0]
+        if str(name).startswith(column + '.') and not _is_missing_value(value):
+            return str(name), value
+        return None
+    
+    def discover_capabilities(self, device):
+        """Détecte les OIDs auxquels l'agent de l'appareil répond
+        
+        Les tables hrProcessorTable et hrStorageTable sont parcourues une fois
+        pour retenir tous les processeurs et la ligne de mémoire vive
+        (hrStorageRam). Le type de compteurs d'interface est repris d'un appareil
+        de même modèle (sysObjectID, device_type) déjà découvert, sinon détecté.
+        Retourne None si l'agent ne répond pas.
+        """
+        options = self._snmp_options()
+        identity = self.get_snmp_values(
+            device.ip_address, [self.oids['sysObjectID'], self.oids['sysUpTime']],
+            auth_data=self.auth_for(device), fallback=False, **options
+        )
+        if not identity:
+            return None
+        sys_object_id = identity.get(self.oids['sysObjectID'])
+        if sys_object_id is not None:
+            sys_object_id = str(sys_object_id)
+        
+        scalar_oids = {}
+        if self.oids['sysUpTime'] in identity:
+            scalar_oids['uptime'] = self.oids['sysUpTime']
+        scalar_oids.update(self._discover_host_resources(device, options))
+        
+        # Le nombre de processeurs varie d'un hôte à l'autre, pas la table d'interfaces
+        template = self._find_template(sys_object_id, device.device_type)
+        if template:
+            interface_counter_bits = template['interface_counter_bits']
+        else:
+            interface_counter_bits = self._discover_interface_counters(device, options)
+        
+        return {
+            'sys_object_id': sys_object_id,
+            'scalar_oids': scalar_oids,
+            'interface_counter_bits': interface_counter_bits
+        }
+    
+    def _discover_host_resources(self, device, options):
+        """OIDs d'instance de chaque processeur ('cpu.<index>') et de la ligne de RAM"""
+        processor_column, type_column = self.oids['hrProcessorLoad'], self.oids['hrStorageType']
+        table = self.walk_table(
+            device.ip_address, [processor_column, type_column], auth_data=self.auth_for(device), **options
+        )
+        
+        scalar_oids = {}
+        for index in sorted(table.get(processor_column, {}), key=_index_key):
+            scalar_oids[f'cpu.{index}'] = f'{processor_column}.{index}'
+        
+        ram_rows = [
+            index for index, storage_type in table.get(type_column, {}).items()
+            if str(storage_type) == HR_STORAGE_RAM
+        ]
+        if ram_rows:
+            index = min(ram_rows, key=_index_key)
+            scalar_oids['storage_used'] = f"{self.oids['hrStorageUsed']}.{index}"
+            scalar_oids['storage_size'] = f"{self.oids['hrStorageSize']}.{index}"
+        return scalar_oids
+    
+    def _discover_interface_counters(self, device, options):
+        """64 si l'ifXTable expose les compteurs HC, 32 pour l'ifTable seule, sinon None"""
+        engine = self.engine
+        auth_data = self.auth_for(device)
+        target = engine.transport_target(
+            device.ip_address, options.get('port', 161), options.get('timeout', 5)
+        )
+        for counter_bits, column in ((64, self.oids['ifHCInOctets']), (32, self.oids['ifInOctets'])):
+            if self._get_next_in_column(engine, auth_data, target, column) is not None:
+                return counter_bits
+        return None
+    
+    def _find_template(self, sys_object_id, device_type):
+        """Profil d'un appareil de même modèle déjà découvert, ou None"""
+        if sys_object_id is None:
             return None
+        key = (sys_object_id, device_type)
+        template = self.profile_templates.get(key)
+        if template is None:
+            row = PollProfile.query.filter_by(sys_object_id=sys_object_id, device_type=device_type) \
+                .order_by(PollProfile.discovered_at.desc()).first()
+            if row is not None:
+                template = self.profile_templates[key] = {
+                    'interface_counter_bits': row.interface_counter_bits
+                }
+        return template
+    
+    def get_poll_profile(self, device, now=None):
+        """Profil de collecte de l'appareil, découvert ou rafraîchi si nécessaire
+        
+        Le profil est rafraîchi après POLL_PROFILE_TTL, lorsque le type de
+        l'appareil change, ou lorsqu'un OID du profil n'a plus répondu. Retourne
+        None si l'agent n'a jamais répondu à la découverte.
+        """
+        now = now or datetime.utcnow()
+        profile = self.poll_profiles.get(device.id)
+        if profile is None:
+            with db.session.no_autoflush:
+                row = db.session.get(PollProfile, device.id)
+            if row is not None:
+                profile = self.poll_profiles[device.id] = {
+                    'sys_object_id': row.sys_object_id,
+                    'device_type': row.device_type,
+                    'scalar_oids': dict(row.scalar_oids or {}),
+                    'interface_counter_bits': row.interface_counter_bits,
+                    'discovered_at': row.discovered_at,
+                    'stale': False
+                }
+        
+        ttl = current_app.config.get('POLL_PROFILE_TTL', 86400) if has_app_context() else 86400
+        if profile is not None and not profile['stale'] and profile['device_type'] == device.device_type \
+                and (now - profile['discovered_at']).total_seconds() < ttl:
+            return profile
+        
+        try:
+            discovered = self.discover_capabilities(device)
+        except Exception as e:
+            print(f"Erreur lors de la découverte SNMP de {device.name}: {e}")
+            discovered = None
+        if discovered is None:
+            # Agent muet : on garde l'ancien profil en attendant qu'il réponde
+            return profile
+        
+        profile = dict(discovered, device_type=device.device_type, discovered_at=now, stale=False)
+        self._save_profile(device.id, profile)
+        self.poll_profiles[device.id] = profile
+        if profile['sys_object_id'] is not None:
+            self.profile_templates[(profile['sys_object_id'], device.device_type)] = {
+                'interface_counter_bits': profile['interface_counter_bits']
+            }
+        return profile
+    
+    def _save_profile(self, device_id, profile):
+        """Enregistre un profil dans sa propre transaction
+        
+        La session de la sonde n'est jamais validée : l'état de l'appareil
+        n'est écrit que par le MetricWriter, colonnes modifiées seulement.
+        """
+        table = PollProfile.__table__
+        values = {
+            'sys_object_id': profile['sys_object_id'],
+            'device_type': profile['device_type'],
+            'scalar_oids': profile['scalar_oids'],
+            'interface_counter_bits': profile['interface_counter_bits'],
+            'discovered_at': profile['discovered_at']
+        }
+        with db.engine.begin() as connection:
+            if not connection.execute(table.update().where(table.c.device_id == device_id).values(values)).rowcount:
+                connection.execute(table.insert().values(device_id=device_id, **values))
+    
+    def forget_profile(self, device_id):
+        """Oublie le profil en mémoire d'un appareil retiré de la surveillance"""
+        self.poll_profiles.pop(device_id, None)
+    
+    def probe_liveness(self, device, ping_result=None, timeout=1):
+        """Sonde de vie d'un seul paquet pour un appareil en backoff
+        
+        Un echo ICMP, sauf si `ping_result` est déjà connu : la joignabilité
+        retenue est celle de la collecte, que l'agent SNMP réponde ou non.
+        """
+        if ping_result is not None:
+            return bool(ping_result['alive'])
+        result = self.ping_many([device.ip_address], timeout)[device.ip_address]
+        return bool(result and result['alive'])
+    
+    def _snmp_options(self):
+        """Port et timeout SNMP issus de la configuration de l'application"""
+        if not has_app_context():
+            return {}
+        return {
+            'port': current_app.config.get('SNMP_PORT', 161),
+            'timeout': current_app.config.get('SNMP_TIMEOUT', 5)
+        }
     
     def ping_device(self, ip_address, timeout=3):
-        """Teste la connectivité avec ping"""
+        """Teste la connectivité (ICMP natif, commande ping en repli)"""
+        result = self.ping_many([ip_address], timeout)[ip_address]
+        return bool(result and result['alive'])
+    
+    def ping_many(self, ip_addresses, timeout=3):
+        """Teste la connectivité d'un lot d'adresses en un seul appel
+        
+        Retourne {adresse: {'alive': bool, 'rtt': ms ou None, 'loss': 0.0-1.0}}.
+        Les adresses que le moteur ICMP ne peut pas traiter (sockets non autorisés,
+        IPv6) passent par la commande ping.
+        """
+        results = self.pinger.ping_many(list(ip_addresses), timeout)
+        for ip_address, result in results.items():
+            if result is None:
+                alive = self._ping_subprocess(ip_address, timeout)
+                results[ip_address] = {'alive': alive, 'rtt': None, 'loss': 0.0 if alive else 1.0}
+        return results
+    
+    def _ping_subprocess(self, ip_address, timeout=3):
+        """Teste la connectivité avec la commande ping"""
         try:
             # Paramètres ping selon l'OS
             if platform.system().lower() == "windows":
@@ -89,7 +969,7 @@ class SNMPService:
                 result = self.get_snmp_value(
                     device.ip_address,
                     self.oids['sysName'],
-                    device.snmp_community
+                    auth_data=self.auth_for(device)
                 )
                 
                 if result is not None:
@@ -127,69 +1007,56 @@ class SNMPService:
                 'message': f'Erreur de connectivité: {str(e)}'
             }
     
-    def collect_device_metrics(self, device):
-        """Collecte les métriques d'un appareil"""
+    def collect_device_metrics(self, device, ping_result=None, writer=None):
+        """Collecte les métriques d'un appareil
+        
+        `ping_result` est le résultat de ping_many pour cet appareil lorsque le
+        test de connectivité a déjà été fait par lot. Avec un `writer`
+        (MetricWriter), les échantillons et l'état de l'appareil sont mis en
+        attente pour l'écriture groupée du cycle au lieu d'être validés ici.
+        """
         metrics_collected = []
+        snmp_responding = None
         
         try:
             # Test de connectivité de base
-            if not self.ping_device(device.ip_address):
+            if ping_result is None:
+                reachable = self.ping_device(device.ip_address)
+            else:
+                reachable = ping_result['alive']
+            
+            if not reachable:
                 device.status = 'offline'
-                db.session.commit()
+                self._save_device_state(device, [], writer)
                 return {
                     'status': 'error',
                     'message': 'Appareil non accessible'
                 }
             
             if self.snmp_available:
-                # Uptime via SNMP
-                uptime = self.get_snmp_value(
-                    device.ip_address,
-                    self.oids['sysUpTime'],
-                    device.snmp_community
-                )
-                if uptime is not None:
-                    device.uptime = int(uptime)
-                    metrics_collected.append({
-                        'type': 'uptime',
-                        'value': float(uptime),
-                        'unit': 'centiseconds'
-                    })
-                
-                # CPU Usage (si disponible)
-                cpu_load = self.get_snmp_value(
-                    device.ip_address,
-                    self.oids['hrProcessorLoad'] + '.1',
-                    device.snmp_community
-                )
-                if cpu_load is not None:
-                    device.cpu_usage = float(cpu_load)
-                    metrics_collected.append({
-                        'type': 'cpu',
-                        'value': float(cpu_load),
-                        'unit': '%'
-                    })
-                
-                # Memory Usage (approximatif)
-                storage_used = self.get_snmp_value(
+                # Seuls les OIDs du profil de l'appareil, en un seul PDU GET
+                profile = self.get_poll_profile(device)
+                scalar_oids = profile['scalar_oids'] if profile else {}
+                values = self.get_snmp_values(
                     device.ip_address,
-                    self.oids['hrStorageUsed'] + '.1',
-                    device.snmp_community
-                )
-                storage_size = self.get_snmp_value(
-                    device.ip_address,
-                    self.oids['hrStorageSize'] + '.1',
-                    device.snmp_community
+                    list(scalar_oids.values()),
+                    auth_data=self.auth_for(device),
+                    fallback=False,
+                    **self._snmp_options()
                 )
+                if values and len(values) < len(scalar_oids):
+                    # L'agent ne répond plus à tout le profil : redécouverte au prochain cycle
+                    profile['stale'] = True
+                uptime = values.get(scalar_oids.get('uptime'))
+                metrics_collected.extend(self._scalar_metrics(device, scalar_oids, values))
                 
-                if storage_used is not None and storage_size is not None:
-                    memory_usage = (float(storage_used) / float(storage_size)) * 100
-                    device.memory_usage = memory_usage
-                    metrics_collected.append({
-                        'type': 'memory',
-                        'value': memory_usage,
-                        'unit': '%'
-                    })
+                # Débits par interface (GETBULK sur l'ifXTable / ifTable)
+                # inutile de parcourir les tables si l'agent n'a pas répondu au GET
+                snmp_responding = bool(values)
+                if snmp_responding and profile['interface_counter_bits']:
+                    metrics_collected.extend(
+                        self.collect_interface_metrics(device, uptime, profile['interface_counter_bits'])
+                    )
             else:
                 # Si SNMP n'est pas disponible, créer des métriques simulées
                 import random
@@ -203,40 +1070,110 @@ class SNMPService:
                     {'type': 'uptime', 'value': device.uptime, 'unit': 'centiseconds'}
                 ])
             
+            # Latence ICMP mesurée lors du test de connectivité
+            if ping_result and ping_result.get('rtt') is not None:
+                metrics_collected.append({'type': 'latency', 'value': ping_result['rtt'], 'unit': 'ms'})
+            
             # Mettre à jour le statut et la dernière vue
             device.status = 'online'
             device.last_seen = datetime.utcnow()
             device.updated_at = datetime.utcnow()
             
             # Sauvegarder les métriques dans la base de données
-            for metric_data in metrics_collected:
-                metric = DeviceMetric(
-                    device_id=device.id,
-                    metric_type=metric_data['type'],
-                    value=metric_data['value'],
-                    unit=metric_data['unit'],
-                    timestamp=datetime.utcnow()
-                )
-                db.session.add(metric)
-            
-            db.session.commit()
+            self._save_device_state(device, metrics_collected, writer)
             
             return {
                 'status': 'success',
                 'metrics_collected': len(metrics_collected),
                 'metrics': metrics_collected,
+                'snmp_responding': snmp_responding,
                 'method': 'SNMP' if self.snmp_available and len(metrics_collected) > 0 else 'Simulation'
             }
             
         except Exception as e:
             device.status = 'warning'
-            db.session.commit()
+            self._save_device_state(device, [], writer)
             print(f"Erreur lors de la collecte des métriques pour {device.name}: {e}")
             return {
                 'status': 'error',
                 'message': str(e)
             }
     
+    def _scalar_metrics(self, device, scalar_oids, values):
+        """Métriques uptime, CPU et mémoire tirées des valeurs du GET du profil
+        
+        Met à jour les colonnes correspondantes de l'appareil.
+        """
+        metrics = []
+        uptime = values.get(scalar_oids.get('uptime'))
+        # Charge moyenne de tous les processeurs découverts
+        cpu_loads = [
+            float(values[oid]) for metric, oid in scalar_oids.items()
+            if metric.startswith('cpu') and oid in values
+        ]
+        cpu_load = sum(cpu_loads) / len(cpu_loads) if cpu_loads else None
+        storage_used = values.get(scalar_oids.get('storage_used'))
+        storage_size = values.get(scalar_oids.get('storage_size'))
+        
+        # Uptime via SNMP
+        if uptime is not None:
+            device.uptime = int(uptime)
+            metrics.append({
+                'type': 'uptime',
+                'value': float(uptime),
+                'unit': 'centiseconds'
+            })
+        
+        # CPU Usage (si disponible)
+        if cpu_load is not None:
+            device.cpu_usage = float(cpu_load)
+            metrics.append({
+                'type': 'cpu',
+                'value': float(cpu_load),
+                'unit': '%'
+            })
+        
+        # Mémoire vive : ligne hrStorageRam de la hrStorageTable
+        if storage_used is not None and storage_size is not None and float(storage_size) > 0:
+            memory_usage = (float(storage_used) / float(storage_size)) * 100
+            device.memory_usage = memory_usage
+            metrics.append({
+                'type': 'memory',
+                'value': memory_usage,
+                'unit': '%'
+            })
+        
+        return metrics
+    
+    def _save_device_state(self, device, metrics, writer=None):
+        """Enregistre les métriques et l'état de l'appareil, ou les confie au tampon
+        
+        En écriture groupée, l'appareil est détaché de la session : son état en
+        mémoire reste lisible (diffusion, alertes) mais n'est écrit que par le
+        tampon, sans transaction par sonde.
+        """
+        if writer is not None:
+            with db.session.no_autoflush:
+                full = writer.record(device, metrics)
+            db.session.expunge(device)
+            if full:
+                writer.flush()
+            return
+        
+        # Un appareil jamais enregistré n'a pas de série où ranger ses échantillons
+        samples = [] if device.id is None else [
+            {
+                'device_id': device.id,
+                'metric_type': metric_data['type'],
+                'value': metric_data['value'],
+                'unit': metric_data['unit'],
+                'timestamp': datetime.utcnow()
+            }
+            for metric_data in metrics
+        ]
+        write_samples(samples)
+        db.session.commit()
+    
     def collect_all_devices_metrics(self):
         """Collecte les métriques de tous les appareils"""
         devices = Device.query.all()
@@ -250,4 +1187,15 @@ class SNMPService:
                 'result': result
             })
         
-        return results
\ No newline at end of file
+        return results
+
+
+_snmp_service = None
+
+
+def get_snmp_service():
+    """Retourne l'instance du service SNMP partagée par le processus"""
+    global _snmp_service
+    if _snmp_service is None:
+        _snmp_service = SNMPService()
+    return _snmp_service
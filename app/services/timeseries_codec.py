@@ -0,0 +1,194 @@
+"""Compression d'une série temporelle (horodatages + valeurs flottantes)
+
+Format inspiré de Gorilla (Facebook) : les horodatages (millisecondes) sont
+codés par différence de différences, les valeurs par XOR avec la valeur
+précédente. Une série collectée à intervalle régulier et dont les valeurs
+changent peu tient en quelques bits par point au lieu d'une ligne complète.
+
+En-tête : nombre de points (32 bits), premier horodatage (64 bits), première
+valeur (64 bits, IEEE 754). Puis, pour chaque point suivant :
+
+- différence de différences : '0' (nulle), '10' + 7 bits, '110' + 9 bits,
+  '1110' + 12 bits, '11110' + 32 bits, sinon '11111' + 64 bits ;
+- valeur : '0' (identique), '10' + bits significatifs dans la fenêtre
+  précédente, sinon '11' + 5 bits de zéros de tête + 6 bits de longueur +
+  bits significatifs.
+"""
+
+import struct
+
+# (préfixe, longueur du préfixe, bits de la valeur) par ordre de taille
+_DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b11110, 5, 32))
+# Bits de la différence de différences selon le nombre de '1' du préfixe
+_DOD_BITS = {1: 7, 2: 9, 3: 12, 4: 32, 5: 64}
+
+
+class _BitWriter:
+    def __init__(self):
+        self._buffer = bytearray()
+        self._accumulator = 0
+        self._bits = 0
+
+    def write(self, value, nbits):
+        self._accumulator = (self._accumulator << nbits) | (value & ((1 << nbits) - 1))
+        self._bits += nbits
+        while self._bits >= 8:
+            self._bits -= 8
+            self._buffer.append((self._accumulator >> self._bits) & 0xFF)
+        self._accumulator &= (1 << self._bits) - 1
+
+    def getvalue(self):
+        if self._bits:
+            return bytes(self._buffer) + bytes([(self._accumulator << (8 - self._bits)) & 0xFF])
+        return bytes(self._buffer)
+
+
+def _signed(value, nbits):
+    return value - (1 << nbits) if value >= 1 << (nbits - 1) else value
+
+
+def _float_bits(value):
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+
+class SeriesEncoder:
+    """Encodeur incrémental d'une série
+
+    Les points ajoutés par extend() prolongent le flux de bits déjà écrit :
+    un bloc ouvert se complète sans décoder ni réencoder ses points. Les
+    points doivent arriver triés par horodatage.
+    """
+
+    def __init__(self):
+        self._writer = _BitWriter()
+        self.count = 0
+        self.first_timestamp = self.last_timestamp = None
+        self._previous_value = 0
+        self._previous_delta = 0
+        self._leading = self._trailing = None
+
+    def extend(self, timestamps, values):
+        if len(timestamps) != len(values):
+            raise ValueError('Horodatages et valeurs de longueurs différentes')
+        if not len(timestamps):
+            return self
+        writer = self._writer
+        start = 0
+        if self.count == 0:
+            self.first_timestamp = self.last_timestamp = int(timestamps[0])
+            self._previous_value = _float_bits(float(values[0]))
+            writer.write(self.first_timestamp, 64)
+            writer.write(self._previous_value, 64)
+            start = 1
+
+        previous_ts, previous_delta = self.last_timestamp, self._previous_delta
+        previous_value, leading, trailing = self._previous_value, self._leading, self._trailing
+        for timestamp, value in zip(timestamps[start:], values[start:]):
+            timestamp = int(timestamp)
+            delta = timestamp - previous_ts
+            dod = delta - previous_delta
+            if dod == 0:
+                writer.write(0, 1)
+            else:
+                for prefix, prefix_bits, nbits in _DOD_BUCKETS:
+                    if -(1 << (nbits - 1)) <= dod < 1 << (nbits - 1):
+                        writer.write(prefix, prefix_bits)
+                        writer.write(dod, nbits)
+                        break
+                else:
+                    writer.write(0b11111, 5)
+                    writer.write(dod, 64)
+            previous_ts, previous_delta = timestamp, delta
+
+            bits = _float_bits(float(value))
+            xor = bits ^ previous_value
+            previous_value = bits
+            if xor == 0:
+                writer.write(0, 1)
+                continue
+            current_leading = min(64 - xor.bit_length(), 31)
+            current_trailing = (xor & -xor).bit_length() - 1
+            if leading is not None and current_leading >= leading and current_trailing >= trailing:
+                writer.write(0b10, 2)
+                writer.write(xor >> trailing, 64 - leading - trailing)
+            else:
+                leading, trailing = current_leading, current_trailing
+                significant = 64 - leading - trailing
+                writer.write(0b11, 2)
+                writer.write(leading, 5)
+                writer.write(significant & 0x3F, 6)  # 64 codé 0
+                writer.write(xor >> trailing, significant)
+
+        self.count += len(timestamps)
+        self.last_timestamp, self._previous_delta = previous_ts, previous_delta
+        self._previous_value, self._leading, self._trailing = previous_value, leading, trailing
+        return self
+
+    def getvalue(self):
+        # Le nombre de points (32 bits) occupe exactement les 4 premiers octets
+        return struct.pack('>I', self.count) + self._writer.getvalue()
+
+
+def encode_series(timestamps, values):
+    """Compresse une série triée par horodatage (entiers en ms, flottants)"""
+    return SeriesEncoder().extend(timestamps, values).getvalue()
+
+
+def decode_series(data):  # noqa: C901 (boucle de décodage gardée d'un seul tenant pour la vitesse)
+    """Décompresse un bloc : retourne (horodatages en ms, valeurs) en listes"""
+    if len(data) < 4:
+        raise ValueError('Bloc de série tronqué')
+    # Lecture sur la représentation binaire textuelle du bloc : découpage et
+    # int(..., 2) sont bien plus rapides en Python que des décalages bit à bit
+    bits = format(int.from_bytes(data, 'big'), f'0{len(data) * 8}b')
+    count = int(bits[:32], 2)
+    timestamps, words = [], []
+    if not count:
+        return timestamps, []
+    if len(bits) < 160:
+        raise ValueError('Bloc de série tronqué')
+
+    timestamp = _signed(int(bits[32:96], 2), 64)
+    value = int(bits[96:160], 2)
+    timestamps.append(timestamp)
+    words.append(value)
+    position = 160
+    delta = 0
+    leading = trailing = 0
+    try:
+        for _ in range(count - 1):
+            if bits[position] == '0':
+                position += 1
+            else:
+                # Préfixe '10', '110', '1110', '11110' ou '11111'
+                ones = 1
+                while ones < 5 and bits[position + ones] == '1':
+                    ones += 1
+                nbits = _DOD_BITS[ones]
+                position += ones + (ones < 5)
+                delta += _signed(int(bits[position:position + nbits], 2), nbits)
+                position += nbits
+            timestamp += delta
+            timestamps.append(timestamp)
+
+            if bits[position] == '0':
+                position += 1
+            else:
+                if bits[position + 1] == '1':
+                    leading = int(bits[position + 2:position + 7], 2)
+                    significant = int(bits[position + 7:position + 13], 2) or 64
+                    trailing = 64 - leading - significant
+                    position += 13
+                else:
+                    significant = 64 - leading - trailing
+                    position += 2
+                if position + significant > len(bits):
+                    raise IndexError
+                value ^= int(bits[position:position + significant], 2) << trailing
+                position += significant
+            words.append(value)
+    except (IndexError, ValueError):
+        raise ValueError('Bloc de série tronqué')
+
+    # Conversion des mots de 64 bits en flottants en une seule passe
+    return timestamps, list(struct.unpack(f'>{count}d', struct.pack(f'>{count}Q', *words)))
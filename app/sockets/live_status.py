@@ -4,6 +4,12 @@ from app import socketio
 from app.models.device import Device
 import json
 
+def _device_states():
+    """État courant tenu en mémoire par le planificateur de ce processus"""
+    # Import tardif : app.tasks.scheduler importe ce module
+    from app import scheduler
+    return scheduler.device_states
+
 @socketio.on('connect')
 def handle_connect():
     """Gère les nouvelles connexions WebSocket"""
@@ -21,9 +27,13 @@ def handle_join_monitoring():
     join_room('monitoring')
     emit('status', {'message': 'Surveillance en temps réel activée'})
     
-    # Envoyer l'état actuel de tous les appareils
-    devices = Device.query.all()
-    devices_data = [device.to_dict() for device in devices]
+    # Envoyer l'état actuel de tous les appareils : depuis la mémoire lorsque ce
+    # processus sonde tout le parc, sinon depuis la base complétée par la mémoire
+    device_states = _device_states()
+    if device_states.complete:
+        devices_data = device_states.snapshot()
+    else:
+        devices_data = [device_states.overlay(device.to_dict()) for device in Device.query.all()]
     emit('devices_update', devices_data)
 
 @socketio.on('leave_monitoring')
@@ -37,9 +47,13 @@ def handle_request_device_status(data):
     """Demande de statut pour un appareil spécifique"""
     device_id = data.get('device_id')
     if device_id:
-        device = Device.query.get(device_id)
-        if device:
-            emit('device_status', device.to_dict())
+        device_states = _device_states()
+        cached = device_states.get(device_id) if device_states.complete else None
+        device = None if cached else Device.query.get(device_id)
+        if cached:
+            emit('device_status', cached)
+        elif device:
+            emit('device_status', device_states.overlay(device.to_dict()))
         else:
             emit('error', {'message': 'Appareil non trouvé'})
     else:
@@ -1,12 +1,263 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from app.services.snmp import SNMPService
+from app.services.snmp import get_snmp_service, probe_deadline
 from app.services.notifier import NotificationService
-from app.models.device import Device
+from app.services.device_state import DEVICE_FIELDS, DEVICE_STATE_COLUMNS
+from app.services.fleet_stats import fleet_stats, status_counts
+from app.services.metric_writer import MetricWriter
+from app.services.retention import MetricRetention, retention_policies
+from app.tasks.sharding import ShardCoordinator
+from app.models.device import Device, db
+from app.models.fleet_version import set_fleet_writer
 from app.sockets.live_status import broadcast_device_update, broadcast_devices_stats, broadcast_alert
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import atexit
+import heapq
 import logging
+import random
+import threading
+import time
+
+
+class DeviceBackoff:
+    """Suivi des échecs par appareil avec backoff exponentiel (disjoncteur)
+    
+    Après `threshold` échecs consécutifs, l'appareil passe à l'état dégradé : il
+    n'est plus sondé avant l'échéance du backoff, qui double à chaque nouvel
+    échec jusqu'à `max_delay`. À l'échéance, une sonde de vie d'un seul paquet
+    décide si l'appareil revient à la collecte normale.
+    """
+    
+    def __init__(self, base_delay=30, threshold=3, max_delay=1800):
+        self.base_delay = base_delay
+        self.threshold = threshold
+        self.max_delay = max_delay
+        self._states = {}
+        self._lock = threading.Lock()
+        # Change à chaque modification d'un état exposé (ETag de l'API)
+        self.version = 0
+    
+    def is_degraded(self, device_id):
+        state = self._states.get(device_id)
+        return bool(state and state['failures'] >= self.threshold)
+    
+    def is_waiting(self, device_id, now=None):
+        """Indique si l'appareil est dégradé et que son backoff n'est pas échu"""
+        state = self._states.get(device_id)
+        if not state or state['next_probe_at'] is None:
+            return False
+        return (now or datetime.utcnow()) < state['next_probe_at']
+    
+    def remaining(self, device_id, now=None):
+        """Secondes restantes avant l'échéance du backoff (0 si l'appareil peut être sondé)"""
+        state = self._states.get(device_id)
+        if not state or state['next_probe_at'] is None:
+            return 0.0
+        return max(0.0, (state['next_probe_at'] - (now or datetime.utcnow())).total_seconds())
+    
+    def record_failure(self, device_id, reason, now=None):
+        """Enregistre un échec et retourne le nombre d'échecs consécutifs"""
+        now = now or datetime.utcnow()
+        with self._lock:
+            state = self._states.setdefault(device_id, {'failures': 0, 'next_probe_at': None, 'reason': None})
+            state['failures'] += 1
+            state['reason'] = reason
+            self.version += 1
+            if state['failures'] >= self.threshold:
+                delay = min(self.base_delay * 2 ** (state['failures'] - self.threshold), self.max_delay)
+                state['next_probe_at'] = now + timedelta(seconds=delay)
+            return state['failures']
+    
+    def record_success(self, device_id):
+        """Retour à la collecte normale"""
+        with self._lock:
+            if self._states.pop(device_id, None) is not None:
+                self.version += 1
+    
+    def forget(self, device_id):
+        self.record_success(device_id)
+    
+    def get_state(self, device_id):
+        """État de backoff exposé par l'API"""
+        state = self._states.get(device_id)
+        if not state:
+            return {'state': 'normal', 'consecutive_failures': 0, 'next_probe_at': None, 'reason': None}
+        next_probe_at = state['next_probe_at']
+        return {
+            'state': 'degraded' if state['failures'] >= self.threshold else 'normal',
+            'consecutive_failures': state['failures'],
+            'next_probe_at': next_probe_at.isoformat() if next_probe_at else None,
+            'reason': state['reason']
+        }
+
+
+class PollQueue:
+    """File de priorité des prochaines échéances de collecte, par appareil
+    
+    Chaque appareil a son propre intervalle (selon son device_type). À son
+    arrivée dans la file, sa première échéance est tirée au hasard dans
+    l'intervalle pour répartir la charge ; les suivantes sont espacées d'un
+    intervalle exact. Les horodatages sont ceux de time.monotonic().
+    """
+    
+    def __init__(self, default_interval=30, type_intervals=None):
+        self.default_interval = default_interval
+        self.type_intervals = dict(type_intervals or {})
+        self._heap = []
+        # device_id -> {'due', 'interval', 'ip_address', 'device_type'}
+        self._entries = {}
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, device_id):
+        return device_id in self._entries
+    
+    def interval_for(self, device_type):
+        return self.type_intervals.get(device_type, self.default_interval)
+    
+    def sync(self, devices, now=None):
+        """Aligne la file sur le parc : [(device_id, device_type, ip_address), ...]"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            seen = set()
+            for device_id, device_type, ip_address in devices:
+                seen.add(device_id)
+                interval = self.interval_for(device_type)
+                entry = self._entries.get(device_id)
+                if entry is None:
+                    self._entries[device_id] = {
+                        'due': now + random.uniform(0, interval),
+                        'interval': interval,
+                        'ip_address': ip_address,
+                        'device_type': device_type
+                    }
+                    heapq.heappush(self._heap, (self._entries[device_id]['due'], device_id))
+                else:
+                    entry['interval'] = interval
+                    entry['ip_address'] = ip_address
+                    entry['device_type'] = device_type
+            
+            for device_id in [device_id for device_id in self._entries if device_id not in seen]:
+                del self._entries[device_id]
+    
+    def remove(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+    
+    def pop_due(self, now=None):
+        """Retire et retourne les appareils échus : [(device_id, entrée), ...]
+        
+        Un appareil retiré n'est replanifié qu'à l'appel de reschedule().
+        """
+        now = time.monotonic() if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due_at, device_id = heapq.heappop(self._heap)
+                entry = self._entries.get(device_id)
+                # Entrée obsolète (appareil retiré ou déjà replanifié)
+                if entry is None or entry['due'] != due_at or entry.get('in_flight'):
+                    continue
+                entry['in_flight'] = True
+                due.append((device_id, entry))
+        return due
+    
+    def reschedule(self, device_id, now=None, at=None):
+        """Planifie la prochaine échéance d'un appareil après sa collecte
+        
+        Si la sonde a débordé sur les échéances suivantes, celles-ci sont
+        fusionnées plutôt que rattrapées en rafale. `at` impose l'échéance
+        (fin de backoff). Retourne (échéance, nombre d'échéances manquées).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is None:
+                return None, 0
+            entry['in_flight'] = False
+            next_due = entry['due'] + entry['interval'] if at is None else at
+            missed = 0
+            if at is None and next_due <= now:
+                missed = int((now - next_due) // entry['interval']) + 1
+                next_due += missed * entry['interval']
+            entry['due'] = next_due
+            heapq.heappush(self._heap, (entry['due'], device_id))
+            return entry['due'], missed
+    
+    def seconds_until_next(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - now)
+
+
+class PollTelemetry:
+    """Télémétrie de l'ordonnancement : retard, dépassements, appareils sautés"""
+    
+    def __init__(self, window=1000):
+        self._lags = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.counters = {
+            'probes': 0,
+            'overruns': 0,
+            'missed_slots': 0,
+            'deadline_exceeded': 0,
+            'backoff_skipped': 0,
+            'cycles_skipped': 0
+        }
+        self.in_flight = 0
+        self.last_tick = None
+    
+    def increment(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+    
+    def probe_queued(self):
+        with self._lock:
+            self.in_flight += 1
+    
+    def probe_finished(self):
+        with self._lock:
+            self.in_flight -= 1
+    
+    def probe_started(self, lag):
+        """Une sonde démarre avec `lag` secondes de retard sur son échéance"""
+        with self._lock:
+            self._lags.append(max(0.0, lag))
+            self.counters['probes'] += 1
+    
+    def record_tick(self, due_count):
+        self.last_tick = {
+            'at': datetime.utcnow().isoformat(),
+            'due': due_count,
+            'in_flight': self.in_flight
+        }
+    
+    def snapshot(self):
+        with self._lock:
+            lags = sorted(self._lags)
+            counters = dict(self.counters)
+        
+        def percentile(p):
+            return round(lags[min(len(lags) - 1, int(p * len(lags)))], 3) if lags else None
+        
+        return {
+            'counters': counters,
+            'in_flight': self.in_flight,
+            'lag': {
+                'samples': len(lags),
+                'p50': percentile(0.50),
+                'p99': percentile(0.99),
+                'max': round(lags[-1], 3) if lags else None
+            },
+            'last_tick': self.last_tick
+        }
+
 
 class MonitoringScheduler:
     """Planificateur pour les tâches de surveillance automatique"""
@@ -14,18 +265,50 @@ class MonitoringScheduler:
     def __init__(self, app=None):
         self.scheduler = None
         self.app = app
-        self.snmp_service = SNMPService()
+        self.snmp_service = get_snmp_service()
         self.notification_service = NotificationService()
         self.logger = logging.getLogger(__name__)
         
         # Garder trace des états précédents pour détecter les changements
         self.previous_device_states = {}
         
+        # Résumé du dernier cycle de collecte (durée, nombre d'appareils)
+        self.last_cycle = None
+        
+        # Résumé de la dernière purge des métriques expirées
+        self.last_cleanup = None
+        
+        # Backoff des appareils qui échouent de manière répétée
+        self.backoff = DeviceBackoff()
+        
+        # Échéances de collecte par appareil et pool de sondes persistant
+        self.poll_queue = PollQueue()
+        self.executor = None
+        self.queue_refresh_interval = 30
+        self._last_queue_refresh = None
+        self._atexit_registered = False
+        
+        # Retard d'ordonnancement et dépassements, échéance dure par sonde
+        self.telemetry = PollTelemetry()
+        self.device_deadline = 25
+        self._cycle_lock = threading.Lock()
+        
+        # Répartition du parc entre plusieurs processus (None : ce processus sonde tout)
+        self.coordinator = None
+        self._probing = set()
+        
+        # Échantillons et états des sondes écrits par lots (une transaction par lot)
+        self.metric_writer = MetricWriter()
+        # État courant des appareils sondés, lu par l'API et Socket.IO sans passer par la base
+        self.device_states = self.metric_writer.state_store
+        
         if app:
             self.init_app(app)
     
     def init_app(self, app):
         """Initialise le planificateur avec l'application Flask"""
+        # Réinitialisation : ne pas laisser tourner le planificateur précédent
+        self.shutdown()
         self.app = app
         
         with app.app_context():
@@ -33,22 +316,65 @@ class MonitoringScheduler:
             
             # Planifier la collecte des métriques
             monitoring_interval = app.config.get('MONITORING_INTERVAL', 30)
+            self.backoff = DeviceBackoff(
+                base_delay=monitoring_interval,
+                threshold=app.config.get('POLL_BACKOFF_THRESHOLD', 3),
+                max_delay=app.config.get('POLL_BACKOFF_MAX_DELAY', 1800)
+            )
+            self.poll_queue = PollQueue(
+                default_interval=monitoring_interval,
+                type_intervals=app.config.get('POLL_INTERVALS')
+            )
+            self.queue_refresh_interval = min(monitoring_interval, 30)
+            self.device_deadline = app.config.get('POLL_DEVICE_DEADLINE', 25)
+            self.metric_writer.configure(
+                batch_size=app.config.get('METRIC_BATCH_SIZE', 500),
+                flush_interval=app.config.get('METRIC_FLUSH_INTERVAL', 5),
+                max_pending=app.config.get('METRIC_QUEUE_MAX', 50000),
+                policy=app.config.get('METRIC_QUEUE_POLICY', 'block'),
+                block_timeout=app.config.get('METRIC_QUEUE_BLOCK_TIMEOUT', 1.0)
+            )
+            self.device_states.configure(
+                flush_interval=app.config.get('DEVICE_STATE_FLUSH_INTERVAL', 60),
+                tolerance=app.config.get('DEVICE_STATE_TOLERANCE', 1.0),
+                max_staleness=app.config.get('DEVICE_STATE_MAX_STALENESS', 300)
+            )
+            
+            if app.config.get('POLLER_SHARDING_ENABLED'):
+                self.coordinator = ShardCoordinator(
+                    worker_id=app.config.get('POLLER_WORKER_ID'),
+                    lease_ttl=app.config.get('POLLER_LEASE_TTL', 30)
+                )
+                # Compteurs de version propres à ce processus (pas de ligne partagée entre pollers)
+                set_fleet_writer(self.coordinator.worker_id)
+                # Le rééquilibrage se fait au rythme du heartbeat
+                self.queue_refresh_interval = min(
+                    self.queue_refresh_interval, app.config.get('POLLER_HEARTBEAT_INTERVAL', 10)
+                )
+                self.logger.info(f"Collecte répartie activée (processus {self.coordinator.worker_id})")
+            self.executor = ThreadPoolExecutor(
+                max_workers=app.config.get('POLLING_MAX_WORKERS', 20), thread_name_prefix='poller'
+            )
+            
+            # Tick régulier : les appareils échus sont sondés, chacun à son rythme
             self.scheduler.add_job(
-                func=self.collect_all_metrics,
-                trigger=IntervalTrigger(seconds=monitoring_interval),
+                func=self.poll_due_devices,
+                trigger=IntervalTrigger(seconds=app.config.get('POLL_TICK_INTERVAL', 1)),
                 id='collect_metrics',
                 name='Collecte des métriques',
+                max_instances=1,
+                coalesce=True,
                 replace_existing=True
             )
             
-            # Planifier le nettoyage des anciennes métriques (tous les jours à 2h)
+            # Purge incrémentale des métriques expirées, bornée à chaque passage
             self.scheduler.add_job(
                 func=self.cleanup_old_metrics,
-                trigger='cron',
-                hour=2,
-                minute=0,
+                trigger=IntervalTrigger(seconds=app.config.get('RETENTION_INTERVAL', 3600)),
                 id='cleanup_metrics',
                 name='Nettoyage des métriques',
+                max_instances=1,
+                coalesce=True,
                 replace_existing=True
             )
             
@@ -63,66 +389,252 @@ class MonitoringScheduler:
                 replace_existing=True
             )
             
+            # Écriture différée : les sondes déposent, un thread dédié écrit
+            self.metric_writer.start(app)
             self.scheduler.start()
             self.logger.info("Planificateur de surveillance démarré")
             
             # Arrêter le planificateur à la fermeture de l'application
-            atexit.register(lambda: self.scheduler.shutdown())
+            if not self._atexit_registered:
+                atexit.register(self.shutdown)
+                self._atexit_registered = True
+    
+    def shutdown(self):
+        """Arrête le planificateur et le pool de sondes, écrit les métriques en attente, libère les baux"""
+        if self.scheduler and self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        # Vide la file d'écriture avant de rendre la main
+        self.metric_writer.stop()
+        if self.app:
+            with self.app.app_context():
+                self.metric_writer.flush()
+        if self.coordinator and self.app:
+            with self.app.app_context():
+                self.coordinator.release_all()
+            self.coordinator = None
+            set_fleet_writer()
+    
+    def poll_due_devices(self):
+        """Tick du planificateur : lance la collecte des appareils arrivés à échéance"""
+        if not self.app or not self.executor:
+            return
+        
+        now = time.monotonic()
+        with self.app.app_context():
+            try:
+                if self._last_queue_refresh is None or now - self._last_queue_refresh >= self.queue_refresh_interval:
+                    self._refresh_poll_queue()
+                    self._last_queue_refresh = now
+            except Exception as e:
+                self.logger.error(f"Erreur lors de la mise à jour de la file de collecte: {e}")
+            
+            # Sans thread d'écriture : échantillons en attente depuis plus de METRIC_FLUSH_INTERVAL
+            self.metric_writer.flush_if_due(now)
+        
+        due = self.poll_queue.pop_due(now)
+        self.telemetry.record_tick(len(due))
+        if due:
+            self.executor.submit(self._poll_batch, due)
+    
+    def _refresh_poll_queue(self):
+        """Synchronise la file et l'état en mémoire avec la table des appareils, diffuse les statistiques"""
+        devices = db.session.query(
+            *(getattr(Device, column) for column in DEVICE_FIELDS + DEVICE_STATE_COLUMNS)
+        ).all()
+        if self.coordinator:
+            owned = self.coordinator.rebalance([device.id for device in devices], in_flight=set(self._probing))
+            devices = [device for device in devices if device.id in owned]
+        self.poll_queue.sync([(device.id, device.device_type, device.ip_address) for device in devices])
+        self.device_states.sync(devices, complete=self.coordinator is None)
+        
+        # Statut en mémoire pour les appareils sondés ici, en base pour les autres
+        broadcast_devices_stats(status_counts(self.device_states))
+    
+    def _poll_batch(self, due):
+        """Ping groupé des appareils échus, puis une sonde par appareil dans le pool
+        
+        Les appareils en backoff ne sont ni pingés ni sondés : ils sont
+        replanifiés à l'échéance de leur backoff.
+        """
+        probes = []
+        for device_id, entry in due:
+            wait = self.backoff.remaining(device_id)
+            if wait:
+                self.poll_queue.reschedule(device_id, at=time.monotonic() + wait)
+            else:
+                probes.append((device_id, entry))
+        if not probes:
+            return
+        
+        try:
+            ping_results = self.snmp_service.ping_many([entry['ip_address'] for _, entry in probes])
+        except Exception as e:
+            self.logger.error(f"Erreur lors du ping groupé: {e}")
+            ping_results = {}
+        
+        for device_id, entry in probes:
+            self.telemetry.probe_queued()
+            self.executor.submit(
+                self._probe_due_device, device_id, entry['due'], entry['interval'], ping_results.get(entry['ip_address'])
+            )
+    
+    def _probe_due_device(self, device_id, due, interval, ping_result):
+        """Sonde un appareil échu sous échéance dure, puis le replanifie"""
+        started = time.monotonic()
+        self.telemetry.probe_started(started - due)
+        deadline = min(self.device_deadline, interval) if self.device_deadline else interval
+        self._probing.add(device_id)
+        try:
+            # Bail perdu depuis la planification (heartbeat en échec, rééquilibrage)
+            if self.coordinator and not self.coordinator.owns(device_id):
+                return
+            with probe_deadline(deadline):
+                _, probed = self._poll_device(device_id, ping_result)
+            if not probed:
+                self.telemetry.increment('backoff_skipped')
+            if time.monotonic() - started > deadline:
+                self.telemetry.increment('deadline_exceeded')
+        finally:
+            self._probing.discard(device_id)
+            self.telemetry.probe_finished()
+            _, missed = self.poll_queue.reschedule(device_id)
+            if missed:
+                self.telemetry.increment('overruns')
+                self.telemetry.increment('missed_slots', missed)
     
     def collect_all_metrics(self):
-        """Collecte les métriques de tous les appareils"""
+        """Collecte les métriques de tous les appareils (sondes exécutées en parallèle)"""
         if not self.app:
             return
         
+        # Un cycle complet encore en cours : on ne l'empile pas
+        if not self._cycle_lock.acquire(blocking=False):
+            self.telemetry.increment('cycles_skipped')
+            self.logger.warning("Cycle de collecte précédent toujours en cours, cycle ignoré")
+            return
+        
         with self.app.app_context():
             try:
-                devices = Device.query.all()
-                online_count = 0
-                offline_count = 0
-                warning_count = 0
-                
-                for device in devices:
-                    previous_status = self.previous_device_states.get(device.id)
-                    
-                    # Collecter les métriques
-                    result = self.snmp_service.collect_device_metrics(device)
-                    
-                    # Vérifier les changements d'état
-                    current_status = device.status
-                    
-                    if previous_status and previous_status != current_status:
-                        self._handle_status_change(device, previous_status, current_status)
-                    
-                    # Vérifier les seuils d'alerte
-                    self._check_alert_thresholds(device)
-                    
-                    # Compter les statuts
-                    if current_status == 'online':
-                        online_count += 1
-                    elif current_status == 'offline':
-                        offline_count += 1
-                    elif current_status == 'warning':
-                        warning_count += 1
-                    
-                    # Mettre à jour l'état précédent
-                    self.previous_device_states[device.id] = current_status
-                    
-                    # Diffuser la mise à jour en temps réel
-                    broadcast_device_update(device)
-                
-                # Diffuser les statistiques mises à jour
-                stats = {
-                    'total': len(devices),
-                    'online': online_count,
-                    'offline': offline_count,
-                    'warning': warning_count
-                }
-                broadcast_devices_stats(stats)
+                started = time.monotonic()
+                targets = db.session.query(Device.id, Device.ip_address).all()
+                if self.coordinator:
+                    targets = [target for target in targets if self.coordinator.owns(target.id)]
+                device_ids = [device_id for device_id, _ in targets]
+                
+                # Appareils en backoff : ni ping ni sonde avant l'échéance
+                targets = [target for target in targets if not self.backoff.is_waiting(target.id)]
+                skipped = len(device_ids) - len(targets)
+                
+                # Test de connectivité de tout le parc en un seul lot ICMP
+                ping_results = self.snmp_service.ping_many([ip_address for _, ip_address in targets])
                 
-                self.logger.info(f"Métriques collectées pour {len(devices)} appareils")
+                max_workers = max(1, min(self.app.config.get('POLLING_MAX_WORKERS', 20), len(device_ids) or 1))
+                with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='poller') as executor:
+                    futures = [
+                        executor.submit(self._poll_device_with_deadline, device_id, ping_results.get(ip_address))
+                        for device_id, ip_address in targets
+                    ]
+                    for future in as_completed(futures):
+                        _, probed = future.result()
+                        if not probed:
+                            skipped += 1
+                
+                # Une écriture groupée pour la fin du cycle
+                self.metric_writer.request_flush()
+                
+                # Diffuser les statistiques mises à jour (parc entier, état en mémoire compris)
+                broadcast_devices_stats(status_counts(self.device_states))
+                
+                duration = time.monotonic() - started
+                overrun = duration > self.app.config.get('MONITORING_INTERVAL', 30)
+                if overrun:
+                    self.telemetry.increment('overruns')
+                self.last_cycle = {
+                    'finished_at': datetime.utcnow().isoformat(),
+                    'duration': round(duration, 3),
+                    'devices': len(device_ids),
+                    'backoff_skipped': skipped,
+                    'overrun': overrun,
+                    'workers': max_workers
+                }
+                self.logger.info(
+                    f"Métriques collectées pour {len(device_ids)} appareils en {duration:.2f}s "
+                    f"({max_workers} sondes en parallèle)"
+                )
                 
             except Exception as e:
                 self.logger.error(f"Erreur lors de la collecte des métriques: {e}")
+            finally:
+                self._cycle_lock.release()
+    
+    def _poll_device_with_deadline(self, device_id, ping_result=None):
+        with probe_deadline(self.device_deadline):
+            return self._poll_device(device_id, ping_result)
+    
+    def _poll_device(self, device_id, ping_result=None):
+        """Sonde un appareil dans son propre contexte applicatif
+        
+        Retourne (statut, sondé) ; sondé vaut False si l'appareil a été laissé de
+        côté parce qu'il est en backoff.
+        """
+        with self.app.app_context():
+            try:
+                device = db.session.get(Device, device_id)
+                if device is None:
+                    return None, False
+                # La base peut être en retard sur l'état en mémoire (écritures différées)
+                self.device_states.apply(device)
+                
+                # Appareil en backoff : rien à faire avant l'échéance
+                if self.backoff.is_waiting(device.id):
+                    return device.status, False
+                
+                # Backoff échu : sonde de vie d'un seul paquet avant la collecte complète ;
+                # son résultat tient lieu de test de connectivité (hors ligne sans collecte SNMP)
+                if self.backoff.is_degraded(device.id):
+                    alive = self.snmp_service.probe_liveness(device, ping_result)
+                    ping_result = {'alive': alive, 'rtt': None, 'loss': 0.0 if alive else 1.0}
+                
+                previous_status = self.previous_device_states.get(device.id)
+                
+                # Collecter les métriques
+                result = self.snmp_service.collect_device_metrics(device, ping_result, writer=self.metric_writer)
+                self._record_probe_result(device, result)
+                
+                # Vérifier les changements d'état
+                current_status = device.status
+                
+                if previous_status and previous_status != current_status:
+                    self._handle_status_change(device, previous_status, current_status)
+                
+                # Vérifier les seuils d'alerte
+                self._check_alert_thresholds(device)
+                
+                # Mettre à jour l'état précédent
+                self.previous_device_states[device.id] = current_status
+                
+                # Diffuser la mise à jour en temps réel
+                broadcast_device_update(device)
+                
+                return current_status, True
+                
+            except Exception as e:
+                self.logger.error(f"Erreur lors de la sonde de l'appareil {device_id}: {e}")
+                return None, True
+    
+    def _record_probe_result(self, device, result):
+        """Met à jour le backoff de l'appareil selon le résultat de la collecte"""
+        # Un appareil qui répond au ping est en ligne, même sans réponse SNMP
+        if result.get('status') == 'success':
+            self.backoff.record_success(device.id)
+            return
+        
+        reason = 'unreachable' if device.status == 'offline' else 'error'
+        failures = self.backoff.record_failure(device.id, reason)
+        if failures == self.backoff.threshold:
+            self.logger.info(f"Appareil {device.name} en backoff après {failures} échecs ({reason})")
     
     def _handle_status_change(self, device, previous_status, current_status):
         """Gère les changements d'état d'un appareil"""
@@ -149,25 +661,48 @@ class MonitoringScheduler:
             broadcast_alert('warning', f"Utilisation mémoire élevée sur {device.name}: {device.memory_usage}%", device)
     
     def cleanup_old_metrics(self):
-        """Nettoie les anciennes métriques (garde 30 jours)"""
+        """Purge les métriques expirées selon les politiques de rétention
+        
+        Échantillons bruts METRIC_RETENTION_DAYS jours, agrégats selon
+        ROLLUP_RETENTION, précisés par métrique dans METRIC_RETENTION_POLICIES.
+        Suppression par lots bornés (DELETE par clé primaire, une transaction
+        par lot) avec une pause entre les lots pour ne pas bloquer l'écriture
+        des sondes ; chaque passage s'arrête après RETENTION_MAX_ROWS lignes
+        ou RETENTION_MAX_DURATION secondes, le suivant reprend.
+        """
         if not self.app:
             return
         
         with self.app.app_context():
             try:
-                from app.models.device import DeviceMetric, db
-                
-                # Supprimer les métriques de plus de 30 jours
-                cutoff_date = datetime.utcnow() - timedelta(days=30)
-                old_metrics = DeviceMetric.query.filter(DeviceMetric.timestamp < cutoff_date).all()
+                config = self.app.config
+                policies = retention_policies(
+                    config.get('METRIC_RETENTION_DAYS', 30),
+                    config.get('ROLLUP_RETENTION'),
+                    config.get('METRIC_RETENTION_POLICIES')
+                )
+                retention = MetricRetention(
+                    chunk_size=config.get('RETENTION_CHUNK_SIZE', 5000),
+                    pause=config.get('RETENTION_CHUNK_PAUSE', 0.1),
+                    policies=policies
+                )
+                result = retention.purge(
+                    max_duration=config.get('RETENTION_MAX_DURATION'),
+                    max_rows=config.get('RETENTION_MAX_ROWS')
+                )
                 
-                for metric in old_metrics:
-                    db.session.delete(metric)
-                
-                db.session.commit()
-                self.logger.info(f"Nettoyage terminé: {len(old_metrics)} anciennes métriques supprimées")
+                self.last_cleanup = dict(result, finished_at=datetime.utcnow().isoformat(), policies=dict(policies))
+                self.logger.info(
+                    f"Nettoyage terminé: {result['deleted']} anciennes métriques, "
+                    f"{result['deleted_blocks']} blocs compressés et "
+                    f"{sum(result['deleted_rollups'].values())} agrégats supprimés "
+                    f"({result['compacted']} échantillons agrégés avant suppression) "
+                    f"en {result['chunks']} lots ({result['duration']:.2f}s)"
+                    + ("" if result['complete'] else ", reste à purger au prochain passage")
+                )
                 
             except Exception as e:
+                db.session.rollback()
                 self.logger.error(f"Erreur lors du nettoyage des métriques: {e}")
     
     def send_daily_report(self):
@@ -177,14 +712,7 @@ class MonitoringScheduler:
         
         with self.app.app_context():
             try:
-                devices = Device.query.all()
-                
-                stats = {
-                    'total': len(devices),
-                    'online': len([d for d in devices if d.status == 'online']),
-                    'offline': len([d for d in devices if d.status == 'offline']),
-                    'warning': len([d for d in devices if d.status == 'warning'])
-                }
+                stats = fleet_stats(self.device_states)
                 
                 self.notification_service.send_daily_report(stats)
                 self.logger.info("Rapport quotidien envoyé")
@@ -202,6 +730,11 @@ class MonitoringScheduler:
     
     def remove_device_monitoring(self, device_id):
         """Retire un appareil de la surveillance"""
+        self.device_states.forget(device_id)
+        self.snmp_service.rate_tracker.forget(device_id)
+        self.snmp_service.forget_profile(device_id)
+        self.backoff.forget(device_id)
+        self.poll_queue.remove(device_id)
         if device_id in self.previous_device_states:
             del self.previous_device_states[device_id]
             self.logger.info(f"Appareil {device_id} retiré de la surveillance")
@@ -211,6 +744,11 @@ class MonitoringScheduler:
         if self.scheduler:
             return {
                 'running': self.scheduler.running,
+                'last_cycle': self.last_cycle,
+                'last_cleanup': self.last_cleanup,
+                'polling': self.telemetry.snapshot(),
+                'sharding': self.coordinator.get_status() if self.coordinator else None,
+                'writes': self.metric_writer.get_status(),
                 'jobs': [
                     {
                         'id': job.id,
@@ -220,4 +758,10 @@ class MonitoringScheduler:
                     for job in self.scheduler.get_jobs()
                 ]
             }
-        return {'running': False, 'jobs': []}
\ No newline at end of file
+        return {
+            'running': False,
+            'last_cycle': self.last_cycle,
+            'last_cleanup': self.last_cleanup,
+            'polling': self.telemetry.snapshot(),
+            'jobs': []
+        }
@@ -0,0 +1,163 @@
+from app.models.device import Device, db
+from app.models.fleet_version import forget_fleet_writers
+from app.models.poller import PollerWorker, DeviceLease
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import IntegrityError
+import hashlib
+import logging
+import os
+import socket
+
+
+class ShardCoordinator:
+    """Répartition des appareils entre plusieurs processus de collecte
+
+    Chaque processus s'annonce dans la table poller_workers (heartbeat). Les
+    appareils sont répartis entre les processus vivants par hachage de
+    rendez-vous, puis un processus ne sonde un appareil que s'il détient son
+    bail (device_leases) non expiré. Un bail n'est pris que s'il est libre,
+    expiré ou déjà détenu : un appareil n'a donc jamais deux collecteurs. Quand
+    un processus disparaît, ses baux expirent et les survivants les reprennent.
+
+    Les échéances sont calculées avec l'horloge locale : les hôtes doivent être
+    synchronisés (NTP) à une fraction de POLLER_LEASE_TTL près.
+    """
+
+    # Taille des lots de clauses IN (limite de variables de SQLite)
+    CHUNK_SIZE = 500
+
+    def __init__(self, worker_id=None, lease_ttl=30):
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_ttl = lease_ttl
+        self.logger = logging.getLogger(__name__)
+        # device_id -> échéance du bail détenu
+        self._owned = {}
+        self.live_workers = []
+
+    def owns(self, device_id, now=None):
+        """Indique si ce processus détient un bail valide sur l'appareil"""
+        expires_at = self._owned.get(device_id)
+        return expires_at is not None and (now or datetime.utcnow()) < expires_at
+
+    @property
+    def owned_devices(self):
+        return set(self._owned)
+
+    def heartbeat(self, now=None):
+        """Annonce ce processus et retourne la liste triée des processus vivants"""
+        now = now or datetime.utcnow()
+        updated = PollerWorker.query.filter_by(id=self.worker_id).update({'heartbeat_at': now})
+        if not updated:
+            db.session.add(PollerWorker(
+                id=self.worker_id, hostname=socket.gethostname(), started_at=now, heartbeat_at=now
+            ))
+
+        # Oubli des processus silencieux et des baux d'appareils supprimés
+        stale = now - timedelta(seconds=self.lease_ttl)
+        PollerWorker.query.filter(PollerWorker.heartbeat_at < stale).delete(synchronize_session=False)
+        DeviceLease.query.filter(
+            ~DeviceLease.device_id.in_(select(Device.id))
+        ).delete(synchronize_session=False)
+        forget_fleet_writers(select(PollerWorker.id))
+        db.session.commit()
+
+        self.live_workers = sorted(worker_id for (worker_id,) in db.session.query(PollerWorker.id).all())
+        return self.live_workers
+
+    def assign(self, device_ids, workers):
+        """Appareils attribués à ce processus par hachage de rendez-vous"""
+        if not workers:
+            return set()
+
+        def score(worker_id, device_id):
+            return hashlib.md5(f"{worker_id}:{device_id}".encode()).hexdigest()
+
+        return set(
+            device_id for device_id in device_ids
+            if max(workers, key=lambda worker_id: score(worker_id, device_id)) == self.worker_id
+        )
+
+    def rebalance(self, device_ids, in_flight=(), now=None):
+        """Heartbeat, cession des baux qui ne nous reviennent plus, prise des autres
+
+        Les appareils dont la sonde est en cours (`in_flight`) ne sont cédés qu'au
+        tour suivant. Retourne l'ensemble des appareils dont on détient le bail.
+        """
+        now = now or datetime.utcnow()
+        device_ids = list(device_ids)
+        wanted = self.assign(device_ids, self.heartbeat(now))
+        expires_at = now + timedelta(seconds=self.lease_ttl)
+
+        # Cession immédiate pour que le nouveau titulaire n'attende pas l'expiration
+        to_release = [
+            device_id for device_id in self._owned
+            if device_id not in wanted and device_id not in in_flight
+        ]
+        for chunk in self._chunks(to_release):
+            DeviceLease.query.filter(
+                DeviceLease.worker_id == self.worker_id, DeviceLease.device_id.in_(chunk)
+            ).update({'worker_id': None, 'expires_at': None}, synchronize_session=False)
+        db.session.commit()
+
+        # Lignes de bail manquantes (libres) pour les appareils visés
+        existing = set()
+        for chunk in self._chunks(list(wanted)):
+            existing.update(
+                device_id for (device_id,) in
+                db.session.query(DeviceLease.device_id).filter(DeviceLease.device_id.in_(chunk)).all()
+            )
+        missing = [device_id for device_id in wanted if device_id not in existing]
+        if missing:
+            try:
+                db.session.execute(
+                    DeviceLease.__table__.insert(),
+                    [{'device_id': device_id, 'worker_id': None, 'expires_at': None} for device_id in missing]
+                )
+                db.session.commit()
+            except IntegrityError:
+                # Un autre processus les a créées entre-temps
+                db.session.rollback()
+
+        # Renouvellement et prise en une seule mise à jour conditionnelle
+        keep = list(wanted | set(device_id for device_id in self._owned if device_id in in_flight))
+        for chunk in self._chunks(keep):
+            DeviceLease.query.filter(
+                DeviceLease.device_id.in_(chunk),
+                or_(
+                    DeviceLease.worker_id == self.worker_id,
+                    DeviceLease.worker_id.is_(None),
+                    DeviceLease.expires_at < now
+                )
+            ).update({'worker_id': self.worker_id, 'expires_at': expires_at}, synchronize_session=False)
+        db.session.commit()
+
+        owned = db.session.query(DeviceLease.device_id).filter(
+            and_(DeviceLease.worker_id == self.worker_id, DeviceLease.expires_at > now)
+        ).all()
+        self._owned = dict((device_id, expires_at) for (device_id,) in owned)
+        return self.owned_devices
+
+    def release_all(self):
+        """Libère tous les baux et se retire (arrêt propre)"""
+        try:
+            DeviceLease.query.filter_by(worker_id=self.worker_id).update(
+                {'worker_id': None, 'expires_at': None}, synchronize_session=False
+            )
+            PollerWorker.query.filter_by(id=self.worker_id).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.logger.error(f"Erreur lors de la libération des baux de {self.worker_id}: {e}")
+        self._owned = {}
+
+    def get_status(self):
+        return {
+            'worker_id': self.worker_id,
+            'live_workers': self.live_workers,
+            'owned_devices': len(self._owned)
+        }
+
+    def _chunks(self, items):
+        for start in range(0, len(items), self.CHUNK_SIZE):
+            yield items[start:start + self.CHUNK_SIZE]
@@ -0,0 +1 @@
+"""Outils de mesure hors ligne : ferme d'agents SNMP simulés et benchmark du poller"""
@@ -0,0 +1,255 @@
+"""
+Benchmark de débit du poller contre la ferme d'agents SNMP simulés
+
+Démarre la ferme dans des processus séparés (son CPU n'est pas compté),
+crée une base SQLite temporaire peuplée d'un appareil par agent, puis fait
+tourner MonitoringScheduler :
+
+- mode 'cycle' : cycles complets collect_all_metrics (après un cycle de
+  découverte des profils, mesuré à part) ;
+- mode 'tick' : le planificateur réel (tick, file d'échéances, pool de sondes)
+  pendant --duration secondes.
+
+Rapporte appareils/s, durée des cycles p50/p99 (retard d'ordonnancement en
+mode 'tick'), latence des sondes p50/p99 et CPU par appareil. Les seuils
+--min-rate / --max-p99 / --max-cpu font échouer la commande en cas de
+régression.
+
+Exemple :
+    python -m benchmarks.poller_benchmark --devices 1000 --cycles 5 --workers 50 --latency 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.snmp_simulator import COUNTER_BEHAVIOURS, build_agents, start_farm_processes  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def create_benchmark_app(args, database_path):
+    """Application sur une base temporaire, sans planificateur ni diffusion externe"""
+    # Lu par config.Config à l'import : à définir avant d'importer l'application
+    os.environ['DATABASE_URL'] = f'sqlite:///{database_path}'
+    os.environ['SCHEDULER_ENABLED'] = 'false'
+    os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)
+
+    from app import create_app
+    app = create_app(start_scheduler=False)
+    app.config.update(
+        SNMP_PORT=args.port,
+        SNMP_COMMUNITY='public',
+        SNMP_TIMEOUT=args.timeout,
+        POLLING_MAX_WORKERS=args.workers,
+        MONITORING_INTERVAL=args.interval,
+        POLL_TICK_INTERVAL=1,
+        EMAIL_ENABLED=False
+    )
+    return app
+
+
+def populate(app, agents):
+    """Un appareil par agent simulé, du type correspondant à son modèle"""
+    from app.models.device import Device, db
+    with app.app_context():
+        db.session.add_all([
+            Device(
+                name=f'sim-{agent.address}', ip_address=agent.address, device_type=agent.device_type,
+                snmp_community='public', snmp_version='2c'
+            )
+            for agent in agents
+        ])
+        db.session.commit()
+
+
+def make_scheduler(app, deadline):
+    """MonitoringScheduler instrumenté : durée de chaque sonde"""
+    from app.tasks.scheduler import MonitoringScheduler
+
+    class BenchmarkScheduler(MonitoringScheduler):
+        def __init__(self):
+            super().__init__()
+            self.probe_durations = []
+            self._durations_lock = threading.Lock()
+
+        def _poll_device(self, device_id, ping_result=None):
+            started = time.perf_counter()
+            try:
+                return super()._poll_device(device_id, ping_result)
+            finally:
+                with self._durations_lock:
+                    self.probe_durations.append(time.perf_counter() - started)
+
+        def take_durations(self):
+            with self._durations_lock:
+                durations, self.probe_durations = self.probe_durations, []
+            return durations
+
+    scheduler = BenchmarkScheduler()
+    scheduler.app = app
+    scheduler.device_deadline = deadline
+    return scheduler
+
+
+def run_cycles(app, scheduler, devices, cycles):
+    """Un cycle de découverte puis `cycles` cycles mesurés"""
+    started, cpu = time.perf_counter(), time.process_time()
+    scheduler.collect_all_metrics()
+    discovery = {'duration': time.perf_counter() - started, 'cpu': time.process_time() - cpu}
+    scheduler.take_durations()
+
+    durations, cpu_total = [], 0.0
+    for _ in range(cycles):
+        started, cpu = time.perf_counter(), time.process_time()
+        scheduler.collect_all_metrics()
+        durations.append(time.perf_counter() - started)
+        cpu_total += time.process_time() - cpu
+
+    probes = scheduler.take_durations()
+    return {
+        'mode': 'cycle',
+        'devices': devices,
+        'cycles': cycles,
+        'discovery_cycle_s': round(discovery['duration'], 3),
+        'devices_per_s': round(devices * cycles / sum(durations), 1) if durations else None,
+        'cycle_p50_ms': _ms(percentile(durations, 0.50)),
+        'cycle_p99_ms': _ms(percentile(durations, 0.99)),
+        'probe_p50_ms': _ms(percentile(probes, 0.50)),
+        'probe_p99_ms': _ms(percentile(probes, 0.99)),
+        'cpu_per_device_ms': _ms(cpu_total / (devices * cycles)) if cycles else None,
+        'statuses': scheduler.last_cycle
+    }
+
+
+def run_ticks(app, scheduler, devices, duration):
+    """Le planificateur réel pendant `duration` secondes"""
+    scheduler.init_app(app)
+    try:
+        # Laisser passer la découverte des profils avant la fenêtre de mesure
+        warmup_deadline = time.monotonic() + max(60, duration)
+        while time.monotonic() < warmup_deadline and scheduler.telemetry.counters['probes'] < devices:
+            time.sleep(0.2)
+        while scheduler.telemetry.in_flight and time.monotonic() < warmup_deadline:
+            time.sleep(0.2)
+        scheduler.take_durations()
+        before = dict(scheduler.telemetry.counters)
+
+        started, cpu = time.perf_counter(), time.process_time()
+        time.sleep(duration)
+        elapsed, cpu_total = time.perf_counter() - started, time.process_time() - cpu
+        snapshot = scheduler.telemetry.snapshot()
+        # File d'écriture différée : profondeur, latence des écritures, échantillons écartés
+        writes = scheduler.metric_writer.get_status()
+    finally:
+        scheduler.shutdown()
+
+    probes = scheduler.take_durations()
+    counters = {name: snapshot['counters'][name] - before.get(name, 0) for name in snapshot['counters']}
+    return {
+        'mode': 'tick',
+        'devices': devices,
+        'duration_s': round(elapsed, 1),
+        'devices_per_s': round(len(probes) / elapsed, 1),
+        'lag_p50_ms': _ms(snapshot['lag']['p50']),
+        'lag_p99_ms': _ms(snapshot['lag']['p99']),
+        'probe_p50_ms': _ms(percentile(probes, 0.50)),
+        'probe_p99_ms': _ms(percentile(probes, 0.99)),
+        'cpu_per_device_ms': _ms(cpu_total / len(probes)) if probes else None,
+        'counters': counters,
+        'writes': writes
+    }
+
+
+def check_thresholds(report, args):
+    """Liste des seuils de régression dépassés"""
+    failures = []
+    p99 = report.get('cycle_p99_ms', report.get('lag_p99_ms'))
+    if args.min_rate is not None and (report['devices_per_s'] or 0) < args.min_rate:
+        failures.append(f"débit {report['devices_per_s']} appareils/s < {args.min_rate}")
+    if args.max_p99 is not None and p99 is not None and p99 > args.max_p99:
+        failures.append(f"p99 {p99} ms > {args.max_p99} ms")
+    if args.max_cpu is not None and (report['cpu_per_device_ms'] or 0) > args.max_cpu:
+        failures.append(f"CPU {report['cpu_per_device_ms']} ms/appareil > {args.max_cpu} ms")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark du poller contre des agents SNMP simulés')
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--mode', choices=('cycle', 'tick'), default='cycle')
+    parser.add_argument('--cycles', type=int, default=3, help="cycles mesurés (mode 'cycle')")
+    parser.add_argument('--duration', type=float, default=60, help="fenêtre de mesure en secondes (mode 'tick')")
+    parser.add_argument('--interval', type=int, default=30, help='MONITORING_INTERVAL (s)')
+    parser.add_argument('--workers', type=int, default=20, help='POLLING_MAX_WORKERS')
+    parser.add_argument('--timeout', type=int, default=1, help='SNMP_TIMEOUT (s)')
+    parser.add_argument('--deadline', type=int, default=25, help='POLL_DEVICE_DEADLINE (s)')
+    parser.add_argument('--port', type=int, default=16100)
+    parser.add_argument('--latency', type=float, default=0.0, help='latence des agents (ms)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='gigue des agents (ms)')
+    parser.add_argument('--loss', type=float, default=0.0, help='probabilité de perte par requête')
+    parser.add_argument('--missing', type=float, default=0.1, help="part d'agents sans HOST-RESOURCES-MIB")
+    parser.add_argument('--counters', choices=COUNTER_BEHAVIOURS + ('mixed',), default='mixed')
+    parser.add_argument('--sim-processes', type=int, default=2, help='processus de la ferme simulée')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='rapport JSON sur la sortie standard')
+    parser.add_argument('--min-rate', type=float, help='débit minimal (appareils/s)')
+    parser.add_argument('--max-p99', type=float, help='p99 maximal des cycles ou du retard (ms)')
+    parser.add_argument('--max-cpu', type=float, help='CPU maximal par appareil (ms)')
+    args = parser.parse_args(argv)
+
+    farm_options = dict(
+        port=args.port, latency=args.latency, jitter=args.jitter, loss=args.loss,
+        missing=args.missing, counters=args.counters, seed=args.seed
+    )
+    processes = start_farm_processes(args.devices, args.sim_processes, **farm_options)
+    database_fd, database_path = tempfile.mkstemp(suffix='.db')
+    try:
+        app = create_benchmark_app(args, database_path)
+        agents = build_agents(args.devices, missing=args.missing, counters=args.counters, seed=args.seed)
+        populate(app, agents)
+        scheduler = make_scheduler(app, args.deadline)
+
+        if args.mode == 'cycle':
+            report = run_cycles(app, scheduler, args.devices, args.cycles)
+        else:
+            report = run_ticks(app, scheduler, args.devices, args.duration)
+    finally:
+        for process in processes:
+            process.terminate()
+        os.close(database_fd)
+        os.unlink(database_path)
+
+    report['simulator'] = farm_options
+    failures = check_thresholds(report, args)
+    report['regressions'] = failures
+
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print(f"📊 Benchmark du poller ({report['mode']}, {args.devices} appareils, {args.workers} sondes)")
+        for key, value in report.items():
+            if key not in ('simulator', 'regressions', 'statuses', 'counters', 'writes'):
+                print(f"   {key}: {value}")
+        for failure in failures:
+            print(f"❌ Régression : {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,510 @@
+"""
+Ferme d'agents SNMP simulés (v1/v2c) pour les benchmarks et les tests hors ligne
+
+Un seul processus sert des milliers d'agents : chacun écoute sur sa propre
+adresse de la boucle locale (127.1.x.y, Linux route tout 127.0.0.0/8 vers lo)
+et sur le même port UDP, comme le parc réel interrogé sur SNMP_PORT. La
+latence, les pertes, les MIBs absentes et le comportement des compteurs
+(rebouclage 32 bits, redémarrage d'agent) sont configurables.
+
+Exemple :
+    python -m benchmarks.snmp_simulator --agents 2000 --port 16100 --latency 5 --loss 0.01
+"""
+
+import argparse
+import bisect
+import heapq
+import ipaddress
+import math
+import multiprocessing
+import random
+import selectors
+import signal
+import socket
+import threading
+import time
+
+from pyasn1.codec.ber import decoder, encoder
+from pysnmp.proto import api, rfc1905
+
+HR_STORAGE_RAM = (1, 3, 6, 1, 2, 1, 25, 2, 1, 2)
+HR_STORAGE_VIRTUAL_MEMORY = (1, 3, 6, 1, 2, 1, 25, 2, 1, 3)
+HR_STORAGE_FIXED_DISK = (1, 3, 6, 1, 2, 1, 25, 2, 1, 4)
+
+# Modèles d'agents : un sysObjectID correspond toujours aux mêmes MIBs,
+# comme pour les profils de collecte partagés par modèle côté poller
+MODELS = {
+    'server': {
+        'sys_object_id': '1.3.6.1.4.1.8072.3.2.10',
+        'descr': 'Linux sim-server 5.15.0 #1 SMP x86_64',
+        'device_type': 'server',
+        'host_resources': True,
+        'hc_counters': True
+    },
+    'router': {
+        'sys_object_id': '1.3.6.1.4.1.9.1.1',
+        'descr': 'Cisco IOS Software, sim-router, Version 15.2',
+        'device_type': 'router',
+        'host_resources': False,
+        'hc_counters': True
+    },
+    'switch': {
+        'sys_object_id': '1.3.6.1.4.1.11.2.3.7.11.1',
+        'descr': 'HP ProCurve sim-switch, revision F.05',
+        'device_type': 'switch',
+        'host_resources': False,
+        'hc_counters': False
+    }
+}
+
+COUNTER_BEHAVIOURS = ('steady', 'wrap', 'reboot')
+MIXED_WEIGHTS = (0.6, 0.25, 0.15)
+
+
+def _oid(text):
+    return tuple(int(part) for part in text.split('.'))
+
+
+class SimulatedAgent:
+    """Agent SNMP simulé : une MIB triée dont les valeurs dépendent de l'uptime
+
+    - `model` : 'server' (HOST-RESOURCES-MIB, compteurs HC), 'router' (sans
+      HOST-RESOURCES-MIB) ou 'switch' (sans HOST-RESOURCES-MIB ni ifXTable) ;
+    - `counters` : 'steady' (débits constants), 'wrap' (compteurs proches de
+      leur maximum et débits élevés : l'ifTable reboucle en quelques minutes)
+      ou 'reboot' (l'agent redémarre toutes les `reboot_every` secondes,
+      uptime et compteurs repartent de zéro).
+    """
+
+    def __init__(self, address, model='server', counters='steady', cpus=2, interfaces=4, seed=0,
+                 reboot_every=600, started=None):
+        self.address = address
+        self.model = model
+        self.counters = counters
+        self.reboot_every = reboot_every
+        self.started = time.time() if started is None else started
+
+        definition = MODELS[model]
+        self.device_type = definition['device_type']
+        rng = random.Random(seed)
+        self._rng = rng
+        self.boot_offset = 0.0 if counters == 'reboot' else rng.uniform(3600, 30 * 86400)
+
+        self.entries = {}
+        self._add('1.3.6.1.2.1.1.1.0', 'str', lambda elapsed: definition['descr'])
+        self._add('1.3.6.1.2.1.1.2.0', 'oid', lambda elapsed: definition['sys_object_id'])
+        self._add('1.3.6.1.2.1.1.3.0', 'ticks', lambda elapsed: int(elapsed * 100) % 2 ** 32)
+        self._add('1.3.6.1.2.1.1.5.0', 'str', lambda elapsed: f'sim-{address}')
+
+        if definition['host_resources']:
+            for cpu in range(cpus):
+                phase = rng.uniform(0, 2 * math.pi)
+                self._add(f'1.3.6.1.2.1.25.3.3.1.2.{196608 + cpu}', 'int', self._load(phase, 50, 35))
+            self._add_storage(rng)
+
+        for index in range(1, interfaces + 1):
+            self._add(f'1.3.6.1.2.1.2.2.1.2.{index}', 'str', lambda elapsed, index=index: f'eth{index - 1}')
+            for column, hc_column in ((10, 6), (16, 10)):
+                rate = rng.uniform(1e7, 1e8) if counters == 'wrap' else rng.uniform(1e4, 1e7)
+                self._add(f'1.3.6.1.2.1.2.2.1.{column}.{index}', 'c32', self._counter(rng, rate, 32))
+                if definition['hc_counters']:
+                    self._add(f'1.3.6.1.2.1.31.1.1.1.{hc_column}.{index}', 'c64', self._counter(rng, rate, 64))
+
+        self.oids = sorted(self.entries)
+
+    def _add(self, oid, kind, value):
+        self.entries[_oid(oid)] = (kind, value)
+
+    def _load(self, phase, mean, amplitude):
+        """Pourcentage variant lentement avec du bruit"""
+        rng = self._rng
+
+        def value(elapsed):
+            load = mean + amplitude * math.sin(elapsed / 300 + phase) + rng.uniform(-5, 5)
+            return int(min(100, max(0, load)))
+        return value
+
+    def _add_storage(self, rng):
+        """hrStorageTable : mémoire vive, mémoire virtuelle et un disque"""
+        ram_units = rng.choice((4, 8, 16, 32)) * 1024 * 256  # unités de 4 Kio
+        rows = (
+            (1, HR_STORAGE_RAM, ram_units, 0.6),
+            (3, HR_STORAGE_VIRTUAL_MEMORY, ram_units * 2, 0.3),
+            (31, HR_STORAGE_FIXED_DISK, rng.choice((64, 256, 512)) * 1024 * 256, 0.5)
+        )
+        for index, storage_type, size, usage in rows:
+            phase = rng.uniform(0, 2 * math.pi)
+            self._add(f'1.3.6.1.2.1.25.2.3.1.2.{index}', 'oid', lambda elapsed, t=storage_type: t)
+            self._add(f'1.3.6.1.2.1.25.2.3.1.5.{index}', 'int', lambda elapsed, s=size: s)
+            self._add(
+                f'1.3.6.1.2.1.25.2.3.1.6.{index}', 'int',
+                lambda elapsed, s=size, u=usage, p=phase: int(s * min(0.98, u + 0.2 * math.sin(elapsed / 600 + p)))
+            )
+
+    def _counter(self, rng, rate, bits):
+        modulus = 2 ** bits
+        if self.counters == 'wrap':
+            # Rebouclage de l'ifTable dans la première minute
+            offset = (2 ** 32 - rate * rng.uniform(5, 60)) % modulus
+        elif self.counters == 'reboot':
+            offset = 0
+        else:
+            offset = rng.uniform(0, 2 ** 31)
+        return lambda elapsed: int(offset + rate * elapsed) % modulus
+
+    def uptime(self, now=None):
+        """Secondes écoulées depuis le (dernier) démarrage simulé de l'agent"""
+        running = (time.time() if now is None else now) - self.started
+        if self.counters == 'reboot':
+            return running % self.reboot_every
+        return running + self.boot_offset
+
+    def get(self, oid, elapsed, hc=True):
+        """(type, valeur) de l'instance `oid`, ou None"""
+        entry = self.entries.get(oid)
+        if entry is None or (entry[0] == 'c64' and not hc):
+            return None
+        return entry[0], entry[1](elapsed)
+
+    def next(self, oid, elapsed, hc=True):
+        """(oid, type, valeur) de l'instance suivante, ou None en fin de MIB"""
+        position = bisect.bisect_right(self.oids, oid)
+        while position < len(self.oids):
+            next_oid = self.oids[position]
+            kind, value = self.entries[next_oid]
+            if kind != 'c64' or hc:
+                return next_oid, kind, value(elapsed)
+            position += 1
+        return None
+
+    def has_column(self, oid):
+        """Indique si la colonne (ou la branche) parente de `oid` existe"""
+        parent = oid[:-1]
+        position = bisect.bisect_left(self.oids, parent)
+        return position < len(self.oids) and self.oids[position][:len(parent)] == parent
+
+
+def build_agents(count, base_address='127.1.0.1', missing=0.0, counters='mixed', seed=0, first=0,
+                 reboot_every=600, started=None):
+    """Construit les agents `first` à `first + count - 1` de la ferme
+
+    Chaque agent est tiré de façon déterministe à partir de (`seed`, rang) :
+    plusieurs processus peuvent donc construire chacun leur tranche.
+    `missing` est la part d'agents sans HOST-RESOURCES-MIB (routeurs et
+    commutateurs, ces derniers sans ifXTable).
+    """
+    base = ipaddress.IPv4Address(base_address)
+    started = time.time() if started is None else started
+    agents = []
+    for rank in range(first, first + count):
+        address = base + rank
+        if not address.is_loopback:
+            raise ValueError(f"L'adresse {address} sort de 127.0.0.0/8")
+        rng = random.Random(seed * 1000003 + rank)
+        model = rng.choice(('router', 'switch')) if rng.random() < missing else 'server'
+        behaviour = counters
+        if behaviour == 'mixed':
+            behaviour = rng.choices(COUNTER_BEHAVIOURS, MIXED_WEIGHTS)[0]
+        agents.append(SimulatedAgent(
+            str(address), model=model, counters=behaviour, cpus=rng.choice((1, 2, 4, 8)),
+            interfaces=rng.choice((2, 4, 8)), seed=rng.random(), reboot_every=reboot_every, started=started
+        ))
+    return agents
+
+
+class SimulatorFarm:
+    """Sert un ensemble d'agents simulés depuis une seule boucle d'événements
+
+    `latency` et `jitter` sont en millisecondes, `loss` est la probabilité de
+    ne pas répondre à une requête. S'utilise en tâche de fond (start/stop, ou
+    comme gestionnaire de contexte) ou au premier plan (serve_forever).
+    """
+
+    def __init__(self, agents, port=16100, community='public', latency=0.0, jitter=0.0, loss=0.0,
+                 max_repetitions=50, seed=None):
+        self.agents = list(agents)
+        self.port = port
+        self.community = community
+        self.latency = latency / 1000.0
+        self.jitter = jitter / 1000.0
+        self.loss = loss
+        self.max_repetitions = max_repetitions
+        self.stats = {'requests': 0, 'responses': 0, 'dropped': 0, 'rejected': 0}
+        self._rng = random.Random(seed)
+        self._selector = None
+        self._sockets = []
+        self._delayed = []
+        self._sequence = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def bind(self):
+        """Ouvre un socket UDP par agent"""
+        self._selector = selectors.DefaultSelector()
+        for agent in self.agents:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.bind((agent.address, self.port))
+            self._sockets.append(sock)
+            self._selector.register(sock, selectors.EVENT_READ, agent)
+
+    def start(self):
+        """Démarre la ferme dans un thread de fond"""
+        self.bind()
+        self._thread = threading.Thread(target=self._loop, name='snmp-simulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.bind()
+        self._loop()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _loop(self):
+        try:
+            while not self._stop.is_set():
+                timeout = 0.2
+                if self._delayed:
+                    timeout = min(timeout, max(0.0, self._delayed[0][0] - time.monotonic()))
+                for key, _ in self._selector.select(timeout):
+                    self._drain(key.fileobj, key.data)
+                self._send_due()
+        finally:
+            self._selector.close()
+            for sock in self._sockets:
+                sock.close()
+            self._sockets = []
+
+    def _drain(self, sock, agent):
+        while True:
+            try:
+                data, peer = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+
+            self.stats['requests'] += 1
+            if self.loss and self._rng.random() < self.loss:
+                self.stats['dropped'] += 1
+                continue
+            response = self.respond(agent, data)
+            if response is None:
+                self.stats['rejected'] += 1
+                continue
+
+            delay = self.latency + (self._rng.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+            if delay <= 0:
+                self._send(sock, response, peer)
+            else:
+                self._sequence += 1
+                heapq.heappush(self._delayed, (time.monotonic() + delay, self._sequence, sock, response, peer))
+
+    def _send_due(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, sock, response, peer = heapq.heappop(self._delayed)
+            self._send(sock, response, peer)
+
+    def _send(self, sock, response, peer):
+        try:
+            sock.sendto(response, peer)
+            self.stats['responses'] += 1
+        except OSError:
+            pass
+
+    def respond(self, agent, data):
+        """Réponse encodée à une requête GET, GETNEXT ou GETBULK, ou None"""
+        try:
+            version = int(api.decodeMessageVersion(data))
+            module = api.protoModules[version]
+            request, _ = decoder.decode(data, asn1Spec=module.Message())
+        except Exception:
+            return None
+        if str(module.apiMessage.getCommunity(request)) != self.community:
+            return None
+
+        v2c = version == api.protoVersion2c
+        request_pdu = module.apiMessage.getPDU(request)
+        response = module.apiMessage.getResponse(request)
+        response_pdu = module.apiMessage.getPDU(response)
+        requested = [tuple(oid) for oid, _ in module.apiPDU.getVarBinds(request_pdu)]
+        elapsed = agent.uptime()
+
+        getnext = request_pdu.isSameTypeWith(module.GetNextRequestPDU())
+        if v2c and request_pdu.isSameTypeWith(module.GetBulkRequestPDU()):
+            var_binds = self._bulk_var_binds(module, agent, request_pdu, requested, elapsed)
+        elif getnext or request_pdu.isSameTypeWith(module.GetRequestPDU()):
+            var_binds, position = self._var_binds(module, agent, requested, elapsed, v2c, getnext)
+            if var_binds is None:
+                return self._v1_error(module, response, response_pdu, request_pdu, position)
+        else:
+            return None
+
+        module.apiPDU.setVarBinds(response_pdu, var_binds)
+        return encoder.encode(response)
+
+    def _var_binds(self, module, agent, requested, elapsed, v2c, getnext):
+        """Varbinds d'un GET ou d'un GETNEXT ; (None, position) pour une erreur SNMPv1"""
+        var_binds = []
+        for position, oid in enumerate(requested):
+            if getnext:
+                entry = agent.next(oid, elapsed, hc=v2c)
+                if entry is not None:
+                    entry = (entry[0], self._value(module, *entry[1:]))
+            else:
+                entry = agent.get(oid, elapsed, hc=v2c)
+                if entry is not None:
+                    entry = (oid, self._value(module, *entry))
+            if entry is None and not v2c:
+                return None, position
+            if entry is None:
+                missing = rfc1905.noSuchInstance if agent.has_column(oid) else rfc1905.noSuchObject
+                entry = (oid, rfc1905.endOfMibView if getnext else missing)
+            var_binds.append(entry)
+        return var_binds, None
+
+    def _bulk_var_binds(self, module, agent, request_pdu, requested, elapsed):
+        """Varbinds d'un GETBULK (SNMPv2c)"""
+        non_repeaters = min(int(module.apiBulkPDU.getNonRepeaters(request_pdu)), len(requested))
+        repetitions = min(int(module.apiBulkPDU.getMaxRepetitions(request_pdu)), self.max_repetitions)
+        var_binds = self._bulk_row(module, agent, requested[:non_repeaters], elapsed)
+        cursors = requested[non_repeaters:]
+        for _ in range(repetitions if cursors else 0):
+            row = self._bulk_row(module, agent, cursors, elapsed)
+            var_binds.extend(row)
+            cursors = [oid for oid, _ in row]
+            if all(value is rfc1905.endOfMibView for _, value in row):
+                break
+        return var_binds
+
+    def _bulk_row(self, module, agent, oids, elapsed):
+        row = []
+        for oid in oids:
+            entry = agent.next(oid, elapsed)
+            if entry is None:
+                row.append((oid, rfc1905.endOfMibView))
+            else:
+                row.append((entry[0], self._value(module, *entry[1:])))
+        return row
+
+    @staticmethod
+    def _value(module, kind, value):
+        if kind == 'int':
+            return module.Integer(value)
+        if kind == 'str':
+            return module.OctetString(value)
+        if kind == 'oid':
+            return module.ObjectIdentifier(value)
+        if kind == 'ticks':
+            return module.TimeTicks(value)
+        if kind == 'c64':
+            return module.Counter64(value)
+        # Counter32 en v2c, Counter en v1
+        counter = getattr(module, 'Counter32', None) or module.Counter
+        return counter(value)
+
+    @staticmethod
+    def _v1_error(module, response, response_pdu, request_pdu, position):
+        """SNMPv1 : noSuchName sur la variable `position`"""
+        module.apiPDU.setVarBinds(response_pdu, module.apiPDU.getVarBinds(request_pdu))
+        module.apiPDU.setErrorStatus(response_pdu, 2)
+        module.apiPDU.setErrorIndex(response_pdu, position + 1)
+        return encoder.encode(response)
+
+
+def _serve_slice(options, first, count, started, ready):
+    """Point d'entrée d'un processus de la ferme : sert sa tranche d'agents"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    agents = build_agents(
+        count, options['base_address'], options['missing'], options['counters'], options['seed'],
+        first=first, reboot_every=options['reboot_every'], started=started
+    )
+    farm = SimulatorFarm(
+        agents, options['port'], options['community'], options['latency'], options['jitter'], options['loss'],
+        seed=options['seed'] + first
+    )
+    farm.bind()
+    ready.set()
+    farm._loop()
+
+
+def start_farm_processes(agents, processes=1, **options):
+    """Lance la ferme répartie sur `processes` processus et attend qu'elle écoute
+
+    Retourne la liste des processus (à arrêter avec terminate()). Les options
+    sont celles de la ligne de commande (port, latency, jitter, loss, missing,
+    counters, seed, community, base_address, reboot_every).
+    """
+    settings = {
+        'port': 16100, 'community': 'public', 'latency': 0.0, 'jitter': 0.0, 'loss': 0.0,
+        'missing': 0.0, 'counters': 'mixed', 'seed': 0, 'base_address': '127.1.0.1', 'reboot_every': 600
+    }
+    settings.update(options)
+    started = time.time()
+    workers = []
+    processes = max(1, min(processes, agents))
+    for rank in range(processes):
+        first = agents * rank // processes
+        count = agents * (rank + 1) // processes - first
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=_serve_slice, args=(settings, first, count, started, ready), daemon=True,
+            name=f'snmp-simulator-{rank}'
+        )
+        process.start()
+        workers.append((process, ready))
+    for process, ready in workers:
+        if not ready.wait(60) or not process.is_alive():
+            for other, _ in workers:
+                other.terminate()
+            raise RuntimeError("La ferme d'agents simulés n'a pas démarré")
+    return [process for process, _ in workers]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ferme d'agents SNMP simulés sur la boucle locale")
+    parser.add_argument('--agents', type=int, default=1000, help="nombre d'agents")
+    parser.add_argument('--port', type=int, default=16100, help='port UDP commun à tous les agents')
+    parser.add_argument('--base-address', default='127.1.0.1', help='adresse du premier agent')
+    parser.add_argument('--community', default='public')
+    parser.add_argument('--latency', type=float, default=0.0, help='latence de réponse (ms)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='gigue de la latence (ms)')
+    parser.add_argument('--loss', type=float, default=0.0, help='probabilité de perte par requête')
+    parser.add_argument('--missing', type=float, default=0.1, help="part d'agents sans HOST-RESOURCES-MIB")
+    parser.add_argument('--counters', choices=COUNTER_BEHAVIOURS + ('mixed',), default='mixed')
+    parser.add_argument('--reboot-every', type=float, default=600, help="période de redémarrage (s), mode 'reboot'")
+    parser.add_argument('--processes', type=int, default=1, help='processus servant la ferme')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    processes = start_farm_processes(
+        args.agents, args.processes, port=args.port, community=args.community, latency=args.latency,
+        jitter=args.jitter, loss=args.loss, missing=args.missing, counters=args.counters, seed=args.seed,
+        base_address=args.base_address, reboot_every=args.reboot_every
+    )
+    last = ipaddress.IPv4Address(args.base_address) + args.agents - 1
+    print(f"🛰️  {args.agents} agents SNMP simulés sur {args.base_address}-{last}:{args.port} "
+          f"({len(processes)} processus) — Ctrl+C pour arrêter")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
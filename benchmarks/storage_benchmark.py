@@ -0,0 +1,193 @@
+"""
+Benchmark du stockage des échantillons bruts : lignes device_metrics ou blocs compressés
+
+Génère des séries réalistes (CPU et mémoire bruités, débits d'interfaces,
+uptime croissant) pour --devices appareils sur --hours heures à --interval
+secondes, les écrit dans une base SQLite temporaire sous les deux formes
+(INSERT dans device_metrics, append_to_chunks dans metric_chunks), puis
+rapporte :
+
+- l'espace occupé par table et index (table virtuelle dbstat de SQLite),
+  en octets par échantillon ;
+- la durée de lectures de plages (--window heures d'une série) : SELECT
+  par l'index (device_id, metric_type, timestamp) contre read_series.
+
+--min-ratio fait échouer la commande si le gain de place est insuffisant.
+
+Exemple :
+    python -m benchmarks.storage_benchmark --devices 50 --hours 24 --interval 30 --json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.poller_benchmark import percentile  # noqa: E402
+
+METRIC_TYPES = (
+    ('cpu', '%'), ('memory', '%'), ('interface_in', 'Mbps'), ('interface_out', 'Mbps'), ('uptime', 's')
+)
+
+
+def generate_samples(device_id, start, hours, interval, rng):
+    """Échantillons d'un appareil, dans l'ordre de collecte (gigue de quelques ms)"""
+    cpu = rng.uniform(5, 60)
+    memory = rng.uniform(20, 80)
+    traffic = rng.uniform(1, 500)
+    uptime = rng.randint(0, 10 ** 7)
+    samples = []
+    for step in range(int(hours * 3600 // interval)):
+        timestamp = start + timedelta(seconds=step * interval, milliseconds=rng.randint(0, 40))
+        cpu = min(100.0, max(0.0, cpu + rng.gauss(0, 3)))
+        memory = min(100.0, max(0.0, memory + rng.gauss(0, 0.2)))
+        traffic = max(0.0, traffic * (1 + rng.gauss(0, 0.05)) + 20 * math.sin(step / 120))
+        uptime += interval
+        values = {
+            'cpu': round(cpu, 1),
+            'memory': round(memory, 2),
+            'interface_in': round(traffic, 2),
+            'interface_out': round(traffic * 0.4, 2),
+            'uptime': float(uptime)
+        }
+        for metric_type, unit in METRIC_TYPES:
+            samples.append({
+                'device_id': device_id, 'metric_type': metric_type, 'value': values[metric_type],
+                'unit': unit, 'timestamp': timestamp
+            })
+    return samples
+
+
+def table_sizes(db, names):
+    """Octets occupés par table ou index (pages SQLite)"""
+    rows = db.session.execute(db.text('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')).all()
+    return {name: size for name, size in rows if name in names}
+
+
+def run(args):
+    database_path = os.path.join(tempfile.mkdtemp(prefix='storage-bench-'), 'bench.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{database_path}'
+    os.environ['SCHEDULER_ENABLED'] = 'false'
+
+    from app import create_app
+    from app.models.chunk import MetricChunk
+    from app.models.device import Device, DeviceMetric, db
+    from app.services.metric_storage import append_to_chunks, read_series
+
+    app = create_app(start_scheduler=False)
+    rng = random.Random(args.seed)
+    start = datetime(2024, 1, 1)
+    write_rows = write_chunks = 0.0
+    total = 0
+
+    with app.app_context():
+        for index in range(args.devices):
+            db.session.add(Device(name=f'bench-{index}', ip_address=f'10.0.{index // 250}.{index % 250 + 1}',
+                                  device_type='server'))
+        db.session.commit()
+        device_ids = [device.id for device in Device.query.all()]
+
+        for device_id in device_ids:
+            samples = generate_samples(device_id, start, args.hours, args.interval, rng)
+            total += len(samples)
+            # Écriture par lots, comme le tampon d'écriture de la collecte
+            for offset in range(0, len(samples), args.batch_size):
+                batch = samples[offset:offset + args.batch_size]
+                started = time.perf_counter()
+                db.session.execute(DeviceMetric.__table__.insert(), batch)
+                db.session.commit()
+                write_rows += time.perf_counter() - started
+                started = time.perf_counter()
+                append_to_chunks(batch, args.chunk_window)
+                db.session.commit()
+                write_chunks += time.perf_counter() - started
+
+        db.session.execute(db.text('VACUUM'))
+        rows_names = {'device_metrics', 'ix_device_metrics_device_type_timestamp', 'ix_device_metrics_timestamp'}
+        chunk_names = {'metric_chunks', 'sqlite_autoindex_metric_chunks_1', 'ix_metric_chunks_end_time'}
+        sizes = table_sizes(db, rows_names | chunk_names)
+        rows_bytes = sum(size for name, size in sizes.items() if name in rows_names)
+        chunk_bytes = sum(size for name, size in sizes.items() if name in chunk_names)
+
+        table = DeviceMetric.__table__
+        scan_rows, scan_chunks = [], []
+        span = timedelta(hours=args.hours - args.window)
+        for _ in range(args.scans):
+            device_id = rng.choice(device_ids)
+            metric_type = rng.choice(METRIC_TYPES)[0]
+            window_start = start + span * rng.random()
+            window_end = window_start + timedelta(hours=args.window)
+
+            started = time.perf_counter()
+            result = db.session.execute(
+                db.select(table.c.timestamp, table.c.value)
+                .where(table.c.device_id == device_id, table.c.metric_type == metric_type,
+                       table.c.timestamp.between(window_start, window_end))
+                .order_by(table.c.timestamp)
+            ).all()
+            timestamps, values = [row[0] for row in result], [row[1] for row in result]
+            scan_rows.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            series = read_series(device_id, window_start, window_end, metric_type)
+            scan_chunks.append(time.perf_counter() - started)
+            if len(series.get(metric_type, (None, []))[1]) != len(timestamps):
+                raise RuntimeError('Lecture des blocs incohérente avec device_metrics')
+            del values
+
+        chunk_count = MetricChunk.query.count()
+
+    return {
+        'samples': total,
+        'chunks': chunk_count,
+        'rows_bytes_per_sample': round(rows_bytes / total, 2),
+        'chunks_bytes_per_sample': round(chunk_bytes / total, 2),
+        'compression_ratio': round(rows_bytes / chunk_bytes, 1) if chunk_bytes else None,
+        'write_rows_s': round(write_rows, 3),
+        'write_chunks_s': round(write_chunks, 3),
+        'scan_window_hours': args.window,
+        'scan_rows_p50_ms': round(percentile(scan_rows, 0.5) * 1000, 3),
+        'scan_rows_p99_ms': round(percentile(scan_rows, 0.99) * 1000, 3),
+        'scan_chunks_p50_ms': round(percentile(scan_chunks, 0.5) * 1000, 3),
+        'scan_chunks_p99_ms': round(percentile(scan_chunks, 0.99) * 1000, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--interval', type=int, default=30, help='intervalle de collecte (secondes)')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--chunk-window', type=int, default=7200, help='fenêtre d\'un bloc (secondes)')
+    parser.add_argument('--window', type=float, default=6, help='durée des plages lues (heures)')
+    parser.add_argument('--scans', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--min-ratio', type=float, help='gain de place minimal (échec en deçà)')
+    args = parser.parse_args(argv)
+    if args.window >= args.hours:
+        parser.error('--window doit être inférieur à --hours')
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f'{key:26} {value}')
+
+    if args.min_ratio is not None and (report['compression_ratio'] or 0) < args.min_ratio:
+        print(f"Échec : gain de place {report['compression_ratio']} < {args.min_ratio}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
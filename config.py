@@ -1,7 +1,40 @@
 import os
 
+
+def parse_intervals(value):
+    """Convertit 'router=10,server=300' en {'router': 10, 'server': 300}"""
+    intervals = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            device_type, seconds = item.split('=', 1)
+            intervals[device_type.strip()] = int(seconds)
+    return intervals
+
+def parse_retention(value):
+    """Convertit 'raw=7,1h=365' en {'raw': 7.0, '1h': 365.0} (jours, suffixe h pour des heures)"""
+    retention = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            tier, duration = item.split('=', 1)
+            duration = duration.strip().lower()
+            if duration.endswith('h'):
+                retention[tier.strip()] = float(duration[:-1]) / 24
+            else:
+                retention[tier.strip()] = float(duration.rstrip('d'))
+    return retention
+
+def parse_retention_policies(value):
+    """Convertit 'cpu:raw=7;bandwidth_*:raw=2,1m=7' en {'cpu': {'raw': 7.0}, 'bandwidth_*': {...}}"""
+    policies = {}
+    for item in (value or '').split(';'):
+        if ':' in item:
+            metric_type, retention = item.split(':', 1)
+            policies[metric_type.strip()] = parse_retention(retention)
+    return policies
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
+    CREDENTIALS_KEY = os.environ.get('CREDENTIALS_KEY')  # chiffrement des phrases secrètes SNMPv3 (défaut : SECRET_KEY)
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///network_monitoring.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
@@ -12,6 +45,44 @@ class Config:
     
     # Configuration de surveillance
     MONITORING_INTERVAL = int(os.environ.get('MONITORING_INTERVAL') or 30)  # en secondes
+    POLLING_MAX_WORKERS = int(os.environ.get('POLLING_MAX_WORKERS') or 20)  # sondes simultanées
+    POLL_INTERVALS = parse_intervals(os.environ.get('POLL_INTERVALS'))  # intervalle par device_type
+    POLL_TICK_INTERVAL = int(os.environ.get('POLL_TICK_INTERVAL') or 1)  # en secondes
+    POLL_DEVICE_DEADLINE = int(os.environ.get('POLL_DEVICE_DEADLINE') or 25)  # durée max d'une sonde (secondes)
+    POLL_PROFILE_TTL = int(os.environ.get('POLL_PROFILE_TTL') or 86400)  # redécouverte des OIDs supportés (secondes)
+    METRIC_BATCH_SIZE = int(os.environ.get('METRIC_BATCH_SIZE') or 500)  # échantillons par écriture groupée
+    METRIC_FLUSH_INTERVAL = int(os.environ.get('METRIC_FLUSH_INTERVAL') or 5)  # délai max avant écriture (secondes)
+    METRIC_QUEUE_MAX = int(os.environ.get('METRIC_QUEUE_MAX') or 50000)  # échantillons en attente d'écriture
+    METRIC_QUEUE_POLICY = os.environ.get('METRIC_QUEUE_POLICY') or 'block'  # file pleine : block, drop_oldest, drop_newest
+    METRIC_QUEUE_BLOCK_TIMEOUT = float(os.environ.get('METRIC_QUEUE_BLOCK_TIMEOUT') or 1.0)  # attente max d'une sonde (secondes)
+    DEVICE_STATE_FLUSH_INTERVAL = int(os.environ.get('DEVICE_STATE_FLUSH_INTERVAL') or 60)  # écriture de l'état des appareils (secondes)
+    DEVICE_STATE_TOLERANCE = float(os.environ.get('DEVICE_STATE_TOLERANCE') or 1.0)  # variation CPU/mémoire à persister (points)
+    DEVICE_STATE_MAX_STALENESS = int(os.environ.get('DEVICE_STATE_MAX_STALENESS') or 300)  # âge max de last_seen en base (secondes)
+    METRIC_STORAGE = os.environ.get('METRIC_STORAGE') or 'rows'  # rows (une ligne par échantillon) ou chunks
+    METRIC_CHUNK_WINDOW = int(os.environ.get('METRIC_CHUNK_WINDOW') or 7200)  # fenêtre d'un bloc compressé (secondes)
+    
+    # Rétention des métriques (purge incrémentale par lots, par métrique et par résolution)
+    METRIC_RETENTION_DAYS = int(os.environ.get('METRIC_RETENTION_DAYS') or 30)  # échantillons bruts
+    ROLLUP_RETENTION = parse_retention(os.environ.get('ROLLUP_RETENTION') or '1m=30,5m=90,1h=365')  # agrégats (jours)
+    METRIC_RETENTION_POLICIES = parse_retention_policies(os.environ.get('METRIC_RETENTION_POLICIES'))  # par metric_type
+    RETENTION_INTERVAL = int(os.environ.get('RETENTION_INTERVAL') or 3600)  # entre deux passages (secondes)
+    RETENTION_CHUNK_SIZE = int(os.environ.get('RETENTION_CHUNK_SIZE') or 5000)  # lignes supprimées par transaction
+    RETENTION_CHUNK_PAUSE = float(os.environ.get('RETENTION_CHUNK_PAUSE') or 0.1)  # pause entre deux lots (secondes)
+    RETENTION_MAX_DURATION = int(os.environ.get('RETENTION_MAX_DURATION') or 0) or None  # durée max d'une purge (secondes)
+    RETENTION_MAX_ROWS = int(os.environ.get('RETENTION_MAX_ROWS') or 200000) or None  # lignes supprimées par passage
+    
+    # Planificateur dans le processus web (désactiver quand poller.py tourne à part)
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true'
+    # File de messages partagée web/poller pour Socket.IO (ex. redis://redis:6379/0)
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    
+    # Collecte répartie entre plusieurs processus (baux en base de données)
+    POLLER_SHARDING_ENABLED = os.environ.get('POLLER_SHARDING_ENABLED', 'false').lower() == 'true'
+    POLLER_WORKER_ID = os.environ.get('POLLER_WORKER_ID')  # hôte-pid par défaut
+    POLLER_LEASE_TTL = int(os.environ.get('POLLER_LEASE_TTL') or 30)  # en secondes
+    POLLER_HEARTBEAT_INTERVAL = int(os.environ.get('POLLER_HEARTBEAT_INTERVAL') or 10)  # en secondes
+    POLL_BACKOFF_THRESHOLD = int(os.environ.get('POLL_BACKOFF_THRESHOLD') or 3)  # échecs avant backoff
+    POLL_BACKOFF_MAX_DELAY = int(os.environ.get('POLL_BACKOFF_MAX_DELAY') or 1800)  # en secondes
     
     # Configuration des notifications
     EMAIL_ENABLED = os.environ.get('EMAIL_ENABLED', 'false').lower() == 'true'
@@ -19,4 +90,4 @@ class Config:
     SMTP_PORT = int(os.environ.get('SMTP_PORT') or 587)
     SMTP_USERNAME = os.environ.get('SMTP_USERNAME')
     SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
-    ADMIN_EMAIL = os.environ.get('ADMIN_EMAIL')
\ No newline at end of file
+    ADMIN_EMAIL = os.environ.get('ADMIN_EMAIL')
@@ -0,0 +1,26 @@
+from app import create_app, scheduler
+import logging
+import signal
+import threading
+
+# Processus de collecte seul : le planificateur démarre ici, pas dans les processus web
+app = create_app(start_scheduler=True)
+
+if __name__ == "__main__":
+    logger = logging.getLogger('poller')
+    if not app.config.get('SOCKETIO_MESSAGE_QUEUE'):
+        logger.warning(
+            "SOCKETIO_MESSAGE_QUEUE non défini : les mises à jour temps réel "
+            "n'atteindront pas les clients du processus web"
+        )
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+
+    logger.info("Processus de collecte démarré")
+    stop.wait()
+
+    # Arrêt propre : libère les baux pour que les autres processus les reprennent
+    scheduler.shutdown()
+    logger.info("Processus de collecte arrêté")
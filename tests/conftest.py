@@ -21,7 +21,7 @@ def app():
     }
     
     # Créer l'application avec la configuration de test
-    app = create_app()
+    app = create_app(start_scheduler=False)
     app.config.update(test_config)
     
     with app.app_context():
@@ -1,5 +1,5 @@
 import pytest
-from datetime import datetime
+from datetime import datetime, timedelta
 from app.models.device import Device, DeviceMetric, db
 
 class TestDevice:
@@ -103,3 +103,109 @@ class TestDeviceMetric:
             assert metric_dict['value'] == 100.0
             assert metric_dict['unit'] == "Mbps"
             assert 'timestamp' in metric_dict
+
+class TestMigrations:
+    """Tests des migrations du schéma"""
+    
+    def test_indexes_added_to_existing_database(self, app):
+        """Test de création des index de séries temporelles sur une base existante"""
+        from app.models.migrations import SchemaMigration, run_migrations
+        with app.app_context():
+            # Base créée avant les index : ni index ni version enregistrée
+            for index in DeviceMetric.__table__.indexes:
+                index.drop(db.engine, checkfirst=True)
+            SchemaMigration.query.delete()
+            db.session.commit()
+            
+            assert '0001_device_metrics_time_series_indexes' in run_migrations()
+            names = {index['name'] for index in db.inspect(db.engine).get_indexes('device_metrics')}
+            assert {'ix_device_metrics_device_type_timestamp', 'ix_device_metrics_timestamp'} <= names
+            
+            # Déjà appliquée : rien à faire
+            assert run_migrations() == []
+    
+    def test_rollup_backfill_resumes_by_chunk(self, app, sample_device):
+        """Test de l'agrégation des échantillons existants, lot par lot, reprise après interruption"""
+        from app.models.migrations import MigrationProgress, _backfill_rollups
+        from app.models.rollup import MetricRollup1h
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            base = datetime(2024, 1, 1, 10, 0, 0)
+            # Échantillons antérieurs aux agrégats : écrits sans passer par write_samples
+            db.session.execute(DeviceMetric.__table__.insert(), [
+                {'device_id': sample_device.id, 'metric_type': 'cpu', 'value': float(value), 'unit': '%',
+                 'timestamp': base + timedelta(minutes=value)}
+                for value in range(1, 6)
+            ])
+            db.session.commit()
+            first_id = db.session.execute(db.select(db.func.min(DeviceMetric.id))).scalar()
+            
+            # Migration interrompue après les deux premiers échantillons
+            db.session.merge(MigrationProgress(version='0002_metric_rollups_backfill', position=first_id + 1,
+                                               target=first_id + 4))
+            db.session.commit()
+            _backfill_rollups(db.engine, chunk_size=2)
+            
+            hour = db.session.get(MetricRollup1h, (sample_device.id, 'cpu', base))
+            assert (hour.count, hour.value_sum) == (3, 12.0)
+            assert db.session.get(MigrationProgress, '0002_metric_rollups_backfill').position == first_id + 4
+            
+            # Terminée : une nouvelle exécution n'agrège rien deux fois
+            _backfill_rollups(db.engine, chunk_size=2)
+            db.session.expire_all()
+            assert db.session.get(MetricRollup1h, (sample_device.id, 'cpu', base)).count == 3
+    
+    def test_snmp_keys_encrypted_at_rest(self, app, sample_device):
+        """Test du chiffrement des phrases secrètes SNMPv3, y compris celles enregistrées en clair"""
+        from app.models.device import SNMPCredential
+        from app.models.migrations import SchemaMigration, run_migrations
+        with app.app_context():
+            sample_device.snmp_credential = SNMPCredential(username='monitor', auth_key='auth-secret', priv_key=None)
+            db.session.add(sample_device)
+            db.session.commit()
+            table = SNMPCredential.__table__
+            raw_keys = db.select(db.type_coerce(table.c.auth_key, db.String))
+            
+            stored = db.session.execute(raw_keys).scalar()
+            assert stored.startswith('enc:') and 'auth-secret' not in stored
+            db.session.expire_all()
+            assert db.session.get(SNMPCredential, sample_device.id).auth_key == 'auth-secret'
+            
+            # Base antérieure au chiffrement : phrase en clair, lue telle quelle puis chiffrée par la migration
+            db.session.execute(table.update().values(auth_key=db.literal_column("'legacy-secret'")))
+            SchemaMigration.query.filter_by(version='0004_snmp_credentials_encrypted_keys').delete()
+            db.session.commit()
+            db.session.expire_all()
+            assert db.session.get(SNMPCredential, sample_device.id).auth_key == 'legacy-secret'
+            
+            assert run_migrations() == ['0004_snmp_credentials_encrypted_keys']
+            assert db.session.execute(raw_keys).scalar().startswith('enc:')
+            db.session.expire_all()
+            credential = db.session.get(SNMPCredential, sample_device.id)
+            assert (credential.auth_key, credential.priv_key) == ('legacy-secret', None)
+
+class TestMetricRollups:
+    """Tests des agrégats 1 min / 5 min / 1 h"""
+    
+    def test_rollups_merged_incrementally(self, app, sample_device):
+        """Test de fusion de lots successifs dans les agrégats"""
+        from app.models.rollup import MetricRollup1m, MetricRollup1h, apply_rollups
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            
+            base = datetime(2024, 1, 1, 10, 0, 0)
+            sample = {'device_id': sample_device.id, 'metric_type': 'cpu', 'unit': '%'}
+            apply_rollups([dict(sample, value=10.0, timestamp=base), dict(sample, value=30.0, timestamp=base.replace(second=30))])
+            apply_rollups([dict(sample, value=5.0, timestamp=base.replace(second=45)),
+                           dict(sample, value=50.0, timestamp=base.replace(minute=1))])
+            db.session.commit()
+            
+            first = db.session.get(MetricRollup1m, (sample_device.id, 'cpu', base))
+            assert (first.count, first.value_min, first.value_max) == (3, 5.0, 30.0)
+            assert first.to_dict()['value'] == 15.0
+            assert MetricRollup1m.query.count() == 2
+            
+            hour = db.session.get(MetricRollup1h, (sample_device.id, 'cpu', base))
+            assert (hour.count, hour.value_sum, hour.value_min, hour.value_max) == (4, 95.0, 5.0, 50.0)
@@ -1,6 +1,10 @@
 import pytest
 import json
+from unittest.mock import patch
 from app.models.device import Device, db
+from app.models.fleet_version import FleetVersion, set_fleet_writer
+from app.services.metric_writer import MetricWriter
+from app.services.snmp import get_snmp_service
 
 class TestDeviceRoutes:
     """Tests pour les routes des appareils"""
@@ -102,3 +106,471 @@ class TestDeviceRoutes:
         with app.app_context():
             device = Device.query.get(device_id)
             assert device is None
+
+    def test_add_device_snmp_v3_invalid_key(self, client):
+        """Test d'ajout d'appareil SNMPv3 avec une clé trop courte"""
+        device_data = {
+            'name': 'Routeur v3',
+            'ip_address': '10.9.9.9',
+            'device_type': 'router',
+            'snmp_version': '3',
+            'snmp_v3': {'username': 'mon', 'auth_key': 'court'}
+        }
+        
+        response = client.post('/api/devices',
+                             data=json.dumps(device_data),
+                             content_type='application/json')
+        
+        assert response.status_code == 400
+        assert 'snmp_v3.auth_key' in json.loads(response.data)['error']
+
+    def test_device_state_served_from_memory(self, client, app, sample_device):
+        """Test de la lecture de l'état courant tenu en mémoire par le planificateur"""
+        from app import scheduler
+        store = scheduler.device_states
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            device_id = sample_device.id
+            store.sync([sample_device], complete=True)
+            # Sonde pas encore écrite en base
+            sample_device.status = 'offline'
+            sample_device.cpu_usage = 55.0
+            store.record(sample_device)
+            db.session.rollback()
+        
+        try:
+            data = client.get(f'/api/devices/{device_id}').get_json()
+            assert (data['status'], data['cpu_usage']) == ('offline', 55.0)
+            assert client.get('/api/devices').get_json()[0]['status'] == 'offline'
+            assert b'Offline' in client.get('/').data
+            with app.app_context():
+                assert db.session.get(Device, device_id).status == 'unknown'
+            
+            # Renommé par l'API : champs descriptifs à jour, état en mémoire conservé
+            client.put(f'/api/devices/{device_id}', json={'name': 'Renamed'})
+            assert store.get(device_id)['name'] == 'Renamed'
+            assert store.get(device_id)['status'] == 'offline'
+            
+            # Test de connectivité : statut écrit en base repris en mémoire, qu'il réussisse ou non
+            snmp_service = get_snmp_service()
+            with patch.object(snmp_service, 'snmp_available', False):
+                with patch.object(snmp_service, 'ping_device', return_value=True):
+                    client.post(f'/api/devices/{device_id}/test')
+                assert store.get(device_id)['status'] == 'online'
+                last_seen = store.state(device_id)['last_seen']
+                with patch.object(snmp_service, 'ping_device', return_value=False):
+                    client.post(f'/api/devices/{device_id}/test')
+                assert store.get(device_id)['status'] == 'offline'
+                assert store.state(device_id)['last_seen'] == last_seen
+                assert not store.status_changes()
+            
+            client.delete(f'/api/devices/{device_id}')
+            assert store.get(device_id) is None
+        finally:
+            store.sync([], complete=False)
+            store.active = False
+    
+    def _add_fleet(self, app):
+        """Cinq appareils de types, statuts et sous-réseaux variés ; retourne leurs ids"""
+        with app.app_context():
+            devices = [
+                Device(name=f'dev-{i}', ip_address=f'10.{1 if i < 3 else 2}.0.{i + 1}',
+                       device_type='router' if i % 2 else 'server', status='online' if i < 4 else 'offline')
+                for i in range(5)
+            ]
+            db.session.add_all(devices)
+            db.session.commit()
+            return [device.id for device in devices]
+    
+    def test_get_devices_filters_fields_and_pagination(self, client, app):
+        """Test des filtres, des champs choisis et de la pagination de la liste des appareils"""
+        ids = self._add_fleet(app)
+        
+        assert [d['id'] for d in client.get('/api/devices').get_json()] == ids
+        assert [d['id'] for d in client.get('/api/devices?status=offline').get_json()] == ids[4:]
+        assert [d['id'] for d in client.get('/api/devices?device_type=router&ip_prefix=10.1.').get_json()] == [ids[1]]
+        assert len(client.get('/api/devices?status=online,offline&device_type=server').get_json()) == 3
+        
+        data = client.get('/api/devices?fields=id,status').get_json()
+        assert data[0] == {'id': ids[0], 'status': 'online'}
+        
+        pages, cursor = [], None
+        while True:
+            response = client.get('/api/devices?fields=id&limit=2' + (f'&cursor={cursor}' if cursor else ''))
+            pages.append([d['id'] for d in response.get_json()])
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+        assert pages == [ids[0:2], ids[2:4], ids[4:]]
+        
+        assert client.get('/api/devices?fields=id,password').status_code == 400
+        assert client.get('/api/devices?limit=0').status_code == 400
+        assert client.get('/api/devices?cursor=abc').status_code == 400
+    
+    def test_get_devices_status_filter_uses_memory_state(self, client, app):
+        """Test du filtre de statut sur l'état en mémoire, base en retard comprise, pages pleines"""
+        from app import scheduler
+        store = scheduler.device_states
+        ids = self._add_fleet(app)
+        with app.app_context():
+            store.sync(Device.query.all(), complete=True)
+            # Sondes pas encore écrites : dev-0 hors ligne, dev-4 de nouveau en ligne
+            for device_id, status in ((ids[0], 'offline'), (ids[4], 'online')):
+                device = db.session.get(Device, device_id)
+                device.status = status
+                store.record(device)
+            db.session.rollback()
+        try:
+            assert [d['id'] for d in client.get('/api/devices?status=offline').get_json()] == [ids[0]]
+            response = client.get('/api/devices?status=online&fields=id&limit=4')
+            assert [d['id'] for d in response.get_json()] == ids[1:5]
+            assert 'X-Next-Cursor' not in response.headers
+        finally:
+            for device_id in ids:
+                store.forget(device_id)
+            store.sync([], complete=False)
+            store.active = False
+    
+    def test_get_devices_conditional_get(self, client, app):
+        """Test de l'ETag : 304 sans parcourir devices tant que l'état n'a pas changé"""
+        from sqlalchemy import event
+        from app import scheduler
+        store = scheduler.device_states
+        ids = self._add_fleet(app)
+        with app.app_context():
+            store.sync(Device.query.all(), complete=True)
+        statements = []
+        
+        def capture(*args):
+            statements.append(args[2])
+        
+        try:
+            full = client.get('/api/devices')
+            light = client.get('/api/devices?fields=id,status')
+            assert full.headers['Cache-Control'] == 'no-cache'
+            with app.app_context():
+                event.listen(db.engine, 'before_cursor_execute', capture)
+                try:
+                    response = client.get('/api/devices', headers={'If-None-Match': full.headers['ETag']})
+                finally:
+                    event.remove(db.engine, 'before_cursor_execute', capture)
+            assert response.status_code == 304
+            assert statements == []
+            
+            # CPU modifiée par une sonde : la liste complète change, pas les statuts
+            with app.app_context():
+                device = db.session.get(Device, ids[0])
+                device.cpu_usage = 42.0
+                store.record(device)
+                db.session.rollback()
+            assert client.get('/api/devices', headers={'If-None-Match': full.headers['ETag']}).status_code == 200
+            response = client.get('/api/devices?fields=id,status', headers={'If-None-Match': light.headers['ETag']})
+            assert response.status_code == 304
+            
+            # Changement de statut
+            with app.app_context():
+                device = db.session.get(Device, ids[0])
+                device.status = 'offline'
+                store.record(device)
+                db.session.rollback()
+            response = client.get('/api/devices?fields=id,status', headers={'If-None-Match': light.headers['ETag']})
+            assert response.status_code == 200
+            assert response.get_json()[0] == {'id': ids[0], 'status': 'offline'}
+        finally:
+            for device_id in ids:
+                store.forget(device_id)
+            store.sync([], complete=False)
+            store.active = False
+        
+        # Processus web seul : l'ETag suit la table fleet_versions, lue en une requête
+        etag = client.get('/api/devices').headers['ETag']
+        light = client.get('/api/devices?fields=id,status').headers['ETag']
+        statements.clear()
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            try:
+                assert client.get('/api/devices', headers={'If-None-Match': etag}).status_code == 304
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', capture)
+        assert len(statements) == 1 and 'fleet_version' in statements[0] and 'devices' not in statements[0]
+        
+        # Écriture groupée d'un autre processus : colonnes volatiles, puis statut
+        writer = MetricWriter()
+        with app.app_context():
+            writer._update_devices([(ids[2], {'cpu_usage': 12.0})])
+            db.session.commit()
+        assert client.get('/api/devices', headers={'If-None-Match': etag}).status_code == 200
+        assert client.get('/api/devices?fields=id,status', headers={'If-None-Match': light}).status_code == 304
+        with app.app_context():
+            writer._update_devices([(ids[2], {'status': 'warning'})])
+            db.session.commit()
+        assert client.get('/api/devices?fields=id,status', headers={'If-None-Match': light}).status_code == 200
+        
+        # Poller réparti : ses écritures incrémentent sa propre ligne, pas la ligne commune
+        light = client.get('/api/devices?fields=id,status').headers['ETag']
+        set_fleet_writer('poller-b')
+        try:
+            with app.app_context():
+                shared = db.session.get(FleetVersion, 'default').version
+                writer._update_devices([(ids[2], {'status': 'online'})])
+                db.session.commit()
+                assert db.session.get(FleetVersion, 'default').version == shared
+                assert db.session.get(FleetVersion, 'poller-b').status_version == 1
+        finally:
+            set_fleet_writer()
+        assert client.get('/api/devices?fields=id,status', headers={'If-None-Match': light}).status_code == 200
+        
+        etag = client.get('/api/devices?fields=id,status').headers['ETag']
+        client.put(f'/api/devices/{ids[1]}', json={'name': 'Renamed'})
+        assert client.get('/api/devices?fields=id,status', headers={'If-None-Match': etag}).status_code == 200
+    
+class TestMetricsQueryPlans:
+    """Plans d'exécution des requêtes de métriques (SQLite)"""
+    
+    def _metric_query_plans(self, app, action, tables=('device_metrics',)):
+        """EXPLAIN QUERY PLAN de chaque requête sur `tables` émise par `action`"""
+        from sqlalchemy import event
+        statements = []
+        
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if any(f'FROM {table}' in statement for table in tables) and not statement.startswith('EXPLAIN'):
+                statements.append((statement, parameters))
+        
+        with app.app_context():
+            engine = db.engine
+            if engine.dialect.name != 'sqlite':
+                pytest.skip("Vérification des plans limitée à SQLite")
+            event.listen(engine, 'before_cursor_execute', capture)
+            try:
+                action()
+            finally:
+                event.remove(engine, 'before_cursor_execute', capture)
+            
+            plans = []
+            with engine.connect() as connection:
+                for statement, parameters in statements:
+                    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+                    plans.append(' | '.join(row[-1] for row in rows))
+            return plans
+    
+    def test_device_metrics_use_indexes(self, client, app, sample_device):
+        """Test : l'API des métriques d'un appareil ne parcourt pas toute la table"""
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            device_id = sample_device.id
+        
+        def fetch():
+            assert client.get(f'/api/devices/{device_id}/metrics?type=cpu&hours=1').status_code == 200
+            assert client.get(f'/api/devices/{device_id}/metrics').status_code == 200
+        
+        plans = self._metric_query_plans(app, fetch)
+        assert len(plans) == 2
+        assert 'ix_device_metrics_device_type_timestamp' in plans[0]
+        for plan in plans:
+            assert 'USING INDEX' in plan or 'USING COVERING INDEX' in plan
+            assert 'SCAN device_metrics' not in plan
+    
+    def test_retention_uses_timestamp_index(self, app, sample_device):
+        """Test : la purge sélectionne par les index d'horodatage et supprime par clé primaire"""
+        from datetime import datetime, timedelta
+        from app.models.device import DeviceMetric
+        from app.tasks.scheduler import MonitoringScheduler
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            db.session.add(DeviceMetric(
+                device_id=sample_device.id, metric_type='cpu', value=1.0, unit='%',
+                timestamp=datetime.utcnow() - timedelta(days=60)
+            ))
+            db.session.commit()
+        scheduler = MonitoringScheduler()
+        scheduler.app = app
+        
+        plans = self._metric_query_plans(
+            app, scheduler.cleanup_old_metrics, tables=('device_metrics', 'metric_rollups_1m', 'metric_rollups_1h')
+        )
+        assert scheduler.last_cleanup['deleted'] == 1
+        assert any('ix_device_metrics_timestamp' in plan for plan in plans)
+        assert any('ix_metric_rollups_1h_bucket' in plan for plan in plans)
+        for plan in plans:
+            assert 'SCAN device_metrics' not in plan
+            assert 'SCAN metric_rollups' not in plan
+    
+    def test_metrics_max_points_uses_rollups(self, client, app, sample_device):
+        """Test du choix de la résolution selon le budget de points"""
+        from datetime import datetime, timedelta
+        from app.models.device import DeviceMetric
+        from app.models.rollup import apply_rollups
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            device_id = sample_device.id
+            
+            # Un échantillon toutes les 20 s pendant 2 h
+            now = datetime.utcnow()
+            samples = [
+                {'device_id': device_id, 'metric_type': 'cpu', 'value': float(i % 100), 'unit': '%',
+                 'timestamp': now - timedelta(seconds=20 * i)}
+                for i in range(360)
+            ]
+            db.session.execute(DeviceMetric.__table__.insert(), samples)
+            apply_rollups(samples)
+            db.session.commit()
+        
+        response = client.get(f'/api/devices/{device_id}/metrics?hours=3&type=cpu')
+        assert response.headers['X-Metrics-Resolution'] == 'raw'
+        assert len(response.get_json()) == 360
+        
+        response = client.get(f'/api/devices/{device_id}/metrics?hours=3&type=cpu&max_points=200')
+        assert response.headers['X-Metrics-Resolution'] == '60'
+        points = response.get_json()
+        assert 120 <= len(points) <= 200
+        assert sum(point['count'] for point in points) == 360
+        assert {'min', 'max', 'value'} <= set(points[0])
+        
+        response = client.get(f'/api/devices/{device_id}/metrics?hours=3&type=cpu&max_points=30')
+        assert response.headers['X-Metrics-Resolution'] == '300'
+        
+        assert client.get(f'/api/devices/{device_id}/metrics?max_points=0').status_code == 400
+    
+    def test_metrics_from_chunk_storage(self, client, app, sample_device):
+        """Test de lecture des métriques en stockage compressé (blocs et anciennes lignes)"""
+        from datetime import datetime, timedelta
+        from app.models.device import DeviceMetric
+        from app.services.metric_storage import write_samples
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            device_id = sample_device.id
+            now = datetime.utcnow().replace(microsecond=0)
+            # Ligne écrite avant le passage aux blocs
+            db.session.add(DeviceMetric(device_id=device_id, metric_type='cpu', value=5.0, unit='%',
+                                        timestamp=now - timedelta(minutes=30)))
+            app.config.update(METRIC_STORAGE='chunks')
+            write_samples([
+                {'device_id': device_id, 'metric_type': 'cpu', 'value': float(i), 'unit': '%',
+                 'timestamp': now - timedelta(minutes=i)}
+                for i in range(3)
+            ])
+            db.session.commit()
+        
+        response = client.get(f'/api/devices/{device_id}/metrics?type=cpu')
+        assert response.headers['X-Metrics-Resolution'] == 'raw'
+        points = response.get_json()
+        assert [point['value'] for point in points] == [0.0, 1.0, 2.0, 5.0]
+        assert points[0]['timestamp'] == now.isoformat()
+        
+        response = client.get(f'/api/devices/{device_id}/metrics?type=cpu&max_points=3')
+        assert response.headers['X-Metrics-Resolution'] == '60'
+    
+    def _pages(self, client, url):
+        """Parcourt toutes les pages en suivant X-Next-Cursor"""
+        points, cursor = [], None
+        while True:
+            response = client.get(url + (f'&cursor={cursor}' if cursor else ''))
+            assert response.status_code == 200
+            points.extend(response.get_json())
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                return points
+    
+    def test_metrics_keyset_pagination(self, client, app, sample_device):
+        """Test de la pagination par clé (horodatage, id), horodatages partagés compris"""
+        from datetime import datetime, timedelta
+        from app.models.device import DeviceMetric
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            device_id = sample_device.id
+            now = datetime.utcnow()
+            # Deux métriques par sonde, au même horodatage
+            db.session.execute(DeviceMetric.__table__.insert(), [
+                {'device_id': device_id, 'metric_type': metric_type, 'value': float(i), 'unit': '%',
+                 'timestamp': now - timedelta(seconds=30 * i)}
+                for i in range(12) for metric_type in ('cpu', 'memory')
+            ])
+            db.session.commit()
+        
+        expected = client.get(f'/api/devices/{device_id}/metrics').get_json()
+        points = self._pages(client, f'/api/devices/{device_id}/metrics?limit=5')
+        assert [point['id'] for point in points] == [point['id'] for point in expected]
+        assert len(points) == 24
+        
+        plans = self._metric_query_plans(
+            app, lambda: self._pages(client, f'/api/devices/{device_id}/metrics?type=cpu&limit=5')
+        )
+        assert plans and all('ix_device_metrics_device_type_timestamp' in plan for plan in plans)
+        assert all('TEMP B-TREE' not in plan for plan in plans)
+        
+        assert client.get(f'/api/devices/{device_id}/metrics?cursor=invalide').status_code == 400
+        assert client.get(f'/api/devices/{device_id}/metrics?limit=0').status_code == 400
+        assert client.get(f'/api/devices/{device_id}/metrics?limit=5&max_points=10').status_code == 400
+    
+    def test_metrics_streaming_export(self, client, app, sample_device):
+        """Test de l'export en flux NDJSON et CSV"""
+        from datetime import datetime, timedelta
+        from app.models.device import DeviceMetric
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            device_id = sample_device.id
+            now = datetime.utcnow()
+            db.session.execute(DeviceMetric.__table__.insert(), [
+                {'device_id': device_id, 'metric_type': 'cpu', 'value': float(i), 'unit': '%',
+                 'timestamp': now - timedelta(minutes=i)}
+                for i in range(1500)
+            ])
+            db.session.commit()
+        
+        response = client.get(f'/api/devices/{device_id}/metrics?format=ndjson&hours=48')
+        assert response.is_streamed
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.get_data(as_text=True).splitlines()
+        assert len(lines) == 1500
+        assert [json.loads(line)['value'] for line in lines[:3]] == [0.0, 1.0, 2.0]
+        
+        response = client.get(f'/api/devices/{device_id}/metrics?format=csv&hours=48&type=cpu')
+        assert response.mimetype == 'text/csv'
+        assert 'attachment' in response.headers['Content-Disposition']
+        lines = response.get_data(as_text=True).splitlines()
+        assert lines[0] == 'timestamp,metric_type,value,unit,id'
+        assert len(lines) == 1501
+        
+        assert client.get(f'/api/devices/{device_id}/metrics?format=xml').status_code == 400
+    
+    def test_metrics_pagination_with_chunk_storage(self, client, app, sample_device):
+        """Test de la pagination en stockage compressé : clé (horodatage, métrique), anciennes lignes fusionnées"""
+        from datetime import datetime, timedelta
+        from app.models.device import DeviceMetric
+        from app.services.metric_storage import write_samples
+        from app.services.metrics_query import encode_cursor
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            device_id = sample_device.id
+            now = datetime.utcnow().replace(microsecond=0)
+            db.session.add(DeviceMetric(device_id=device_id, metric_type='cpu', value=99.0, unit='%',
+                                        timestamp=now - timedelta(minutes=7, seconds=30)))
+            db.session.commit()
+            app.config.update(METRIC_STORAGE='chunks', METRIC_CHUNK_WINDOW=300)
+            write_samples([
+                {'device_id': device_id, 'metric_type': metric_type, 'value': float(i), 'unit': '%',
+                 'timestamp': now - timedelta(minutes=i)}
+                for i in range(15) for metric_type in ('cpu', 'memory')
+            ])
+            db.session.commit()
+        
+        expected = client.get(f'/api/devices/{device_id}/metrics').get_json()
+        assert len(expected) == 31
+        points = self._pages(client, f'/api/devices/{device_id}/metrics?limit=4')
+        assert points == expected
+        assert [point['value'] for point in points[:3]] == [0.0, 0.0, 1.0]
+        assert points[16]['value'] == 99.0
+        
+        lines = client.get(f'/api/devices/{device_id}/metrics?format=ndjson').get_data(as_text=True).splitlines()
+        assert [json.loads(line) for line in lines] == expected
+        # Curseur (horodatage, id) émis avant le passage aux blocs
+        cursor = encode_cursor((now, 1))
+        assert client.get(f'/api/devices/{device_id}/metrics?cursor={cursor}').status_code == 400
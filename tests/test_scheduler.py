@@ -0,0 +1,435 @@
+import pytest
+import time
+from datetime import datetime, timedelta
+from unittest.mock import Mock, patch
+from app.tasks.scheduler import MonitoringScheduler, DeviceBackoff, PollQueue
+from app.tasks.sharding import ShardCoordinator
+from app.models.device import Device, db
+from app.models.fleet_version import FleetVersion, bump_fleet_version, set_fleet_writer
+
+
+class TestMonitoringScheduler:
+    """Tests pour le planificateur de surveillance"""
+    
+    def _add_devices(self, count):
+        for i in range(count):
+            db.session.add(Device(
+                name=f"Device {i}",
+                ip_address=f"10.0.0.{i + 1}",
+                device_type="server"
+            ))
+        db.session.commit()
+    
+    def test_collect_all_metrics_concurrent(self, app):
+        """Test de collecte parallèle sur tous les appareils"""
+        with app.app_context():
+            self._add_devices(5)
+            app.config['POLLING_MAX_WORKERS'] = 3
+            
+            scheduler = MonitoringScheduler()
+            scheduler.app = app
+            
+            def fake_collect(device, ping_result=None, writer=None):
+                device.status = 'online' if device.id % 2 else 'offline'
+                # Comme la vraie collecte : état confié au tampon d'écriture
+                writer.record(device, [])
+                db.session.expunge(device)
+                return {'status': 'success', 'snmp_responding': True}
+            
+            with patch.object(scheduler.snmp_service, 'collect_device_metrics', side_effect=fake_collect), \
+                    patch.object(scheduler.snmp_service, 'ping_many', return_value={}), \
+                    patch('app.tasks.scheduler.broadcast_device_update'), \
+                    patch('app.tasks.scheduler.broadcast_devices_stats') as mock_stats:
+                scheduler.collect_all_metrics()
+            
+            stats = mock_stats.call_args[0][0]
+            assert stats == {'total': 5, 'online': 3, 'offline': 2, 'warning': 0}
+            assert scheduler.last_cycle['devices'] == 5
+            assert scheduler.last_cycle['workers'] == 3
+            assert len(scheduler.previous_device_states) == 5
+    
+    def test_status_change_detected(self, app):
+        """Test de détection d'un changement d'état pendant la collecte"""
+        with app.app_context():
+            self._add_devices(1)
+            device_id = Device.query.first().id
+            
+            scheduler = MonitoringScheduler()
+            scheduler.app = app
+            scheduler.previous_device_states[device_id] = 'online'
+            
+            def fake_collect(device, ping_result=None, writer=None):
+                device.status = 'offline'
+                return {'status': 'error'}
+            
+            with patch.object(scheduler.snmp_service, 'collect_device_metrics', side_effect=fake_collect), \
+                    patch.object(scheduler.snmp_service, 'ping_many', return_value={}), \
+                    patch.object(scheduler, '_handle_status_change') as mock_change, \
+                    patch('app.tasks.scheduler.broadcast_device_update'), \
+                    patch('app.tasks.scheduler.broadcast_devices_stats'):
+                scheduler.collect_all_metrics()
+            
+            mock_change.assert_called_once()
+            assert mock_change.call_args[0][1:] == ('online', 'offline')
+
+    def test_refresh_poll_queue_primes_device_states(self, app):
+        """Test de la synchronisation de la file et de l'état en mémoire avec la table des appareils"""
+        with app.app_context():
+            self._add_devices(3)
+            scheduler = MonitoringScheduler()
+            scheduler.app = app
+            
+            with patch('app.tasks.scheduler.broadcast_devices_stats') as broadcast:
+                scheduler._refresh_poll_queue()
+                device_id = Device.query.first().id
+                assert device_id in scheduler.poll_queue
+                assert scheduler.device_states.complete
+                assert scheduler.device_states.get_status()['devices'] == 3
+                assert broadcast.call_args[0][0]['total'] == 3
+                # Parc complet servi depuis la mémoire avant toute sonde (clients Socket.IO)
+                snapshot = sorted(scheduler.device_states.snapshot(), key=lambda data: data['id'])
+                assert snapshot == [device.to_dict() for device in Device.query.order_by(Device.id)]
+                
+                # Statut en mémoire pris en compte dans les statistiques
+                device = db.session.get(Device, device_id)
+                device.status = 'online'
+                scheduler.device_states.record(device)
+                db.session.rollback()
+                Device.query.filter(Device.id != device_id).delete()
+                db.session.commit()
+                scheduler._refresh_poll_queue()
+                assert broadcast.call_args[0][0] == {'total': 1, 'online': 1, 'offline': 0, 'warning': 0}
+                assert scheduler.device_states.get_status()['devices'] == 1
+    
+    def test_cleanup_old_metrics_in_chunks(self, app):
+        """Test de la purge par lots : seules les métriques expirées sont supprimées"""
+        from app.models.device import DeviceMetric
+        with app.app_context():
+            self._add_devices(1)
+            device_id = Device.query.first().id
+            old = datetime.utcnow() - timedelta(days=31)
+            db.session.add_all(
+                [DeviceMetric(device_id=device_id, metric_type='cpu', value=i, unit='%', timestamp=old) for i in range(5)]
+                + [DeviceMetric(device_id=device_id, metric_type='cpu', value=1.0, unit='%')]
+            )
+            db.session.commit()
+            app.config.update(RETENTION_CHUNK_SIZE=2, RETENTION_CHUNK_PAUSE=0)
+            
+            scheduler = MonitoringScheduler()
+            scheduler.app = app
+            scheduler.cleanup_old_metrics()
+            
+            assert DeviceMetric.query.count() == 1
+            assert scheduler.last_cleanup['deleted'] == 5
+            assert scheduler.last_cleanup['chunks'] == 3
+            assert scheduler.last_cleanup['complete'] is True
+            assert 'duration' in scheduler.last_cleanup
+
+
+class TestDeviceBackoff:
+    """Tests pour le backoff des appareils injoignables"""
+    
+    def test_backoff_after_threshold(self):
+        """Test du passage en backoff exponentiel après plusieurs échecs"""
+        backoff = DeviceBackoff(base_delay=30, threshold=2, max_delay=100)
+        now = datetime(2024, 1, 1)
+        
+        backoff.record_failure(1, 'unreachable', now)
+        assert not backoff.is_degraded(1)
+        assert not backoff.is_waiting(1, now)
+        
+        backoff.record_failure(1, 'unreachable', now)
+        assert backoff.is_degraded(1)
+        assert backoff.is_waiting(1, now + timedelta(seconds=29))
+        assert not backoff.is_waiting(1, now + timedelta(seconds=30))
+        
+        backoff.record_failure(1, 'liveness', now)
+        assert backoff.is_waiting(1, now + timedelta(seconds=59))
+        
+        # Délai plafonné
+        backoff.record_failure(1, 'liveness', now)
+        assert not backoff.is_waiting(1, now + timedelta(seconds=100))
+        assert backoff.get_state(1)['state'] == 'degraded'
+        
+        backoff.record_success(1)
+        assert backoff.get_state(1)['state'] == 'normal'
+    
+    def test_degraded_device_skipped_then_recovers(self, app):
+        """Test d'un appareil en backoff : ignoré, puis sonde de vie réussie"""
+        with app.app_context():
+            db.session.add(Device(name="Router", ip_address="10.0.0.1", device_type="router"))
+            db.session.commit()
+            device_id = Device.query.first().id
+            
+            scheduler = MonitoringScheduler()
+            scheduler.app = app
+            scheduler.backoff = DeviceBackoff(base_delay=30, threshold=1)
+            scheduler.backoff.record_failure(device_id, 'unreachable')
+            
+            with patch.object(scheduler.snmp_service, 'collect_device_metrics') as mock_collect, \
+                    patch('app.tasks.scheduler.broadcast_device_update'):
+                assert scheduler._poll_device(device_id)[1] is False
+                mock_collect.assert_not_called()
+                
+                # Backoff échu et l'appareil répond à la sonde de vie
+                scheduler.backoff._states[device_id]['next_probe_at'] = datetime.utcnow()
+                mock_collect.return_value = {'status': 'success', 'snmp_responding': True}
+                with patch.object(scheduler.snmp_service, 'probe_liveness', return_value=True):
+                    assert scheduler._poll_device(device_id)[1] is True
+                mock_collect.assert_called_once()
+                assert scheduler.backoff.get_state(device_id)['consecutive_failures'] == 0
+    
+    def test_ping_only_success_is_up(self, app):
+        """Test d'un appareil qui répond au ping mais pas à SNMP : en ligne, sans backoff"""
+        with app.app_context():
+            device = Device(name="Router", ip_address="10.0.0.1", device_type="router", status="online")
+            scheduler = MonitoringScheduler()
+            scheduler.backoff = DeviceBackoff(threshold=1)
+            
+            scheduler._record_probe_result(device, {'status': 'success', 'snmp_responding': False})
+            assert scheduler.backoff.get_state(device.id)['consecutive_failures'] == 0
+    
+    def test_failed_liveness_marks_device_offline(self, app):
+        """Test d'une sonde de vie sans réponse : appareil hors ligne, notifié, sans collecte SNMP"""
+        with app.app_context():
+            db.session.add(Device(name="Router", ip_address="10.0.0.1", device_type="router", status="online"))
+            db.session.commit()
+            device_id = Device.query.first().id
+            
+            scheduler = MonitoringScheduler()
+            scheduler.app = app
+            scheduler.backoff = DeviceBackoff(base_delay=30, threshold=1)
+            scheduler.backoff.record_failure(device_id, 'error', datetime.utcnow() - timedelta(minutes=5))
+            scheduler.previous_device_states[device_id] = 'online'
+            
+            with patch.object(scheduler.snmp_service, 'probe_liveness', return_value=False), \
+                    patch.object(scheduler.snmp_service, 'get_snmp_values') as mock_get, \
+                    patch.object(scheduler.notification_service, 'notify_device_down') as mock_down, \
+                    patch('app.tasks.scheduler.broadcast_device_update'), \
+                    patch('app.tasks.scheduler.broadcast_alert'):
+                assert scheduler._poll_device(device_id) == ('offline', True)
+            
+            mock_get.assert_not_called()
+            mock_down.assert_called_once()
+            assert scheduler.device_states.state(device_id)['status'] == 'offline'
+            assert scheduler.backoff.get_state(device_id)['reason'] == 'unreachable'
+    
+    def test_backed_off_devices_not_pinged(self, app):
+        """Test d'un tick : appareil en backoff ni pingé ni sondé, replanifié à l'échéance du backoff"""
+        with app.app_context():
+            scheduler = MonitoringScheduler()
+            scheduler.app = app
+            scheduler.executor = Mock()
+            scheduler.backoff = DeviceBackoff(base_delay=120, threshold=1)
+            scheduler.backoff.record_failure(2, 'unreachable')
+            scheduler.poll_queue.sync([(1, 'switch', '10.0.0.1'), (2, 'switch', '10.0.0.2')], now=0)
+            due = scheduler.poll_queue.pop_due(now=60)
+            
+            with patch.object(scheduler.snmp_service, 'ping_many', return_value={}) as mock_ping:
+                scheduler._poll_batch(due)
+            
+            mock_ping.assert_called_once_with(['10.0.0.1'])
+            assert [call.args[1] for call in scheduler.executor.submit.call_args_list] == [1]
+            assert scheduler.poll_queue.seconds_until_next() > 100
+            assert scheduler.telemetry.snapshot()['counters']['backoff_skipped'] == 0
+
+
+class TestPollQueue:
+    """Tests pour la file de priorité des échéances de collecte"""
+    
+    def test_intervals_per_device_type(self):
+        """Test des intervalles par type d'appareil et de la répartition initiale"""
+        queue = PollQueue(default_interval=60, type_intervals={'router': 10})
+        queue.sync([(1, 'router', '10.0.0.1'), (2, 'server', '10.0.0.2')], now=0)
+        
+        assert queue.interval_for('router') == 10
+        assert queue.interval_for('server') == 60
+        # Première échéance tirée dans l'intervalle de chaque appareil
+        first = {device_id for device_id, _ in queue.pop_due(now=10)}
+        assert 1 in first
+        rest = {device_id for device_id, _ in queue.pop_due(now=60)}
+        assert first | rest == {1, 2}
+    
+    def test_reschedule_fixed_rate(self):
+        """Test de la replanification à intervalle fixe"""
+        queue = PollQueue(default_interval=30)
+        queue.sync([(1, 'switch', '10.0.0.1')], now=0)
+        
+        due = queue.pop_due(now=30)
+        assert [device_id for device_id, _ in due] == [1]
+        first_due = due[0][1]['due']
+        
+        # Pas de double collecte tant que la sonde est en cours
+        assert queue.pop_due(now=100) == []
+        
+        # Sonde terminée avant l'échéance suivante (gigue initiale quelconque)
+        assert queue.reschedule(1, now=first_due + 1) == (first_due + 30, 0)
+        assert queue.pop_due(now=first_due + 29) == []
+        assert len(queue.pop_due(now=first_due + 30)) == 1
+    
+    def test_reschedule_coalesces_overrun(self):
+        """Test de la fusion des échéances manquées après un dépassement"""
+        queue = PollQueue(default_interval=10)
+        queue.sync([(1, 'switch', '10.0.0.1')], now=0)
+        
+        due = queue.pop_due(now=10)[0][1]['due']
+        # La sonde a duré 35 secondes : 3 échéances manquées, une seule replanifiée
+        next_due, missed = queue.reschedule(1, now=due + 35)
+        assert missed == 3
+        assert next_due == pytest.approx(due + 40)
+        assert len(queue.pop_due(now=next_due)) == 1
+    
+    def test_sync_removes_deleted_devices(self):
+        """Test du retrait des appareils supprimés"""
+        queue = PollQueue(default_interval=30)
+        queue.sync([(1, 'switch', '10.0.0.1'), (2, 'switch', '10.0.0.2')], now=0)
+        queue.sync([(2, 'switch', '10.0.0.2')], now=0)
+        
+        assert 1 not in queue
+        assert [device_id for device_id, _ in queue.pop_due(now=30)] == [2]
+
+
+class TestPollTelemetry:
+    """Tests pour la télémétrie d'ordonnancement"""
+    
+    def test_probe_deadline_and_overrun(self, app):
+        """Test de l'échéance dure d'une sonde et du comptage des dépassements"""
+        with app.app_context():
+            scheduler = MonitoringScheduler()
+            scheduler.app = app
+            scheduler.device_deadline = 1
+            scheduler.poll_queue.sync([(1, 'switch', '10.0.0.1')], now=0)
+            entry = scheduler.poll_queue.pop_due(now=30)[0][1]
+            
+            def slow_poll(device_id, ping_result=None):
+                time.sleep(1.1)
+                return 'online', True
+            
+            scheduler.telemetry.probe_queued()
+            with patch.object(scheduler, '_poll_device', side_effect=slow_poll):
+                # Sonde démarrée 65 secondes après son échéance
+                scheduler._probe_due_device(1, time.monotonic() - 65, entry['interval'], None)
+            
+            snapshot = scheduler.telemetry.snapshot()
+            assert snapshot['counters']['probes'] == 1
+            assert snapshot['counters']['deadline_exceeded'] == 1
+            assert snapshot['lag']['max'] >= 65
+            assert snapshot['in_flight'] == 0
+    
+    def test_monitoring_status_endpoint(self, client):
+        """Test de l'API de télémétrie du planificateur"""
+        response = client.get('/api/monitoring/status')
+        assert response.status_code == 200
+        data = response.get_json()
+        assert 'counters' in data['polling']
+        assert 'lag' in data['polling']
+
+
+class TestAppFactory:
+    """Tests de la fabrique d'application"""
+    
+    def test_create_app_without_scheduler(self):
+        """Test du démarrage du processus web sans planificateur de collecte"""
+        from app import create_app, scheduler
+        create_app(start_scheduler=False)
+        assert scheduler.get_scheduler_status()['running'] is False
+        
+        create_app(start_scheduler=True)
+        assert scheduler.get_scheduler_status()['running'] is True
+        scheduler.shutdown()
+    
+    def test_create_app_fails_on_unreachable_message_queue(self, monkeypatch):
+        """Test du refus de démarrer lorsque la file de messages Socket.IO est injoignable"""
+        from app import create_app
+        monkeypatch.setattr('config.Config.SOCKETIO_MESSAGE_QUEUE', 'redis://127.0.0.1:1/0')
+        with pytest.raises(RuntimeError, match='SOCKETIO_MESSAGE_QUEUE'):
+            create_app(start_scheduler=False)
+
+
+class TestShardCoordinator:
+    """Tests pour la répartition du parc entre processus de collecte"""
+    
+    def _add_devices(self, count):
+        for i in range(count):
+            db.session.add(Device(name=f"Device {i}", ip_address=f"10.1.0.{i + 1}", device_type="switch"))
+        db.session.commit()
+        return [device.id for device in Device.query.all()]
+    
+    def test_disjoint_ownership(self, app):
+        """Test de l'attribution disjointe et complète des appareils"""
+        with app.app_context():
+            device_ids = self._add_devices(40)
+            now = datetime.utcnow()
+            worker_a = ShardCoordinator(worker_id='poller-a', lease_ttl=30)
+            worker_b = ShardCoordinator(worker_id='poller-b', lease_ttl=30)
+            
+            # Premier tour : A s'annonce seul et prend tout, B arrive ensuite
+            assert worker_a.rebalance(device_ids, now=now) == set(device_ids)
+            worker_b.rebalance(device_ids, now=now)
+            # A cède ce qui revient à B, puis B le prend
+            worker_a.rebalance(device_ids, now=now)
+            worker_b.rebalance(device_ids, now=now)
+            
+            owned_a, owned_b = worker_a.owned_devices, worker_b.owned_devices
+            assert owned_a and owned_b
+            assert not owned_a & owned_b
+            assert owned_a | owned_b == set(device_ids)
+    
+    def test_takeover_after_worker_death(self, app):
+        """Test de la reprise des baux d'un processus disparu"""
+        with app.app_context():
+            device_ids = self._add_devices(20)
+            now = datetime.utcnow()
+            worker_a = ShardCoordinator(worker_id='poller-a', lease_ttl=30)
+            worker_b = ShardCoordinator(worker_id='poller-b', lease_ttl=30)
+            for coordinator in (worker_a, worker_b, worker_a, worker_b):
+                coordinator.rebalance(device_ids, now=now)
+            
+            # A ne donne plus signe de vie : B reprend tout à l'expiration des baux
+            later = now + timedelta(seconds=31)
+            assert worker_b.rebalance(device_ids, now=later) == set(device_ids)
+            assert not worker_a.owns(device_ids[0], now=later)
+    
+    def test_lease_never_stolen(self, app):
+        """Test qu'un bail valide n'est pas pris par un autre processus"""
+        with app.app_context():
+            device_ids = self._add_devices(10)
+            now = datetime.utcnow()
+            worker_a = ShardCoordinator(worker_id='poller-a', lease_ttl=30)
+            worker_a.rebalance(device_ids, now=now)
+            
+            # B se croit seul (heartbeat de A ignoré) : les baux de A restent à A
+            worker_b = ShardCoordinator(worker_id='poller-b', lease_ttl=30)
+            with patch.object(worker_b, 'heartbeat', return_value=['poller-b']):
+                assert worker_b.rebalance(device_ids, now=now) == set()
+    
+    def test_release_all(self, app):
+        """Test de la libération des baux à l'arrêt"""
+        with app.app_context():
+            device_ids = self._add_devices(5)
+            now = datetime.utcnow()
+            worker_a = ShardCoordinator(worker_id='poller-a', lease_ttl=30)
+            worker_b = ShardCoordinator(worker_id='poller-b', lease_ttl=30)
+            worker_a.rebalance(device_ids, now=now)
+            worker_a.release_all()
+            
+            assert worker_b.rebalance(device_ids, now=now) == set(device_ids)
+    
+    def test_fleet_versions_of_dead_workers_forgotten(self, app):
+        """Test de la suppression des compteurs de version d'un processus disparu"""
+        with app.app_context():
+            now = datetime.utcnow()
+            worker_a = ShardCoordinator(worker_id='poller-a', lease_ttl=30)
+            worker_b = ShardCoordinator(worker_id='poller-b', lease_ttl=30)
+            worker_a.heartbeat(now=now)
+            worker_b.heartbeat(now=now)
+            for worker_id in ('poller-a', 'poller-b', None):
+                set_fleet_writer(worker_id)
+                bump_fleet_version(db.session)
+            set_fleet_writer()
+            db.session.commit()
+            
+            # A ne donne plus signe de vie : sa ligne disparaît, la ligne commune reste
+            worker_b.heartbeat(now=now + timedelta(seconds=31))
+            writers = {row.writer for row in FleetVersion.query.all()}
+            assert writers == {'poller-b', 'default'}
@@ -1,8 +1,13 @@
 import pytest
+import time
 from unittest.mock import Mock, patch
-from app.services.snmp import SNMPService
+from app.services.snmp import (
+    SNMPService, CounterRateTracker, ProbeDeadlineExceeded, get_snmp_service, get_shared_engine, probe_deadline
+)
 from app.services.notifier import NotificationService
-from app.models.device import Device
+from app.services.metric_writer import MetricWriter
+from app.models.device import Device, DeviceMetric, PollProfile, db
+
 
 class TestSNMPService:
     """Tests pour le service SNMP"""
@@ -25,6 +30,28 @@ class TestSNMPService:
             result = snmp_service.ping_device('192.168.255.255')
             assert result is False
     
+    def test_ping_device_subprocess_fallback(self):
+        """Test du repli sur la commande ping sans socket ICMP"""
+        snmp_service = SNMPService()
+        snmp_service.pinger.socket_type = None
+        
+        with patch('subprocess.run') as mock_run:
+            mock_run.return_value.returncode = 0
+            result = snmp_service.ping_device('127.0.0.1')
+            assert result is True
+            mock_run.assert_called_once()
+    
+    def test_ping_many_native(self):
+        """Test du ping ICMP natif par lot"""
+        snmp_service = SNMPService()
+        if not snmp_service.pinger.available:
+            pytest.skip("Sockets ICMP non autorisés")
+        
+        results = snmp_service.ping_many(['127.0.0.1', '127.0.0.2'], timeout=1)
+        assert results['127.0.0.1']['alive'] is True
+        assert results['127.0.0.1']['rtt'] is not None
+        assert results['127.0.0.2']['loss'] == 0.0
+    
     def test_collect_device_metrics_no_snmp(self, app, sample_device):
         """Test de collecte de métriques sans SNMP"""
         with app.app_context():
@@ -38,6 +65,742 @@ class TestSNMPService:
                 assert 'metrics' in result
                 assert sample_device.status == 'online'
 
+    def test_collect_device_metrics_saves_samples(self, app, sample_device):
+        """Test de l'enregistrement des échantillons d'un appareil en base"""
+        with app.app_context():
+            db.session.add(sample_device)
+            db.session.commit()
+            snmp_service = SNMPService()
+            snmp_service.snmp_available = False
+            
+            with patch.object(snmp_service, 'ping_device', return_value=True):
+                result = snmp_service.collect_device_metrics(sample_device)
+            
+            assert result['status'] == 'success'
+            stored = DeviceMetric.query.filter_by(device_id=sample_device.id).all()
+            assert len(stored) == len(result['metrics'])
+
+    def test_shared_snmp_service(self):
+        """Test du service et du moteur SNMP partagés par le processus"""
+        assert get_snmp_service() is get_snmp_service()
+        assert SNMPService().engine is get_shared_engine()
+    
+    def test_transport_target_cached(self):
+        """Test de la réutilisation des cibles de transport et des identifiants"""
+        engine = get_shared_engine()
+        if not SNMPService().snmp_available:
+            pytest.skip("PySNMP non disponible")
+        
+        target = engine.transport_target('127.0.0.1', 161, 5)
+        assert engine.transport_target('127.0.0.1', 161, 5) is target
+        assert engine.transport_target('127.0.0.1', 162, 5) is not target
+        assert engine.auth_data('public') is engine.auth_data('public')
+
+    def test_usm_auth_data_cached(self):
+        """Test des identifiants SNMPv3 : clés maîtresses dérivées une seule fois"""
+        snmp_service = SNMPService()
+        if not snmp_service.snmp_available:
+            pytest.skip("PySNMP non disponible")
+
+        from app.services.snmp import USM_AUTH_PROTOCOLS, USM_PRIV_PROTOCOLS
+        engine = get_shared_engine()
+        sha, aes = USM_AUTH_PROTOCOLS['sha'], USM_PRIV_PROTOCOLS['aes']
+
+        auth = engine.usm_auth_data('mon', sha, 'authpass-cache', aes, 'privpass-cache')
+        assert engine.usm_auth_data('mon', sha, 'authpass-cache', aes, 'privpass-cache') is auth
+
+        # Un autre agent (engine ID distinct) réutilise les clés maîtresses déjà calculées
+        with patch.object(engine, '_master_keys', wraps=engine._master_keys) as master_keys:
+            other = engine.usm_auth_data('mon', sha, 'authpass-cache', aes, 'privpass-cache', b'\x80\x00\x01')
+        assert other is not auth
+        assert other.authKey == auth.authKey
+        assert master_keys.setdefault.call_count == 0
+
+    def test_auth_for_v3_uses_stored_engine_id(self, app):
+        """Test de la réutilisation de l'engine ID enregistré en base (sans découverte)"""
+        snmp_service = SNMPService()
+        if not snmp_service.snmp_available:
+            pytest.skip("PySNMP non disponible")
+
+        from app.models.device import SNMPCredential
+        with app.app_context():
+            device = Device(name='v3', ip_address='10.3.3.3', device_type='router', snmp_version='3')
+            device.snmp_credential = SNMPCredential(
+                username='mon', auth_key='authpass-db', priv_key='privpass-db', engine_id='80001f8880aabbcc'
+            )
+            db.session.add(device)
+            db.session.commit()
+
+            engine = snmp_service.engine
+            with patch.object(engine, 'discover_engine_id') as discover:
+                auth = snmp_service.auth_for(device)
+
+            discover.assert_not_called()
+            assert bytes(auth.securityEngineId) == bytes.fromhex('80001f8880aabbcc')
+            assert engine.peer_engine_id('10.3.3.3', snmp_service._snmp_options().get('port', 161)) == \
+                bytes.fromhex('80001f8880aabbcc')
+
+    def test_get_snmp_values_single_pdu(self):
+        """Test de lecture groupée avec repli GETNEXT pour les OIDs absents"""
+        snmp_service = SNMPService()
+        if not snmp_service.snmp_available:
+            pytest.skip("PySNMP non disponible")
+        
+        from pysnmp.proto.rfc1905 import NoSuchInstance
+        
+        engine = Mock()
+        engine.request.side_effect = [
+            # GET groupé : l'index 1 de hrProcessorLoad n'existe pas
+            (None, 0, 0, [('1.3.6.1.2.1.1.3.0', 4200), ('1.3.6.1.2.1.25.3.3.1.2.1', NoSuchInstance())]),
+            # GETNEXT de repli sur la colonne
+            (None, 0, 0, [('1.3.6.1.2.1.25.3.3.1.2.196608', 12)])
+        ]
+        
+        with patch('app.services.snmp.get_shared_engine', return_value=engine):
+            values = snmp_service.get_snmp_values(
+                '10.0.0.1', ['1.3.6.1.2.1.1.3.0', '1.3.6.1.2.1.25.3.3.1.2.1']
+            )
+        
+        assert values == {'1.3.6.1.2.1.1.3.0': 4200, '1.3.6.1.2.1.25.3.3.1.2.1': 12}
+        assert engine.request.call_args_list[0][0][0] == 'get'
+        assert engine.request.call_args_list[1][0][0] == 'next'
+        assert engine.request.call_args_list[1][0][3] == ['1.3.6.1.2.1.25.3.3.1.2']
+
+    def test_poll_profile_discovery(self, app):
+        """Test de la découverte des processeurs, de la ligne de RAM et des interfaces"""
+        snmp_service = SNMPService()
+        if not snmp_service.snmp_available:
+            pytest.skip("PySNMP non disponible")
+        
+        with app.app_context():
+            first = Device(name="Server 1", ip_address="10.0.0.1", device_type="server")
+            second = Device(name="Server 2", ip_address="10.0.0.2", device_type="server")
+            db.session.add_all([first, second])
+            db.session.commit()
+            
+            processors = '1.3.6.1.2.1.25.3.3.1.2'
+            storage_types = '1.3.6.1.2.1.25.2.3.1.2'
+            identity = (None, 0, 0, [('1.3.6.1.2.1.1.2.0', '1.3.6.1.4.1.8072.3.2.10'), ('1.3.6.1.2.1.1.3.0', 4200)])
+            engine = Mock()
+            engine.request.side_effect = [
+                identity,
+                # Deux processeurs ; index 1 = disque fixe, index 10 = mémoire vive
+                (None, 0, 0, {
+                    processors: {'196608': 12, '196609': 30},
+                    storage_types: {'1': '1.3.6.1.2.1.25.2.1.4', '10': '1.3.6.1.2.1.25.2.1.2'}
+                }),
+                # Compteurs 64 bits présents
+                (None, 0, 0, [('1.3.6.1.2.1.31.1.1.1.6.1', 1000)]),
+                # Second hôte du même modèle : ses processeurs, sans redétection des interfaces
+                identity,
+                (None, 0, 0, {processors: {'196608': 5}, storage_types: {}})
+            ]
+            
+            with patch('app.services.snmp.get_shared_engine', return_value=engine):
+                profile = snmp_service.get_poll_profile(first)
+                assert profile['scalar_oids'] == {
+                    'uptime': '1.3.6.1.2.1.1.3.0',
+                    'cpu.196608': processors + '.196608',
+                    'cpu.196609': processors + '.196609',
+                    'storage_used': '1.3.6.1.2.1.25.2.3.1.6.10',
+                    'storage_size': '1.3.6.1.2.1.25.2.3.1.5.10'
+                }
+                assert profile['interface_counter_bits'] == 64
+                
+                profile = snmp_service.get_poll_profile(second)
+                assert sorted(profile['scalar_oids']) == ['cpu.196608', 'uptime']
+                assert profile['interface_counter_bits'] == 64
+                assert engine.request.call_count == 5
+                
+                # Profil frais : aucune requête supplémentaire
+                snmp_service.get_poll_profile(first)
+                assert engine.request.call_count == 5
+            
+            db.session.commit()
+            assert PollProfile.query.count() == 2
+    
+    def test_profile_saved_without_committing_probe(self, app):
+        """Test de l'enregistrement d'un profil sans écrire l'état en mémoire de l'appareil"""
+        from app.services.device_state import DeviceStateStore
+        with app.app_context():
+            device = Device(name="Server", ip_address="10.0.0.3", device_type="server")
+            db.session.add(device)
+            db.session.commit()
+            store = DeviceStateStore()
+            store.sync([device], complete=True)
+            device.status, device.cpu_usage = 'online', 42.0
+            store.record(device)
+            db.session.rollback()
+            
+            # Sonde : état en mémoire recopié, profil découvert puis enregistré
+            device = db.session.get(Device, device.id)
+            store.apply(device)
+            snmp_service = SNMPService()
+            discovered = {'sys_object_id': None, 'scalar_oids': {'uptime': '1.3.6.1.2.1.1.3.0'},
+                          'interface_counter_bits': None}
+            with patch.object(snmp_service, 'discover_capabilities', return_value=discovered):
+                snmp_service.get_poll_profile(device)
+            assert device.status == 'online' and not db.session.dirty
+            db.session.rollback()
+            
+            assert db.session.get(PollProfile, device.id).scalar_oids == discovered['scalar_oids']
+            assert db.session.execute(db.select(Device.status, Device.cpu_usage)).one() == ('unknown', 0.0)
+    
+    def test_collect_uses_profile(self, app):
+        """Test de la collecte en un seul GET : moyenne des processeurs et RAM"""
+        snmp_service = SNMPService()
+        if not snmp_service.snmp_available:
+            pytest.skip("PySNMP non disponible")
+        
+        with app.app_context():
+            device = Device(name="Server", ip_address="10.0.0.1", device_type="server")
+            db.session.add(device)
+            db.session.commit()
+            
+            profile = {
+                'scalar_oids': {
+                    'uptime': '1.3.6.1.2.1.1.3.0',
+                    'cpu.1': '1.3.6.1.2.1.25.3.3.1.2.1',
+                    'cpu.2': '1.3.6.1.2.1.25.3.3.1.2.2',
+                    'storage_used': '1.3.6.1.2.1.25.2.3.1.6.10',
+                    'storage_size': '1.3.6.1.2.1.25.2.3.1.5.10'
+                },
+                'interface_counter_bits': None,
+                'stale': False
+            }
+            values = {
+                '1.3.6.1.2.1.1.3.0': 4200,
+                '1.3.6.1.2.1.25.3.3.1.2.1': 20,
+                '1.3.6.1.2.1.25.3.3.1.2.2': 60,
+                '1.3.6.1.2.1.25.2.3.1.6.10': 250,
+                '1.3.6.1.2.1.25.2.3.1.5.10': 1000
+            }
+            
+            with patch.object(snmp_service, 'get_poll_profile', return_value=profile), \
+                    patch.object(snmp_service, 'get_snmp_values', return_value=values) as mock_get:
+                result = snmp_service.collect_device_metrics(device, {'alive': True, 'rtt': 1.0})
+            
+            assert mock_get.call_count == 1
+            assert result['snmp_responding'] is True
+            assert device.cpu_usage == 40.0
+            assert device.memory_usage == 25.0
+    
+    def test_probe_deadline_bounds_requests(self):
+        """Test de l'échéance dure : plus aucune requête SNMP après l'échéance"""
+        engine = get_shared_engine()
+        target = Mock(timeout=5, retries=5)
+        
+        with patch.object(engine, 'submit') as mock_submit:
+            with probe_deadline(0.01):
+                time.sleep(0.02)
+                with pytest.raises(ProbeDeadlineExceeded):
+                    engine.request('get', Mock(), target, ['1.3.6.1.2.1.1.3.0'])
+            mock_submit.assert_not_called()
+
+
+class TestSimulatedAgents:
+    """Collecte de bout en bout contre la ferme d'agents simulés (hors ligne)"""
+
+    def test_collect_from_simulated_farm(self, app):
+        """Test de découverte et de collecte : serveur complet et commutateur sans HOST-RESOURCES-MIB"""
+        snmp_service = SNMPService()
+        if not snmp_service.snmp_available:
+            pytest.skip("PySNMP non disponible")
+
+        from benchmarks.snmp_simulator import SimulatedAgent, SimulatorFarm
+        agents = [
+            SimulatedAgent('127.1.250.1', model='server', cpus=2, interfaces=2, seed=1),
+            SimulatedAgent('127.1.250.2', model='switch', counters='wrap', interfaces=2, seed=2)
+        ]
+        try:
+            farm = SimulatorFarm(agents, port=16199).start()
+        except OSError as e:
+            pytest.skip(f"Adresses de boucle locale indisponibles: {e}")
+
+        app.config.update(SNMP_PORT=16199, SNMP_TIMEOUT=1)
+        try:
+            server = Device(name='sim-server', ip_address='127.1.250.1', device_type='server')
+            switch = Device(name='sim-switch', ip_address='127.1.250.2', device_type='switch')
+            db.session.add_all([server, switch])
+            db.session.commit()
+
+            results = {}
+            for _ in range(2):
+                for device in (server, switch):
+                    results[device.name] = snmp_service.collect_device_metrics(device, {'alive': True, 'rtt': 0.1})
+                time.sleep(0.1)
+        finally:
+            farm.stop()
+
+        server_metrics = {metric['type'] for metric in results['sim-server']['metrics']}
+        switch_metrics = {metric['type'] for metric in results['sim-switch']['metrics']}
+        assert {'uptime', 'cpu', 'memory', 'bandwidth_in.1', 'bandwidth_out.2'} <= server_metrics
+        assert 'cpu' not in switch_metrics and 'memory' not in switch_metrics
+        assert 'bandwidth_in.1' in switch_metrics
+
+        assert db.session.get(PollProfile, server.id).interface_counter_bits == 64
+        assert db.session.get(PollProfile, switch.id).interface_counter_bits == 32
+        assert len([oid for metric, oid in db.session.get(PollProfile, server.id).scalar_oids.items()
+                    if metric.startswith('cpu')]) == 2
+
+    def test_walk_snmpv1_agent(self):
+        """Test du parcours de table d'un agent SNMPv1 par GETNEXT (pas de GETBULK)"""
+        snmp_service = SNMPService()
+        if not snmp_service.snmp_available:
+            pytest.skip("PySNMP non disponible")
+
+        from benchmarks.snmp_simulator import SimulatedAgent, SimulatorFarm
+        try:
+            farm = SimulatorFarm([SimulatedAgent('127.1.250.3', model='switch', interfaces=3, seed=3)],
+                                 port=16198).start()
+        except OSError as e:
+            pytest.skip(f"Adresses de boucle locale indisponibles: {e}")
+
+        columns = ['1.3.6.1.2.1.2.2.1.10', '1.3.6.1.2.1.2.2.1.16']
+        try:
+            table = snmp_service.walk_table(
+                '127.1.250.3', columns, port=16198, timeout=1,
+                auth_data=snmp_service.engine.auth_data('public', mp_model=0)
+            )
+        finally:
+            farm.stop()
+
+        assert {column: sorted(rows) for column, rows in table.items()} == \
+            {column: ['1', '2', '3'] for column in columns}
+
+
+class TestMetricWriter:
+    """Tests de l'écriture groupée des métriques"""
+
+    def test_flush_single_transaction(self, app):
+        """Test d'écriture d'un lot : échantillons, état des appareils, appareil supprimé écarté"""
+        from app.models.device import DeviceMetric
+        with app.app_context():
+            devices = [Device(name=f'd{i}', ip_address=f'10.5.0.{i}', device_type='server') for i in (1, 2, 3)]
+            db.session.add_all(devices)
+            db.session.commit()
+
+            writer = MetricWriter(batch_size=100)
+            for device in devices:
+                device.status = 'online'
+                device.cpu_usage = 42.0
+                assert writer.record(device, [
+                    {'type': 'cpu', 'value': 42.0, 'unit': '%'},
+                    {'type': 'memory', 'value': 10.0, 'unit': '%'}
+                ]) is False
+            db.session.rollback()
+
+            # Supprimé avant l'écriture : ses lignes sont écartées
+            db.session.delete(db.session.get(Device, devices[2].id))
+            db.session.commit()
+
+            with patch.object(db.session, 'commit', wraps=db.session.commit) as commit:
+                assert writer.flush() == 4
+            assert commit.call_count == 1
+            assert writer.pending == 0
+            assert DeviceMetric.query.count() == 4
+            assert {device.status for device in Device.query.all()} == {'online'}
+            assert Device.query.first().cpu_usage == 42.0
+
+    def test_batch_size_and_interval(self, app):
+        """Test des déclencheurs : lot plein et intervalle d'écriture"""
+        with app.app_context():
+            device = Device(name='d', ip_address='10.5.1.1', device_type='server')
+            db.session.add(device)
+            db.session.commit()
+
+            writer = MetricWriter(batch_size=3, flush_interval=5)
+            metric = {'type': 'cpu', 'value': 1.0, 'unit': '%'}
+            assert writer.record(device, [metric, metric]) is False
+            assert writer.record(device, [metric]) is True
+
+            now = writer._last_flush
+            assert writer.flush_if_due(now + 1) == 0
+            assert writer.flush_if_due(now + 5) == 3
+            assert writer.get_status()['samples_written'] == 3
+
+    def test_background_writer_drains_on_stop(self, app):
+        """Test du thread d'écriture : les sondes ne flushent pas, la file est vidée à l'arrêt"""
+        from app.models.device import DeviceMetric
+        with app.app_context():
+            device = Device(name='d', ip_address='10.5.1.2', device_type='server')
+            db.session.add(device)
+            db.session.commit()
+
+            writer = MetricWriter(batch_size=2, flush_interval=60)
+            writer.start(app)
+            try:
+                metric = {'type': 'cpu', 'value': 1.0, 'unit': '%'}
+                # Lot plein : le thread d'écriture s'en charge
+                assert writer.record(device, [metric, metric]) is False
+                deadline = time.monotonic() + 5
+                while writer.get_status()['samples_written'] < 2 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                assert writer.get_status()['samples_written'] == 2
+
+                writer.record(device, [metric])
+                assert writer.get_status()['oldest_pending_age'] is not None
+            finally:
+                assert writer.stop() == 0
+            assert not writer.running
+            assert DeviceMetric.query.count() == 3
+            status = writer.get_status()
+            assert status['flush_latency']['samples'] == 2
+            assert status['pending'] == 0 and status['oldest_pending_age'] is None
+
+    def test_queue_full_policies(self, app):
+        """Test des politiques de file pleine : écarter les anciens, les nouveaux, contre-pression bornée"""
+        device = Device(id=1, name='d', ip_address='10.5.1.3', device_type='server')
+
+        def metrics(*values):
+            return [{'type': 'cpu', 'value': value, 'unit': '%'} for value in values]
+
+        writer = MetricWriter(batch_size=100, max_pending=3, policy='drop_oldest')
+        writer.record(device, metrics(1, 2, 3))
+        writer.record(device, metrics(4, 5))
+        assert [row['value'] for row in writer._samples] == [3, 4, 5]
+        assert writer.stats['dropped'] == 2
+
+        writer = MetricWriter(batch_size=100, max_pending=3, policy='drop_newest')
+        writer.record(device, metrics(1, 2))
+        writer.record(device, metrics(3, 4))
+        assert [row['value'] for row in writer._samples] == [1, 2, 3]
+        assert writer.stats['dropped'] == 1
+
+        # Contre-pression : la sonde attend une place, au plus block_timeout
+        writer = MetricWriter(batch_size=100, flush_interval=60, max_pending=2, block_timeout=0.2)
+        writer.start(app)
+        try:
+            writer.record(device, metrics(1, 2))
+            started = time.monotonic()
+            writer.record(device, metrics(3))
+            assert time.monotonic() - started >= 0.2
+            assert writer.stats['blocked'] == 1
+            assert writer.stats['dropped'] == 1
+        finally:
+            writer.stop()
+
+        with pytest.raises(ValueError):
+            writer.configure(policy='unknown')
+
+
+class TestDeviceStateStore:
+    """Tests de l'état des appareils tenu en mémoire"""
+
+    def test_only_changed_columns_persisted(self, app):
+        """Test de l'écriture différée : statut sans attendre, petites variations retenues"""
+        from datetime import datetime, timedelta
+        with app.app_context():
+            device = Device(name='d', ip_address='10.5.4.1', device_type='server')
+            db.session.add(device)
+            db.session.commit()
+            device_id = device.id
+            writer = MetricWriter()
+            store = writer.state_store
+            store.configure(flush_interval=3600, tolerance=1.0, max_staleness=300)
+            store.sync(Device.query.all(), complete=True)
+
+            def probe(**values):
+                device = db.session.get(Device, device_id)
+                store.apply(device)
+                for column, value in values.items():
+                    setattr(device, column, value)
+                writer.record(device, [])
+                db.session.expunge(device)
+                writer.flush()
+                return db.session.execute(db.select(Device.status, Device.cpu_usage).where(Device.id == device_id)).one()
+
+            now = datetime.utcnow()
+            assert probe(status='online', cpu_usage=10.0, last_seen=now) == ('online', 10.0)
+            assert writer.stats['devices_updated'] == 1
+
+            # Même statut, variation sous la tolérance : rien n'est écrit, même à l'échéance
+            assert probe(cpu_usage=10.5, last_seen=now + timedelta(seconds=30)) == ('online', 10.0)
+            store._last_flush = float('-inf')
+            assert probe(cpu_usage=10.6, last_seen=now + timedelta(seconds=60)) == ('online', 10.0)
+            assert writer.stats['devices_updated'] == 1
+            # Lecture servie par la mémoire
+            assert store.get(device_id)['cpu_usage'] == 10.6
+            assert store.overlay({'id': device_id, 'cpu_usage': 10.0})['cpu_usage'] == 10.6
+
+            # Changement de statut : écrit à la prochaine écriture, avec les colonnes modifiées
+            assert probe(status='offline') == ('offline', 10.6)
+            assert writer.stats['devices_updated'] == 2
+            assert store.get_status()['dirty'] == 0
+
+            # Appareil supprimé entre-temps : oublié
+            Device.query.filter_by(id=device_id).delete()
+            db.session.commit()
+            writer.state_store.record(Device(id=device_id, name='d', ip_address='10.5.4.1', device_type='server',
+                                             status='warning'))
+            writer.flush()
+            assert store.get(device_id) is None
+
+
+class TestFleetStats:
+    """Tests des agrégats du parc (tableau de bord, rapport quotidien)"""
+
+    def test_group_by_with_memory_state(self, app):
+        """Test des comptes par type et des classements, corrigés de l'état en mémoire"""
+        from app.services.device_state import DeviceStateStore
+        from app.services.fleet_stats import fleet_stats, status_counts
+        with app.app_context():
+            for index, (device_type, status, cpu) in enumerate([
+                ('server', 'online', 20.0), ('server', 'offline', None), ('router', 'online', 70.0),
+                ('router', 'warning', 40.0), ('switch', 'online', 10.0)
+            ]):
+                db.session.add(Device(name=f'f{index}', ip_address=f'10.6.0.{index + 1}', device_type=device_type,
+                                      status=status, cpu_usage=cpu, memory_usage=float(index)))
+            db.session.commit()
+
+            stats = fleet_stats(top=2)
+            assert {key: stats[key] for key in ('total', 'online', 'offline', 'warning')} == \
+                {'total': 5, 'online': 3, 'offline': 1, 'warning': 1}
+            assert stats['by_type']['router'] == {'total': 2, 'online': 1, 'offline': 0, 'warning': 1}
+            assert [device['name'] for device in stats['top_cpu']] == ['f2', 'f3']
+            assert [device['name'] for device in stats['top_memory']] == ['f4', 'f3']
+
+            # Sonde pas encore écrite en base : l'état en mémoire l'emporte
+            store = DeviceStateStore()
+            store.sync(Device.query.all(), complete=True)
+            device = Device.query.filter_by(name='f4').one()
+            device.status, device.cpu_usage = 'offline', 95.0
+            store.record(device)
+            db.session.rollback()
+
+            stats = fleet_stats(store, top=2)
+            assert status_counts(store) == {'total': 5, 'online': 2, 'offline': 2, 'warning': 1}
+            assert stats['by_type']['switch'] == {'total': 1, 'online': 0, 'offline': 1, 'warning': 0}
+            assert [(device['name'], device['cpu_usage']) for device in stats['top_cpu']] == \
+                [('f4', 95.0), ('f2', 70.0)]
+
+
+class TestChunkStorage:
+    """Tests du stockage compressé des séries"""
+
+    def test_codec_roundtrip(self):
+        """Test de compression / décompression sans perte, horodatages irréguliers compris"""
+        from app.services.timeseries_codec import decode_series, encode_series
+        timestamps = [1_700_000_000_000 + 30_000 * i + (i % 3) for i in range(500)] + [1_800_000_000_000]
+        values = [round(20 + (i % 17) * 0.7, 1) for i in range(500)] + [float('inf')]
+        data = encode_series(timestamps, values)
+        assert decode_series(data) == (timestamps, values)
+        # Moins de la moitié des 16 octets d'un couple (horodatage, flottant) brut
+        assert len(data) < 8 * len(values)
+        assert decode_series(encode_series([], [])) == ([], [])
+        with pytest.raises(ValueError):
+            decode_series(data[:40])
+
+    def test_writer_appends_to_chunks(self, app):
+        """Test d'écriture en blocs : ajout au bloc existant, fenêtres, lecture de plage"""
+        from datetime import datetime, timedelta
+        from app.models.chunk import MetricChunk
+        from app.models.device import DeviceMetric
+        from app.services.metric_storage import from_millis, read_series
+        with app.app_context():
+            app.config.update(METRIC_STORAGE='chunks', METRIC_CHUNK_WINDOW=3600)
+            device = Device(name='d', ip_address='10.5.2.1', device_type='server')
+            db.session.add(device)
+            db.session.commit()
+
+            writer = MetricWriter(batch_size=1000)
+            start = datetime(2024, 1, 1, 10, 0, 0)
+            # 90 minutes en deux lots, le second contenant un échantillon en retard
+            for minutes in (range(0, 45), list(range(46, 90)) + [45]):
+                for minute in minutes:
+                    writer.record(device, [{'type': 'cpu', 'value': float(minute), 'unit': '%'}],
+                                  timestamp=start + timedelta(minutes=minute))
+                writer.flush()
+
+            assert DeviceMetric.query.count() == 0
+            chunks = MetricChunk.query.order_by(MetricChunk.window_start).all()
+            assert [chunk.count for chunk in chunks] == [60, 30]
+            assert chunks[1].start_time == start + timedelta(hours=1)
+
+            unit, timestamps, values = read_series(device.id, start + timedelta(minutes=30),
+                                                   start + timedelta(minutes=70))['cpu']
+            assert unit == '%'
+            assert list(values) == [float(minute) for minute in range(30, 71)]
+            assert from_millis(timestamps[0]) == start + timedelta(minutes=30)
+
+    def test_open_chunk_extended_without_decoding(self, app):
+        """Test d'ajout à un bloc ouvert par l'encodeur en mémoire, décodage si la base a changé"""
+        from datetime import datetime, timedelta
+        from app.models.chunk import MetricChunk
+        from app.services import metric_storage
+        from app.services.timeseries_codec import decode_series, encode_series
+        with app.app_context():
+            device = Device(name='d', ip_address='10.5.2.2', device_type='server')
+            db.session.add(device)
+            db.session.commit()
+            start = datetime(2024, 1, 1)
+            samples = [
+                {'device_id': device.id, 'metric_type': 'cpu', 'value': float(minute), 'unit': '%',
+                 'timestamp': start + timedelta(minutes=minute)}
+                for minute in range(6)
+            ]
+
+            metric_storage.append_to_chunks(samples[:3], window=3600)
+            db.session.commit()
+            with patch.object(metric_storage, 'decode_series') as mock_decode:
+                metric_storage.append_to_chunks(samples[3:5], window=3600)
+                db.session.commit()
+            mock_decode.assert_not_called()
+
+            # Bloc modifié hors de ce processus : décodé puis réencodé
+            chunk = MetricChunk.query.one()
+            chunk.data = encode_series(*[values[:4] for values in decode_series(chunk.data)])
+            db.session.commit()
+            with patch.object(metric_storage, 'decode_series', side_effect=decode_series) as mock_decode:
+                metric_storage.append_to_chunks(samples[5:], window=3600)
+                db.session.commit()
+            mock_decode.assert_called_once()
+
+            db.session.expire_all()
+            chunk = MetricChunk.query.one()
+            assert chunk.count == 5
+            assert decode_series(chunk.data)[1] == [0.0, 1.0, 2.0, 3.0, 5.0]
+
+    def test_retention_purges_expired_chunks(self, app):
+        """Test de la purge des blocs entièrement expirés"""
+        from datetime import datetime, timedelta
+        from app.models.chunk import MetricChunk
+        from app.services.metric_storage import append_to_chunks
+        from app.services.retention import MetricRetention
+        with app.app_context():
+            device = Device(name='d', ip_address='10.5.3.1', device_type='server')
+            db.session.add(device)
+            db.session.commit()
+            start = datetime(2024, 1, 1)
+            append_to_chunks([
+                {'device_id': device.id, 'metric_type': 'cpu', 'value': 1.0, 'unit': '%',
+                 'timestamp': start + timedelta(minutes=30 * i)}
+                for i in range(10)
+            ], window=3600)
+            db.session.commit()
+
+            result = MetricRetention(chunk_size=2, pause=0).purge_before(start + timedelta(hours=3, minutes=15))
+            assert result['deleted_blocks'] == 3
+            assert result['complete'] is True
+            # Le bloc à cheval sur la date limite est conservé
+            assert MetricChunk.query.order_by(MetricChunk.window_start).first().window_start == start + timedelta(hours=3)
+
+
+class TestMetricRetention:
+    """Tests des politiques de rétention par métrique et par résolution"""
+
+    def test_policies_order_and_defaults(self):
+        """Test de l'ordre des politiques et des paliers repris du défaut"""
+        from config import parse_retention_policies
+        from app.services.retention import retention_policies
+        overrides = parse_retention_policies('bandwidth_*:raw=2;cpu:raw=7;uptime:raw=6h,1m=1,5m=1,1h=30')
+        policies = retention_policies(30, {'1m': 30, '5m': 90, '1h': 365}, overrides)
+        assert [metric_type for metric_type, _ in policies] == ['cpu', 'uptime', 'bandwidth_*', '*']
+        assert dict(policies)['cpu'] == {'raw': 7, '1m': 30, '5m': 90, '1h': 365}
+        assert dict(policies)['uptime']['raw'] == 0.25
+        assert dict(policies)['*']['raw'] == 30
+        with pytest.raises(ValueError):
+            retention_policies(30, overrides={'cpu': {'10m': 7}})
+
+    def _write(self, device_id, metric_type, start, count, rollups=True):
+        from datetime import timedelta
+        from app.models.device import DeviceMetric
+        from app.services.metric_storage import write_samples
+        samples = [
+            {'device_id': device_id, 'metric_type': metric_type, 'value': float(i), 'unit': 'u',
+             'timestamp': start + timedelta(minutes=i)}
+            for i in range(count)
+        ]
+        if rollups:
+            write_samples(samples)
+        else:
+            db.session.execute(DeviceMetric.__table__.insert(), samples)
+        db.session.commit()
+
+    def test_purge_per_metric_type_and_tier(self, app):
+        """Test de la purge par palier : brut court, agrégats conservés, compaction des lignes non agrégées"""
+        from datetime import datetime, timedelta
+        from app.models.device import DeviceMetric
+        from app.models.rollup import MetricRollup1h, MetricRollup1m
+        from app.services.retention import MetricRetention, retention_policies
+        now = datetime(2024, 6, 1)
+        with app.app_context():
+            device = Device(name='d', ip_address='10.5.4.1', device_type='server')
+            db.session.add(device)
+            db.session.commit()
+            old = now - timedelta(days=10)
+            for metric_type in ('cpu', 'uptime', 'bandwidth_in.1', 'latency'):
+                self._write(device.id, metric_type, old, 5)
+            # Lignes écrites sans agrégats : agrégées avant suppression
+            self._write(device.id, 'memory', old, 5, rollups=False)
+
+            policies = retention_policies(30, {'1m': 8, '5m': 90, '1h': 365}, {
+                'cpu': {'raw': 7}, 'memory': {'raw': 7}, 'bandwidth_*': {'raw': 2},
+                'uptime': {'raw': 1, '1m': 1, '5m': 1, '1h': 5}
+            })
+            result = MetricRetention(chunk_size=100, pause=0, policies=policies).purge(now=now)
+
+            assert result['complete'] is True
+            assert result['deleted'] == 20
+            assert result['compacted'] == 5
+            assert result['deleted_rollups'] == {'1m': 20, '5m': 1, '1h': 1}
+            assert {row.metric_type for row in DeviceMetric.query} == {'latency'}
+            hourly = {rollup.metric_type: rollup for rollup in MetricRollup1h.query}
+            assert set(hourly) == {'cpu', 'memory', 'bandwidth_in.1', 'latency'}
+            assert hourly['memory'].count == 5 and hourly['memory'].value_max == 4.0
+            # Agrégats 1 min expirés pour toutes les métriques (8 jours par défaut)
+            assert MetricRollup1m.query.count() == 0
+
+    def test_purge_respects_row_budget(self, app):
+        """Test du budget de lignes par passage : le passage suivant reprend"""
+        from datetime import datetime, timedelta
+        from app.models.device import DeviceMetric
+        from app.services.retention import MetricRetention, retention_policies
+        now = datetime(2024, 6, 1)
+        with app.app_context():
+            device = Device(name='d', ip_address='10.5.4.2', device_type='server')
+            db.session.add(device)
+            db.session.commit()
+            self._write(device.id, 'cpu', now - timedelta(days=10), 5)
+            retention = MetricRetention(chunk_size=2, pause=0, policies=retention_policies(7))
+
+            result = retention.purge(now=now, max_rows=3)
+            assert (result['deleted'], result['chunks'], result['complete']) == (3, 2, False)
+            result = retention.purge(now=now, max_rows=3)
+            assert (result['deleted'], result['complete']) == (2, True)
+            assert DeviceMetric.query.count() == 0
+
+
+class TestCounterRateTracker:
+    """Tests pour le calcul des débits d'interface"""
+    
+    def test_rate_from_consecutive_samples(self):
+        """Test du débit entre deux échantillons (sysUpTime en centièmes)"""
+        tracker = CounterRateTracker()
+        assert tracker.rate((1, '2', 'in'), 1000, 10000) is None
+        # 1000 octets en 10 secondes = 800 bits/s
+        assert tracker.rate((1, '2', 'in'), 2000, 11000) == 800.0
+    
+    def test_counter32_wrap(self):
+        """Test du rebouclage d'un compteur 32 bits"""
+        tracker = CounterRateTracker()
+        tracker.rate((1, '2', 'in'), 2 ** 32 - 500, 10000)
+        assert tracker.rate((1, '2', 'in'), 500, 10100) == 8000.0
+    
+    def test_counter64_discontinuity(self):
+        """Test d'un compteur 64 bits qui recule (pas de débit)"""
+        tracker = CounterRateTracker()
+        tracker.rate((1, '2', 'in'), 5000, 10000, counter_bits=64)
+        assert tracker.rate((1, '2', 'in'), 100, 10100, counter_bits=64) is None
+    
+    def test_agent_reboot(self):
+        """Test d'un redémarrage de l'agent (sysUpTime qui recule)"""
+        tracker = CounterRateTracker()
+        tracker.rate((1, '2', 'in'), 5000, 900000)
+        assert tracker.rate((1, '2', 'in'), 100, 300) is None
+        assert tracker.rate((1, '2', 'in'), 1100, 1300) == 800.0
+
+
 class TestNotificationService:
     """Tests pour le service de notifications"""
     